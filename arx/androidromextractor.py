@@ -2,13 +2,29 @@ import logging
 import os
 import tempfile
 
+from functools import partial
 from pathlib import Path
-from typing import Dict, Set, Callable, Optional, List
+from typing import Callable, Dict, Set, Iterable, List, Optional, Tuple
 from os.path import isdir, isfile, basename, join
 
 from arx.sdat2img.sdat2img import sdat2img
-from arx.shell_wrapper import aunpack, findw, find, mount, catfiles, resize2fs, unyaffs
+from arx import telemetry
+from arx.archive import stored_member_offset, unpacked_size
+from arx.cache import ExtractionCache
+from arx.imagefs import ImageFsError, extract_tree, open_filesystem
+from arx.journal import Journal
+from arx.mounts import MountError, MountManager
+from arx.partitions import PartitionFilter
+from arx.yaffs import YaffsFileSystem
+from arx.rawprogram import assembled_pieces
+from arx.scheduler import Stage, StageScheduler, RESOURCE_CPU, RESOURCE_DISK
+from arx.scratch import ScratchSpace
+from arx.sdat2img.sdat2img import BLOCK_SIZE, read_transfer_list
+from arx.streams import streamable_transfer_lists, read_member_lines
+from arx.telemetry import Recorder, CATEGORY_STEP, optional_span
+from arx.shell_wrapper import aunpack, find, catfiles, resize2fs, unyaffs
 from arx.utility import find_biggest_archive, filetype_to_files
+from arx.workdir_index import WorkDirIndex
 from arx.formats_extraction import \
     extract_pac, \
     extract_kdz, \
@@ -17,8 +33,10 @@ from arx.formats_extraction import \
     extract_ota_payload_bin, \
     extract_br, \
     extract_ubi_image, \
-    sparsechunks_to_raw, \
+    sparse_chunks_list, \
+    sparse_chunks_to_raw, \
     sparse_single_to_raw, \
+    stream_sdat2img, \
     extract_update_app, \
     extract_sign_img, \
     extract_lz4, \
@@ -26,123 +44,399 @@ from arx.formats_extraction import \
 
 logger = logging.getLogger('rom_analyzer')
 
+IMAGE_MOUNT = 'mount'
+IMAGE_YAFFS = 'yaffs'
+IMAGE_FILE = 'file'
+IMAGE_SPLIT = 'split'  # read in place from its parts, the path is the first one
 
-def unpack_archive(in_file: str, unpack_dir: str) -> bool:
+# unpack_and_mount results: mount points, or ImageFileSystem handles read in userspace
+RESULT_MOUNT = 'mount'
+RESULT_FILESYSTEM = 'fs'
+
+# steps of unpack_and_mount checkpointed in the journal of the work dir, in order
+STEP_PAYLOAD = 'payload'
+STEP_UNPACK = 'unpack'
+STEP_STAGES = 'stages'
+STEP_IMAGES = 'images'
+
+# archives in archives unpacked, e.g. zip -> tar.md5 -> ...
+MAX_ARCHIVE_DEPTH = 4
+
+# output/input size of the extractors, to reserve disk space before they run
+EXPANSION_LZ4 = 2.5
+EXPANSION_BROTLI = 3
+EXPANSION_PAYLOAD = 2.5
+EXPANSION_SIN = 1.5
+EXPANSION_DZ = 2.5
+
+
+def unpack_archive(in_file: str, unpack_dir: str, index: Optional[WorkDirIndex] = None,
+                   keep: Optional[PartitionFilter] = None, scratch: Optional[ScratchSpace] = None) -> bool:
+    # in_file, then the biggest archive each unpack produced (zip -> tar.md5 -> ...), up to
+    # MAX_ARCHIVE_DEPTH levels
     assert isfile(in_file)
     assert isdir(unpack_dir)
-    if aunpack(in_file, unpack_dir):
-        biggest_archive = find_biggest_archive(unpack_dir)
-        if biggest_archive is not None and biggest_archive != in_file:
-            return aunpack(biggest_archive, unpack_dir)
-        return True
-    return False
+    if index is None:
+        index = WorkDirIndex(unpack_dir)
+    if scratch is None:
+        scratch = ScratchSpace(unpack_dir, index, keep_intermediates=True)
+    archive = in_file
+    for depth in range(MAX_ARCHIVE_DEPTH):
+        before = set(index.files())
+        with scratch.reserving(unpacked_size(archive, keep), f'unpack {basename(archive)}'):
+            if not aunpack(archive, unpack_dir, keep):
+                return False
+        index.refresh()
+        if archive != in_file:
+            scratch.consume([archive])
+        nested = find_biggest_archive(unpack_dir, index, among=set(index.files()) - before)
+        if nested is None or nested == in_file:
+            return True
+        archive = nested
+    logger.warning("{} nests more than {} archives, {} is left packed".format(in_file, MAX_ARCHIVE_DEPTH, archive))
+    return True
 
 
-def add_mount(diz: dict, tmp_dir: str, img_path: str):
+def add_mount(diz: dict, tmp_dir: str, img_path: str, mounts: Optional[MountManager] = None):
+    # mounts: None to mount read-write and leave it mounted
     assert isdir(tmp_dir)
     assert isfile(img_path)
     bname = os.path.basename(img_path)
     assert bname not in diz
-    mnt_point = tempfile.mkdtemp(dir=tmp_dir)
-    if mount(img_path, mnt_point):
-        diz[bname] = mnt_point
+    if mounts is None:
+        mounts = MountManager(read_only=False, max_mounts=None)
+    try:
+        diz[bname] = mounts.mount(img_path, tmp_dir)
         logger.info("{} -> {}".format(bname, diz))
+    except MountError as e:
+        logger.error("Mount failed! {}".format(e))
+        if 'system' in bname.lower():
+            raise
+
+
+def add_filesystem(diz: dict, img_path: str, parts: Optional[List[str]] = None,
+                   mounts: Optional[MountManager] = None):
+    assert parts is not None or isfile(img_path)
+    bname = os.path.basename(img_path)
+    assert bname not in diz
+    fs = open_filesystem(img_path, parts)
+    if fs is not None:
+        diz[bname] = fs
+        if mounts is not None:
+            mounts.track(fs)
+        logger.info("{} -> {}".format(bname, fs))
     else:
-        logger.error("Mount failed! Img={}".format(bname))
+        logger.error("Unreadable filesystem! Img={}".format(bname))
         if 'system' in bname.lower():
-            raise Exception('Mount of system failed!')
+            raise Exception('Read of system failed!')
+
+
+def transfer_list_to_img(tr: str, work_dir: str, cache: Optional[ExtractionCache] = None) -> bool:
+    new_dat = tr.replace('.transfer.list', '.new.dat')
+    assert isfile(new_dat)
+    new_img = os.path.join(work_dir, f"{basename(new_dat)}.img")
+
+    def convert() -> bool:
+        result = sdat2img(tr, new_dat, new_img)
+        logger.info("sdat2img {} -> {} ({} blocks, {})".format(
+            basename(new_dat), new_img, result.blocks_written, result.android_version))
+        return True
+
+    if cache is not None:
+        cache.cached_artifact('sdat2img', [tr, new_dat], new_img, convert)
+    else:
+        convert()
+    assert isfile(new_img)
+    return True
+
+
+def transfer_list_inputs(tr: str) -> List[str]:
+    return [tr, tr.replace('.transfer.list', '.new.dat')]
+
+
+def new_dat_size(tr: str) -> int:
+    return os.path.getsize(tr.replace('.transfer.list', '.new.dat'))
+
+
+def streamed_image_size(archive: str, transfer_list_member: str) -> int:
+    # bytes of new data, the zero ranges stay holes
+    return read_transfer_list(read_member_lines(archive, transfer_list_member)).new_blocks * BLOCK_SIZE
+
+
+def scaled_size(f: str, factor: float = 1) -> int:
+    return int(os.path.getsize(f) * factor)
+
+
+def consumed_input(f: str) -> List[str]:
+    return [f]
+
 
+def rawprogram_size(rawprogram0_xml: str, partitions: Optional[Iterable[str]] = None) -> int:
+    return sum(os.path.getsize(p) for p in assembled_pieces(rawprogram0_xml, partitions) if isfile(p))
 
-def search_and_unpack(work_dir: str, patt_wild: str, unpack_method: Callable):
-    imgs = findw(work_dir, patt_wild)
-    if imgs is not None:
-        for img in imgs:
-            if not unpack_method(img):
-                raise Exception(f"'{patt_wild}' search and unpack failed")
 
+def cached_sparse_single_to_raw(img: str, cache: ExtractionCache) -> Optional[str]:
+    raw_img = f'{img}.raw'
+    if cache.cached_artifact('simg2img', [img], raw_img, lambda: sparse_single_to_raw(img) is not None):
+        return raw_img
+    return None
 
-def unpack_and_mount(in_file: str, work_dir: str = None, mnt_dir: str = None) -> Dict:
+
+def cached_sparse_chunks_to_raw(sc_name: str, imgs: List[str], cache: ExtractionCache) -> Optional[str]:
+    raw_img = join(os.path.dirname(imgs[0]), f'{sc_name}.img.raw')
+    if cache.cached_artifact('sparsechunks', imgs, raw_img, lambda: sparse_chunks_to_raw(sc_name, imgs) is not None):
+        return raw_img
+    return None
+
+
+def extraction_stages(work_dir: str, cache: Optional[ExtractionCache] = None,
+                      partitions: Optional[Iterable[str]] = None) -> List[Stage]:
+    # Inputs are looked up when a stage starts, so a stage must come after every stage that
+    # may produce its inputs
+    # consumes: what the scratch space removes once a job succeeded, estimate: what it reserves before
+    return [
+        Stage('update_app', ('UPDATE.APP',), partial(extract_update_app, partitions=partitions), RESOURCE_DISK,
+              consumes=consumed_input, estimate=scaled_size),
+        Stage('payload', ('payload.bin',), partial(extract_ota_payload_bin, output_dir=work_dir, partitions=partitions),
+              RESOURCE_CPU, output_dir=work_dir, consumes=consumed_input,
+              estimate=partial(scaled_size, factor=EXPANSION_PAYLOAD)),
+        Stage('rawprogram', ('rawprogram0.xml',), partial(unsparse_joiner, partitions=partitions), RESOURCE_DISK,
+              consumes=partial(assembled_pieces, partitions=partitions),
+              estimate=partial(rawprogram_size, partitions=partitions)),
+        Stage('pac', ('*pac',), extract_pac, RESOURCE_DISK, consumes=consumed_input, estimate=scaled_size),
+        Stage('sign', ('*-sign.img',), extract_sign_img, RESOURCE_DISK,
+              after=('update_app', 'payload', 'rawprogram', 'pac'), consumes=consumed_input, estimate=scaled_size),
+        Stage('lz4', ('*.lz4',), extract_lz4, RESOURCE_CPU, after=('pac',), consumes=consumed_input,
+              estimate=partial(scaled_size, factor=EXPANSION_LZ4)),
+        Stage('br', ('*.br',), extract_br, RESOURCE_CPU, after=('lz4',), consumes=consumed_input,
+              estimate=partial(scaled_size, factor=EXPANSION_BROTLI)),
+        Stage('sin', ('*.sin',), extract_sin, RESOURCE_CPU, after=('pac',), consumes=consumed_input,
+              estimate=partial(scaled_size, factor=EXPANSION_SIN)),
+        Stage('kdz', ('*.kdz',), partial(extract_kdz, partitions=partitions), RESOURCE_CPU, after=('pac',),
+              consumes=consumed_input, estimate=partial(scaled_size, factor=EXPANSION_DZ)),
+        Stage('dz', ('*.dz',), partial(extract_dz, partitions=partitions), RESOURCE_CPU, after=('kdz',),
+              consumes=consumed_input, estimate=partial(scaled_size, factor=EXPANSION_DZ)),
+        Stage('sdat2img', ('*.transfer.list',), partial(transfer_list_to_img, work_dir=work_dir, cache=cache), RESOURCE_DISK,
+              after=('br',), output_dir=work_dir, consumes=transfer_list_inputs, estimate=new_dat_size),
+    ]
+
+
+def unpack_and_mount(in_file: str, work_dir: str = None, mnt_dir: str = None, max_workers: int = None,
+                     cache: Optional[ExtractionCache] = None, partitions: Optional[Iterable[str]] = None,
+                     result_mode: str = RESULT_MOUNT, recorder: Optional[Recorder] = None,
+                     keep_intermediates: bool = False, disk_budget: Optional[int] = None,
+                     virtual_splits: bool = False, resume: bool = False,
+                     mounts: Optional[MountManager] = None, yaffs_paths: Optional[Iterable[str]] = None) -> Dict:
+    # partitions: names of the partitions to extract (e.g. system, vendor), None for all of them
+    # result_mode: RESULT_FILESYSTEM needs no privileges, the caller closes the returned handles
+    # recorder: collects the time and resources taken by each step, stage, job and command
+    # keep_intermediates: keep the archives, compressed and sparse images once they are converted
+    # disk_budget: bytes work_dir may take, jobs wait for room or fail when it can't be made
+    # virtual_splits: with RESULT_FILESYSTEM and no cache, read split images (system_1.img,
+    #   system_2.img, ...) in place rather than concatenating them
+    # resume: journal the completed steps in work_dir, and skip those of a previous run of the same
+    #   ROM and options whose files are intact
+    # mounts: mounts the images (read-only by default) and closes the returned mounts and handles
+    #   when it is closed. Without it the images are mounted read-write and stay mounted.
+    # yaffs_paths: with RESULT_MOUNT, extract only these files and folders of the YAFFS2 images
+    #   (e.g. /app, /framework, /build.prop), None for all of them
+    assert result_mode in (RESULT_MOUNT, RESULT_FILESYSTEM)
     assert isfile(in_file)
+    journal = None
     if work_dir is None:
         work_dir = tempfile.mkdtemp()
+    elif resume:
+        st = os.stat(in_file)
+        journal = Journal(work_dir, {'rom': os.path.abspath(in_file), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                                     'partitions': sorted(partitions) if partitions is not None else None,
+                                     'result_mode': result_mode, 'virtual_splits': virtual_splits},
+                          protected=[in_file])
     assert isdir(work_dir)
     if mnt_dir is not None:
         assert os.path.isdir(mnt_dir)
+    index = WorkDirIndex(work_dir)
+    scratch = ScratchSpace(work_dir, index, keep_intermediates, disk_budget, protected=[in_file])
+    if recorder is None:
+        return _unpack_and_mount(in_file, work_dir, max_workers, cache, partitions, result_mode, None, index, scratch,
+                                 virtual_splits, journal, mounts, yaffs_paths)
+    previous = telemetry.current()
+    telemetry.install(recorder)
+    try:
+        with recorder.sample_disk(work_dir), recorder.span('unpack_and_mount', CATEGORY_STEP, rom=in_file):
+            return _unpack_and_mount(in_file, work_dir, max_workers, cache, partitions, result_mode, recorder, index,
+                                     scratch, virtual_splits, journal, mounts, yaffs_paths)
+    finally:
+        telemetry.install(previous)
+
+
+def _unpack_and_mount(in_file: str, work_dir: str, max_workers: Optional[int], cache: Optional[ExtractionCache],
+                      partitions: Optional[Iterable[str]], result_mode: str, recorder: Optional[Recorder],
+                      index: WorkDirIndex, scratch: ScratchSpace, virtual_splits: bool = False,
+                      journal: Optional[Journal] = None, mounts: Optional[MountManager] = None,
+                      yaffs_paths: Optional[Iterable[str]] = None) -> Dict:
+    keep = PartitionFilter(partitions)
+    rom_key = None
+    if cache is not None:
+        with optional_span(recorder, 'cache_get', CATEGORY_STEP):
+            rom_key = cache.rom_key(in_file, result_mode, *sorted(keep.partitions or ()))
+            hit = cache.get(rom_key, work_dir)
+        if hit is not None:
+            files, meta = hit
+            images = [(kind, key, f) for (kind, key), f in zip(meta['images'], files)]
+            with optional_span(recorder, 'mount', CATEGORY_STEP):
+                return mount_images(work_dir, images, result_mode, mounts, yaffs_paths)
+
+    def done(step: str) -> bool:
+        return journal is not None and journal.done(step) is not None
+
+    def checkpoint(step: str, **kwargs):
+        if journal is not None:
+            with optional_span(recorder, 'checkpoint', CATEGORY_STEP, step=step):
+                journal.commit(step, **kwargs)
+
+    if journal is not None:
+        with optional_span(recorder, 'resume', CATEGORY_STEP):
+            journal.resume()
+        index.refresh()
+
+    images_checkpoint = journal.done(STEP_IMAGES) if journal is not None else None
+    if images_checkpoint is not None:
+        images = [(kind, key, join(work_dir, f)) for kind, key, f in images_checkpoint.data['images']]
+    else:
+        # read-only mounts skip the journal, no need to replay it beforehand
+        repair = result_mode == RESULT_MOUNT and (mounts is None or not mounts.read_only)
+        images = _prepare_rom(in_file, work_dir, max_workers, cache, keep, repair, result_mode, recorder, index,
+                              scratch, virtual_splits, done, checkpoint)
+    if scratch.removed_bytes > 0:
+        logger.info("{} bytes of intermediates removed from {}".format(scratch.removed_bytes, work_dir))
+    if cache is not None:
+        with optional_span(recorder, 'cache_put', CATEGORY_STEP):
+            cache.put(rom_key, [f for _, _, f in images],
+                      {'rom': basename(in_file), 'images': [(k, n) for k, n, _ in images]})
+    with optional_span(recorder, 'mount', CATEGORY_STEP):
+        return mount_images(work_dir, images, result_mode, mounts, yaffs_paths)
+
+
+def _prepare_rom(in_file: str, work_dir: str, max_workers: Optional[int], cache: Optional[ExtractionCache],
+                 keep: PartitionFilter, repair: bool, result_mode: str, recorder: Optional[Recorder],
+                 index: WorkDirIndex, scratch: ScratchSpace, virtual_splits: bool, done: Callable[[str], bool],
+                 checkpoint: Callable[..., None]) -> List[Tuple[str, str, str]]:
+    # the steps of unpack_and_mount up to the images to mount, those done(step) are skipped
+    payload_offset = stored_member_offset(in_file, 'payload.bin')
+    if payload_offset is not None:
+        # A/B OTA: the partitions are read straight from the zip, payload.bin is never unpacked
+        if not done(STEP_PAYLOAD):
+            with optional_span(recorder, 'payload', CATEGORY_STEP), \
+                    scratch.reserving(int(os.path.getsize(in_file) * EXPANSION_PAYLOAD), 'payload.bin'):
+                if not extract_ota_payload_bin(in_file, work_dir, keep.partitions, payload_offset):
+                    raise Exception("payload.bin extraction failed")
+            checkpoint(STEP_PAYLOAD)
+        keep = PartitionFilter(keep.partitions, exclude=('payload.bin',))
 
-    if not unpack_archive(in_file, work_dir):
-        raise Exception("Unpack failed")
-
-    update_app = find(work_dir, "UPDATE.APP")
-    if update_app is not None and not extract_update_app(update_app):
-        raise Exception("extract_update_app failed")
-
-    payload_ota = find(work_dir, "payload.bin")
-    if payload_ota is not None and not extract_ota_payload_bin(payload_ota, work_dir):
-        raise Exception("extract_ota_payload_bin failed")
-
-    rawprogram0_xml = find(work_dir, 'rawprogram0.xml')
-    if rawprogram0_xml is not None and not unsparse_joiner(rawprogram0_xml):
-        raise Exception("unsparse_joiner failed")
-
-    search_and_unpack(work_dir, "*pac", extract_pac)
-    search_and_unpack(work_dir, "*-sign.img", extract_sign_img)
-    search_and_unpack(work_dir, "*.lz4", extract_lz4)
-    search_and_unpack(work_dir, "*.br", extract_br)
-    search_and_unpack(work_dir, "*.sin", extract_sin)
-    search_and_unpack(work_dir, "*.kdz", extract_kdz)
-    search_and_unpack(work_dir, "*.dz", extract_dz)
-
-    trlist: Optional[List[str]] = findw(work_dir, "*.transfer.list")
-    if trlist is not None:
-        for tr in trlist:
-            new_dat = tr.replace('.transfer.list', '.new.dat')
-            assert isfile(new_dat)
-            new_img = os.path.join(work_dir, f"{basename(new_dat)}.img")
-            sdat2img(tr, new_dat, new_img)
-            assert isfile(new_img)
-            os.remove(new_dat)
-
-    diz_filetype_to_files = filetype_to_files(work_dir)
+    # new.dat(.br) members are decoded straight from the zip into images, never unpacked
+    streamed = [(tr, new_data) for tr, new_data in streamable_transfer_lists(in_file) if keep(new_data)]
+    if len(streamed) > 0:
+        keep = PartitionFilter(keep.partitions, exclude=keep.exclude | {basename(m) for pair in streamed for m in pair})
+
+    index.refresh()
+    with StageScheduler(index, max_workers, select=keep if keep else None, recorder=recorder,
+                        scratch=scratch) as scheduler:
+        if not done(STEP_UNPACK):
+            streams = [scheduler.submit(RESOURCE_CPU, stream_sdat2img, in_file, tr, new_data, work_dir,
+                                        reserve=streamed_image_size(in_file, tr))
+                       for tr, new_data in streamed]
+            with optional_span(recorder, 'unpack', CATEGORY_STEP):
+                if not unpack_archive(in_file, work_dir, index, keep, scratch):
+                    raise Exception("Unpack failed")
+            if not all(f.result() for f in streams):
+                raise Exception("Streamed sdat2img failed")
+            index.refresh(work_dir)
+            checkpoint(STEP_UNPACK)
+
+        rawprogram0_xml = find(work_dir, 'rawprogram0.xml', index)
+        if not done(STEP_STAGES):
+            with optional_span(recorder, 'stages', CATEGORY_STEP):
+                scheduler.run(extraction_stages(work_dir, cache, keep.partitions))
+            checkpoint(STEP_STAGES)
+        with optional_span(recorder, 'prepare_images', CATEGORY_STEP):
+            images = prepare_images(work_dir, index, scheduler, rawprogram0_xml is not None, cache, keep,
+                                    repair=repair, scratch=scratch,
+                                    virtual_splits=virtual_splits and result_mode == RESULT_FILESYSTEM and cache is None)
+    # mounted read-write, the images change without being damaged
+    checkpoint(STEP_IMAGES, data={'images': [(kind, key, os.path.relpath(f, work_dir)) for kind, key, f in images]},
+               size_only=[f for kind, _, f in images if kind == IMAGE_MOUNT and result_mode == RESULT_MOUNT])
+    return images
+
+
+def prepare_images(work_dir: str, index: WorkDirIndex, scheduler: StageScheduler, has_rawprogram: bool,
+                   cache: Optional[ExtractionCache] = None,
+                   keep: Optional[PartitionFilter] = None, repair: bool = True,
+                   scratch: Optional[ScratchSpace] = None,
+                   virtual_splits: bool = False) -> List[Tuple[str, str, str]]:
+    # (kind, result key, path) of everything unpack_and_mount returns, before any mount.
+    # repair: replay the journal of the images that need it, the kernel refuses to mount them
+    # virtual_splits: IMAGE_SPLIT results for the split images instead of concatenating them
+    if keep is None:
+        keep = PartitionFilter()
+    if scratch is None:
+        scratch = ScratchSpace(work_dir, index, keep_intermediates=True)
+    diz_filetype_to_files = filetype_to_files(work_dir, index=index, select=keep if keep else None)
     logger.debug(diz_filetype_to_files)
-    ret_diz = {}
+    images = []
     for file_type, list_files in diz_filetype_to_files.items():
         file_type: str
         if 'ext4 filesystem data' in file_type or 'ext2 filesystem data' in file_type:
             for f in list_files:
-                if f.endswith('_1.img') and rawprogram0_xml is None:
+                if f.endswith('_1.img') and not has_rawprogram:
                     name = basename(f).replace('_1.img', '')
-                    parent_folder = Path(f).parent
-                    splits = [f]
-                    i = 1
-                    while True:
-                        i += 1
-                        succ_split = join(parent_folder, f'{name}_{i}.img')
-                        if isfile(succ_split):
-                            splits.append(succ_split)
-                        else:
-                            break
-                    out_file = join(parent_folder, f'{name}.img')
+                    if virtual_splits:
+                        images.append((IMAGE_SPLIT, f'{name}.img', f))
+                        continue
+                    splits = split_parts(f)
+                    out_file = join(Path(f).parent, f'{name}.img')
                     assert not isfile(out_file)
-                    if not catfiles(splits, out_file):
-                        raise Exception('catfiles failed')
+                    with scratch.reserving(sum(os.path.getsize(s) for s in splits), f'catfiles {name}'):
+                        if not catfiles(splits, out_file):
+                            raise Exception('catfiles failed')
+                    index.add(out_file)
+                    scratch.consume(splits)
                     f = out_file
-                elif 'needs journal recovery' in file_type:
+                elif 'needs journal recovery' in file_type and repair:
                     assert resize2fs(f)
-                add_mount(ret_diz, work_dir, f)
+                images.append((IMAGE_MOUNT, basename(f), f))
+        if file_type.startswith('EROFS'):
+            for f in list_files:
+                images.append((IMAGE_MOUNT, basename(f), f))
         if file_type.startswith('Android sparse image'):
             sparsechunk_names: Set[str] = set()
+            singles = []
             for f in list_files:
                 if 'sparsechunk' in f:
                     bname = os.path.basename(f)
                     sparsechunk_names.add(bname.split('.')[0])
                     continue
-                raw = sparse_single_to_raw(f)
-                add_mount(ret_diz, work_dir, raw)
+                singles.append(f)
             if len(sparsechunk_names) > 0:
                 logger.info("Sparsechunks found: {}".format(sparsechunk_names))
-            for sc_name in sparsechunk_names:
-                raw = sparsechunks_to_raw(work_dir, sc_name)
-                add_mount(ret_diz, work_dir, raw)
+            sparse_chunks = [(sc_name, sparse_chunks_list(work_dir, sc_name, index)) for sc_name in sparsechunk_names]
+            # the conversions are independent, only the mounts are done one at a time
+            if cache is not None:
+                single_to_raw = partial(cached_sparse_single_to_raw, cache=cache)
+                chunks_to_raw = partial(cached_sparse_chunks_to_raw, cache=cache)
+            else:
+                single_to_raw = sparse_single_to_raw
+                chunks_to_raw = sparse_chunks_to_raw
+            # RAW chunks hold about all the data of the raw image, the rest stays holes
+            raws = scheduler.map(RESOURCE_DISK, single_to_raw, singles, estimate=os.path.getsize)
+            raws += scheduler.starmap(RESOURCE_DISK, chunks_to_raw, sparse_chunks,
+                                      estimate=lambda _, imgs: sum(os.path.getsize(i) for i in imgs))
+            sources = [[f] for f in singles] + [imgs for _, imgs in sparse_chunks]
+            for raw, sparse_imgs in zip(raws, sources):
+                if raw is None:
+                    raise Exception(f'Sparse conversion of {sparse_imgs} failed')
+                index.add(raw)
+                scratch.consume(sparse_imgs)
+                images.append((IMAGE_MOUNT, basename(raw), raw))
         if file_type.startswith('UBI image'):
             raise Exception("UBI unsupported")  #TODO
             #for f in list_files:
@@ -151,16 +445,65 @@ def unpack_and_mount(in_file: str, work_dir: str = None, mnt_dir: str = None) ->
                 #add_mount(ret_diz, work_dir, f)
         if file_type == 'YAFFS':
             for f in list_files:
-                bname = os.path.basename(f)
-                assert bname not in ret_diz
-                mnt_point = tempfile.mkdtemp(dir=work_dir)
-                unyaffs(f, mnt_point)
-                ret_diz[bname] = mnt_point
-                logger.info("{} -> {}".format(bname, ret_diz))
-    boot_img = find(work_dir, 'boot.img')
-    if boot_img is not None:
-        ret_diz['boot'] = boot_img
-    ramdisk_img = find(work_dir, 'ramdisk.img')
-    if ramdisk_img is not None:
-        ret_diz['ramdisk'] = ramdisk_img
+                images.append((IMAGE_YAFFS, basename(f), f))
+    boot_img = find(work_dir, 'boot.img', index)
+    if boot_img is not None and keep(boot_img):
+        images.append((IMAGE_FILE, 'boot', boot_img))
+    ramdisk_img = find(work_dir, 'ramdisk.img', index)
+    if ramdisk_img is not None and keep(ramdisk_img):
+        images.append((IMAGE_FILE, 'ramdisk', ramdisk_img))
+    return images
+
+
+def split_parts(first: str) -> List[str]:
+    # system_1.img -> [system_1.img, system_2.img, ...]
+    name = basename(first).replace('_1.img', '')
+    parent_folder = Path(first).parent
+    splits = [first]
+    i = 1
+    while True:
+        i += 1
+        succ_split = join(parent_folder, f'{name}_{i}.img')
+        if isfile(succ_split):
+            splits.append(succ_split)
+        else:
+            break
+    return splits
+
+
+def extract_yaffs(work_dir: str, img: str, paths: Optional[Iterable[str]] = None) -> str:
+    # folder with the files of a YAFFS2 image, only paths (e.g. /app, /build.prop) when given.
+    # unyaffs extracts what the reader here can't parse, all of it.
+    out_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        with YaffsFileSystem(img) as fs:
+            n = extract_tree(fs, out_dir, paths or ('/',))
+        logger.info("{}: {} files extracted".format(basename(img), n))
+    except ImageFsError as e:
+        logger.warning("{}, trying unyaffs".format(e))
+        unyaffs(img, out_dir)
+    return out_dir
+
+
+def mount_images(work_dir: str, images: List[Tuple[str, str, str]], result_mode: str = RESULT_MOUNT,
+                 mounts: Optional[MountManager] = None, yaffs_paths: Optional[Iterable[str]] = None) -> Dict:
+    # yaffs_paths: files and folders extracted from the YAFFS2 images with RESULT_MOUNT, None for all
+    ret_diz = {}
+    for kind, key, f in images:
+        if kind == IMAGE_MOUNT and result_mode == RESULT_FILESYSTEM:
+            add_filesystem(ret_diz, f, mounts=mounts)
+        elif kind == IMAGE_SPLIT:
+            # the kernel needs the concatenation, prepare_images makes it for mounts
+            assert result_mode == RESULT_FILESYSTEM
+            add_filesystem(ret_diz, join(Path(f).parent, key), split_parts(f), mounts)
+        elif kind == IMAGE_MOUNT:
+            add_mount(ret_diz, work_dir, f, mounts)
+        elif kind == IMAGE_YAFFS and result_mode == RESULT_FILESYSTEM:
+            add_filesystem(ret_diz, f, mounts=mounts)
+        elif kind == IMAGE_YAFFS:
+            assert key not in ret_diz
+            ret_diz[key] = extract_yaffs(work_dir, f, yaffs_paths)
+            logger.info("{} -> {}".format(key, ret_diz[key]))
+        else:
+            ret_diz[key] = f
     return ret_diz
@@ -0,0 +1,529 @@
+import logging
+import lzma
+import os
+import struct
+import tarfile
+import tempfile
+import zipfile
+import zlib
+
+from os.path import isdir, isfile
+from typing import Callable, List, NamedTuple, Optional, Set, Tuple
+
+from arx.classify import RAR_MAGIC, SEVEN_ZIP_MAGIC, ZIP_MAGIC
+from arx.shell_wrapper import UNPACK_TIMEOUT, run_cmd
+
+logger = logging.getLogger('rom_analyzer')
+
+Selector = Callable[[str], bool]
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_LOCAL_HEADER_MAGIC = b'PK\x03\x04'
+# compression methods zipfile extracts, 7za does the others (Deflate64, PPMd, ...)
+ZIPFILE_METHODS = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA)
+# unpacked/packed size of the archives whose listing is not read
+UNPACK_EXPANSION_FACTOR = 3
+# tried in order on encrypted archives
+PASSWORDS = ('www.stockrom.net',)
+
+ARCHIVE_ZIP = 'zip'
+ARCHIVE_7Z = '7z'
+ARCHIVE_RAR = 'rar'
+ARCHIVE_TAR = 'tar'
+
+SEVEN_ZIP_START_HEADER = struct.Struct('<QQI')  # next header offset, size and CRC, after the signature
+SEVEN_ZIP_SIGNATURE_SIZE = 32
+# property ids and coder ids of the 7z headers (7zFormat.txt)
+K_END, K_HEADER, K_ARCHIVE_PROPERTIES, K_ADDITIONAL_STREAMS, K_MAIN_STREAMS, K_FILES_INFO, K_PACK_INFO, \
+    K_UNPACK_INFO, K_SUBSTREAMS_INFO, K_SIZE, K_CRC, K_FOLDER, K_CODERS_UNPACK_SIZE, K_NUM_UNPACK_STREAM, \
+    K_EMPTY_STREAM, K_EMPTY_FILE = range(16)
+K_NAME = 0x11
+K_ENCODED_HEADER = 0x17
+CODER_AES = b'\x06\xF1\x07\x01'
+CODER_LZMA = b'\x03\x01\x01'
+CODER_LZMA2 = b'\x21'
+RAR4_BLOCK = struct.Struct('<HBHH')  # CRC, type, flags, size
+RAR4_FILE = struct.Struct('<IIBIIBBHI')  # packed size, size, host OS, CRC, time, version, method, name size, attrs
+RAR4_MAIN_HEAD = 0x73
+RAR4_FILE_HEAD = 0x74
+RAR4_END_ARCHIVE = 0x7B
+RAR4_MAIN_PASSWORD = 0x0080
+RAR4_FILE_PASSWORD = 0x0004
+RAR4_FILE_DIRECTORY = 0x00E0
+RAR4_LONG_BLOCK = 0x8000
+RAR4_LARGE_FILE = 0x0100
+RAR5_MAGIC = RAR_MAGIC + b'\x01\x00'
+RAR5_FILE = 2
+RAR5_SERVICE = 3
+RAR5_ENCRYPTION = 4
+RAR5_END = 5
+RAR5_EXTRA_ENCRYPTION = 1
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class ArchiveInfo(NamedTuple):
+    kind: str
+    encrypted: bool  # some member, or the listing itself, needs a password
+    members: Optional[List[str]]  # files, None when the listing is encrypted or not readable here
+
+
+class _Reader:
+    # cursor over the bytes of a header
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def byte(self) -> int:
+        if self.pos >= len(self.data):
+            raise ArchiveError('Truncated header')
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def read(self, n: int) -> bytes:
+        if self.pos + n > len(self.data):
+            raise ArchiveError('Truncated header')
+        self.pos += n
+        return self.data[self.pos - n:self.pos]
+
+    def number(self) -> int:
+        # 7z NUMBER: the leading 1 bits of the first byte tell how many little endian bytes follow
+        first = self.byte()
+        mask = 0x80
+        value = 0
+        for i in range(8):
+            if first & mask == 0:
+                return value | (first & (mask - 1)) << (8 * i)
+            value |= self.byte() << (8 * i)
+            mask >>= 1
+        return value
+
+    def vint(self) -> int:
+        # RAR5 vint: 7 bits per byte, the high bit tells that another byte follows
+        value = 0
+        shift = 0
+        while True:
+            b = self.byte()
+            value |= (b & 0x7F) << shift
+            shift += 7
+            if b & 0x80 == 0:
+                return value
+
+    def bits(self, n: int) -> List[bool]:
+        ret = []
+        b = 0
+        for i in range(n):
+            if i % 8 == 0:
+                b = self.byte()
+            ret.append(bool(b & (0x80 >> (i % 8))))
+        return ret
+
+    def defined(self, n: int) -> List[bool]:
+        # "all are defined" byte, else a bit vector
+        return [True] * n if self.byte() else self.bits(n)
+
+
+# (coder id, properties) of each coder of a folder
+Folder = List[Tuple[bytes, bytes]]
+
+
+def _7z_folder(r: _Reader) -> Tuple[Folder, int]:
+    # coders and number of output streams
+    coders = []
+    n_in = n_out = 0
+    for _ in range(r.number()):
+        flags = r.byte()
+        coder_id = r.read(flags & 0x0F)
+        ins = outs = 1
+        if flags & 0x10:
+            ins, outs = r.number(), r.number()
+        props = r.read(r.number()) if flags & 0x20 else b''
+        coders.append((coder_id, props))
+        n_in += ins
+        n_out += outs
+    for _ in range(n_out - 1):
+        # bind pairs
+        r.number()
+        r.number()
+    packed = n_in - (n_out - 1)
+    if packed > 1:
+        for _ in range(packed):
+            r.number()
+    return coders, n_out
+
+
+def _7z_streams_info(r: _Reader) -> Tuple[int, List[int], List[Folder], List[int]]:
+    # pack position, pack sizes, folders and their unpacked sizes (of the last output stream)
+    pack_pos = 0
+    pack_sizes: List[int] = []
+    folders: List[Folder] = []
+    unpack_sizes: List[int] = []
+    n_unpack_streams: List[int] = []
+    while True:
+        prop = r.byte()
+        if prop == K_END:
+            return pack_pos, pack_sizes, folders, unpack_sizes
+        if prop == K_PACK_INFO:
+            pack_pos = r.number()
+            n_pack = r.number()
+            while True:
+                p = r.byte()
+                if p == K_END:
+                    break
+                if p == K_SIZE:
+                    pack_sizes = [r.number() for _ in range(n_pack)]
+                elif p == K_CRC:
+                    r.read(4 * sum(r.defined(n_pack)))
+        elif prop == K_UNPACK_INFO:
+            if r.byte() != K_FOLDER:
+                raise ArchiveError('Bad 7z coders info')
+            n_folders = r.number()
+            if r.byte() != 0:
+                raise ArchiveError('External 7z folders are not supported')
+            outs = []
+            for _ in range(n_folders):
+                coders, n_out = _7z_folder(r)
+                folders.append(coders)
+                outs.append(n_out)
+            if r.byte() != K_CODERS_UNPACK_SIZE:
+                raise ArchiveError('Bad 7z coders info')
+            for n_out in outs:
+                unpack_sizes.append([r.number() for _ in range(n_out)][-1])
+            while True:
+                p = r.byte()
+                if p == K_END:
+                    break
+                if p == K_CRC:
+                    r.read(4 * sum(r.defined(n_folders)))
+        elif prop == K_SUBSTREAMS_INFO:
+            n_unpack_streams = [1] * len(folders)
+            p = r.byte()
+            if p == K_NUM_UNPACK_STREAM:
+                n_unpack_streams = [r.number() for _ in folders]
+                p = r.byte()
+            if p == K_SIZE:
+                for n in n_unpack_streams:
+                    for _ in range(n - 1):
+                        r.number()
+                p = r.byte()
+            while p != K_END:
+                if p == K_CRC:
+                    r.read(4 * sum(r.defined(sum(n_unpack_streams))))
+                p = r.byte()
+        else:
+            raise ArchiveError(f'Unexpected 7z property {prop:#x}')
+
+
+def _7z_files(r: _Reader) -> List[str]:
+    n_files = r.number()
+    names: List[str] = []
+    empty_stream = [False] * n_files
+    empty_file: List[bool] = []
+    while True:
+        prop = r.byte()
+        if prop == K_END:
+            break
+        data = _Reader(r.read(r.number()))
+        if prop == K_EMPTY_STREAM:
+            empty_stream = data.bits(n_files)
+        elif prop == K_EMPTY_FILE:
+            empty_file = data.bits(sum(empty_stream))
+        elif prop == K_NAME:
+            if data.byte() != 0:
+                raise ArchiveError('External 7z names are not supported')
+            names = data.data[data.pos:].decode('utf-16-le').split('\x00')[:n_files]
+    members = []
+    i_empty = 0
+    for name, empty in zip(names, empty_stream):
+        if empty:
+            # empty streams are directories, unless marked as empty files
+            is_file = i_empty < len(empty_file) and empty_file[i_empty]
+            i_empty += 1
+            if not is_file:
+                continue
+        members.append(name)
+    return members
+
+
+def _lzma_filters(coder_id: bytes, props: bytes) -> Optional[List[dict]]:
+    if coder_id == CODER_LZMA and len(props) == 5:
+        d = props[0]
+        return [{'id': lzma.FILTER_LZMA1, 'lc': d % 9, 'lp': d // 9 % 5, 'pb': d // 45,
+                 'dict_size': struct.unpack('<I', props[1:])[0]}]
+    if coder_id == CODER_LZMA2 and len(props) == 1:
+        p = props[0]
+        return [{'id': lzma.FILTER_LZMA2, 'dict_size': 0xFFFFFFFF if p >= 40 else (2 | (p & 1)) << (p // 2 + 11)}]
+    return None
+
+
+def _probe_7z(archive: str) -> ArchiveInfo:
+    with open(archive, 'rb') as f:
+        f.seek(len(SEVEN_ZIP_MAGIC) + 6)
+        offset, size, _ = SEVEN_ZIP_START_HEADER.unpack(f.read(SEVEN_ZIP_START_HEADER.size))
+        f.seek(SEVEN_ZIP_SIGNATURE_SIZE + offset)
+        r = _Reader(f.read(size))
+        if r.byte() == K_ENCODED_HEADER:
+            # the header is packed like a file, maybe encrypted
+            pack_pos, pack_sizes, folders, unpack_sizes = _7z_streams_info(r)
+            if len(folders) != 1 or len(pack_sizes) != 1:
+                raise ArchiveError('Unsupported 7z encoded header')
+            if any(coder_id == CODER_AES for coder_id, _ in folders[0]):
+                return ArchiveInfo(ARCHIVE_7Z, True, None)
+            filters = _lzma_filters(*folders[0][0]) if len(folders[0]) == 1 else None
+            if filters is None:
+                raise ArchiveError('Unsupported 7z header coders: {}'.format(
+                    ', '.join(c.hex() for c, _ in folders[0])))
+            f.seek(SEVEN_ZIP_SIGNATURE_SIZE + pack_pos)
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=filters)
+            r = _Reader(decompressor.decompress(f.read(pack_sizes[0]), unpack_sizes[0]))
+            if r.byte() != K_HEADER:
+                raise ArchiveError('Bad 7z header')
+    encrypted = False
+    members: List[str] = []
+    while True:
+        prop = r.byte()
+        if prop == K_END:
+            break
+        if prop == K_ARCHIVE_PROPERTIES:
+            while r.byte() != K_END:
+                r.read(r.number())
+        elif prop in (K_ADDITIONAL_STREAMS, K_MAIN_STREAMS):
+            _, _, folders, _ = _7z_streams_info(r)
+            encrypted |= any(coder_id == CODER_AES for folder in folders for coder_id, _ in folder)
+        elif prop == K_FILES_INFO:
+            members = _7z_files(r)
+        else:
+            raise ArchiveError(f'Unexpected 7z property {prop:#x}')
+    return ArchiveInfo(ARCHIVE_7Z, encrypted, members)
+
+
+def _probe_rar4(f) -> ArchiveInfo:
+    f.seek(len(RAR_MAGIC) + 1)
+    encrypted = False
+    members = []
+    while True:
+        raw = f.read(RAR4_BLOCK.size)
+        if len(raw) < RAR4_BLOCK.size:
+            break
+        _, block_type, flags, size = RAR4_BLOCK.unpack(raw)
+        if size < RAR4_BLOCK.size:
+            raise ArchiveError('Bad RAR block size')
+        body = f.read(size - RAR4_BLOCK.size)
+        data_size = 0
+        if block_type == RAR4_MAIN_HEAD and flags & RAR4_MAIN_PASSWORD:
+            return ArchiveInfo(ARCHIVE_RAR, True, None)
+        if block_type == RAR4_FILE_HEAD:
+            packed, _, _, _, _, _, _, name_size, _ = RAR4_FILE.unpack_from(body)
+            pos = RAR4_FILE.size
+            if flags & RAR4_LARGE_FILE:
+                packed |= struct.unpack_from('<I', body, pos)[0] << 32
+                pos += 8
+            # unicode names follow the ASCII one after a zero byte
+            name = body[pos:pos + name_size].split(b'\x00', 1)[0].decode(errors='replace').replace('\\', '/')
+            encrypted |= bool(flags & RAR4_FILE_PASSWORD)
+            if flags & RAR4_FILE_DIRECTORY != RAR4_FILE_DIRECTORY:
+                members.append(name)
+            data_size = packed
+        elif flags & RAR4_LONG_BLOCK:
+            data_size = struct.unpack_from('<I', body)[0]
+        elif block_type == RAR4_END_ARCHIVE:
+            break
+        f.seek(data_size, os.SEEK_CUR)
+    return ArchiveInfo(ARCHIVE_RAR, encrypted, members)
+
+
+def _probe_rar5(f) -> ArchiveInfo:
+    f.seek(len(RAR5_MAGIC))
+    encrypted = False
+    members = []
+    while True:
+        head = f.read(4 + 3)
+        if len(head) < 5:
+            break
+        # CRC32, then the header size as a vint of up to 3 bytes
+        r = _Reader(head[4:])
+        size = r.vint()
+        f.seek(-(len(head) - 4 - r.pos), os.SEEK_CUR)
+        r = _Reader(f.read(size))
+        header_type = r.vint()
+        flags = r.vint()
+        extra_size = r.vint() if flags & 0x1 else 0
+        data_size = r.vint() if flags & 0x2 else 0
+        if header_type == RAR5_ENCRYPTION:
+            return ArchiveInfo(ARCHIVE_RAR, True, None)
+        if header_type == RAR5_FILE:
+            file_flags = r.vint()
+            r.vint()  # unpacked size
+            r.vint()  # attributes
+            if file_flags & 0x2:
+                r.read(4)  # mtime
+            if file_flags & 0x4:
+                r.read(4)  # CRC32
+            r.vint()  # compression
+            r.vint()  # host OS
+            name = r.read(r.vint()).decode(errors='replace')
+            extra = _Reader(r.data[len(r.data) - extra_size:])
+            while extra.pos < len(extra.data):
+                record_size = extra.vint()
+                end = extra.pos + record_size
+                if extra.vint() == RAR5_EXTRA_ENCRYPTION:
+                    encrypted = True
+                extra.pos = end
+            if not file_flags & 0x1:
+                members.append(name)
+        elif header_type == RAR5_END:
+            break
+        f.seek(data_size, os.SEEK_CUR)
+    return ArchiveInfo(ARCHIVE_RAR, encrypted, members)
+
+
+def probe_archive(archive: str) -> Optional[ArchiveInfo]:
+    # Kind, encryption and members from the headers, nothing is extracted; None when archive is
+    # not a zip, 7z, RAR or tar, or when its headers can't be read here
+    with open(archive, 'rb') as f:
+        header = f.read(512)
+        try:
+            if header.startswith(ZIP_MAGIC) or zipfile.is_zipfile(archive):
+                with zipfile.ZipFile(archive) as zf:
+                    infos = zf.infolist()
+                return ArchiveInfo(ARCHIVE_ZIP, any(i.flag_bits & 0x1 for i in infos),
+                                   [i.filename for i in infos if not i.is_dir()])
+            if header.startswith(SEVEN_ZIP_MAGIC):
+                return _probe_7z(archive)
+            if header.startswith(RAR5_MAGIC):
+                return _probe_rar5(f)
+            if header.startswith(RAR_MAGIC):
+                return _probe_rar4(f)
+            if header[257:262] == b'ustar':
+                # Samsung tar.md5: the checksum line after the end of the tar is ignored
+                with tarfile.open(archive) as tf:
+                    return ArchiveInfo(ARCHIVE_TAR, False, [m.name for m in tf.getmembers() if m.isfile()])
+        except (ArchiveError, zipfile.BadZipFile, tarfile.TarError, lzma.LZMAError, struct.error, UnicodeDecodeError,
+                EOFError) as e:
+            logger.warning("Can't read the headers of {}: {}".format(archive, e))
+    return None
+
+
+def unpacked_size(archive: str, keep: Optional[Selector] = None) -> int:
+    # bytes the (selected) members take once unpacked: exact for zips, estimated for the others
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            return sum(i.file_size for i in zf.infolist() if not i.is_dir() and (not keep or keep(i.filename)))
+    return int(os.path.getsize(archive) * UNPACK_EXPANSION_FACTOR)
+
+
+def stored_member_offset(archive: str, member: str) -> Optional[int]:
+    # Offset of the data of a stored (not compressed, not encrypted) zip member, readable in place
+    if not zipfile.is_zipfile(archive):
+        return None
+    with zipfile.ZipFile(archive) as zf:
+        try:
+            info = zf.getinfo(member)
+        except KeyError:
+            return None
+    if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+        return None
+    with open(archive, 'rb') as f:
+        f.seek(info.header_offset)
+        header = f.read(ZIP_LOCAL_HEADER.size)
+    if len(header) < ZIP_LOCAL_HEADER.size or header[:4] != ZIP_LOCAL_HEADER_MAGIC:
+        return None
+    fields = ZIP_LOCAL_HEADER.unpack(header)
+    # the local header has its own name and extra field lengths
+    return info.header_offset + ZIP_LOCAL_HEADER.size + fields[-2] + fields[-1]
+
+
+def _extract_zipfile(archive: str, dst_dir: str, members: List[str]) -> bool:
+    # False, with nothing partially extracted left behind, when zipfile can't extract a member
+    with zipfile.ZipFile(archive) as zf:
+        infos = [zf.getinfo(m) for m in members]
+        unsupported = {i.compress_type for i in infos if i.compress_type not in ZIPFILE_METHODS}
+        if unsupported:
+            logger.info("{}: compression methods {} need 7za".format(archive, sorted(unsupported)))
+            return False
+        for i in infos:
+            try:
+                zf.extract(i, dst_dir)
+            except (NotImplementedError, zipfile.BadZipFile, zlib.error, EOFError) as e:
+                logger.warning("{}: zipfile can't extract {} ({}), trying 7za".format(archive, i.filename, e))
+                out = os.path.join(dst_dir, i.filename)
+                if isfile(out):
+                    os.remove(out)
+                return False
+    return True
+
+
+def _extract_7za(archive: str, dst_dir: str, selected: Optional[List[str]], password: Optional[str]) -> bool:
+    # -p with no password fails right away on an encrypted archive instead of prompting
+    cmd = ['/usr/bin/7za', 'x', archive, '-o' + dst_dir, '-aos', '-p' + (password or '')]
+    lst = None
+    if selected is not None:
+        with tempfile.NamedTemporaryFile('w', suffix='.lst', delete=False) as lst:
+            lst.write('\n'.join(selected) + '\n')
+        cmd.append('@' + lst.name)
+    try:
+        output = run_cmd(cmd, timeout=UNPACK_TIMEOUT)
+    finally:
+        if lst is not None:
+            os.remove(lst.name)
+    return output is not None and 'Everything is Ok' in output
+
+
+def _extract_unrar(archive: str, dst_dir: str, selected: Optional[List[str]], password: Optional[str]) -> bool:
+    # -p- never asks for a password
+    cmd = ['/usr/bin/unrar', 'x', '-o-', '-p' + (password or '-'), archive]
+    lst = None
+    if selected is not None:
+        with tempfile.NamedTemporaryFile('w', suffix='.lst', delete=False) as lst:
+            lst.write('\n'.join(selected) + '\n')
+        cmd.append('@' + lst.name)
+    try:
+        output = run_cmd(cmd + [os.path.join(dst_dir, '')], timeout=UNPACK_TIMEOUT)
+    finally:
+        if lst is not None:
+            os.remove(lst.name)
+    return output is not None and 'All OK' in output
+
+
+def _extract_tar(archive: str, dst_dir: str, selected: Optional[Set[str]]) -> bool:
+    with tarfile.open(archive) as tf:
+        for m in tf.getmembers():
+            if not m.isfile() or selected is not None and m.name not in selected:
+                continue
+            if os.path.isabs(m.name) or '..' in m.name.split('/'):
+                logger.warning("{}: {} is outside of the archive folder, skipped".format(archive, m.name))
+                continue
+            tf.extract(m, dst_dir, set_attrs=False)
+    return True
+
+
+def unpack(archive: str, dst_dir: str, keep: Optional[Selector] = None) -> Optional[bool]:
+    # Extracts archive (the keep selected members only) with the backend its headers call for,
+    # trying the known passwords only when it is encrypted. None when it is no archive known here.
+    assert isfile(archive)
+    assert isdir(dst_dir)
+    info = probe_archive(archive)
+    if info is None:
+        return None
+    selected = None
+    if keep and info.members is not None:
+        selected = [m for m in info.members if keep(m)]
+        logger.info("{} {}: {}/{} members selected".format(info.kind, archive, len(selected), len(info.members)))
+        if len(selected) == 0:
+            return True
+    if info.kind == ARCHIVE_ZIP and not info.encrypted \
+            and _extract_zipfile(archive, dst_dir, selected if selected is not None else info.members):
+        return True
+    if info.kind == ARCHIVE_TAR:
+        return _extract_tar(archive, dst_dir, set(selected) if selected is not None else None)
+    extract = _extract_unrar if info.kind == ARCHIVE_RAR else _extract_7za
+    if not info.encrypted:
+        return extract(archive, dst_dir, selected, None)
+    for password in PASSWORDS:
+        logger.info("{} is encrypted, trying a known password".format(archive))
+        if extract(archive, dst_dir, selected, password):
+            return True
+    logger.error("No known password for {}".format(archive))
+    return False
@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import shutil
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from os.path import basename, isdir, isfile, join
+from typing import Dict, Iterable, List, Optional
+
+from arx.androidromextractor import unpack_and_mount, RESULT_MOUNT
+from arx.cache import ExtractionCache
+from arx.commands import set_max_tools
+from arx.imagefs import ImageFileSystem
+from arx.inventory import write_inventory
+from arx.mounts import DEFAULT_MAX_MOUNTS, MountManager
+from arx.telemetry import Recorder, CATEGORY_STEP, optional_span
+
+logger = logging.getLogger('rom_analyzer')
+
+# unpacked ROMs are usually several times bigger than the archive they come in
+DEFAULT_EXPANSION_FACTOR = 6
+DEFAULT_RESERVE_BYTES = 2 * 1024 ** 3
+# in the output folder: the external tools limit is shared by the ROMs of the batch, and its reruns
+TOOL_SLOTS_DIR = '.arx-tool-slots'
+
+
+def load_batch(source: str) -> List[str]:
+    # a directory of ROMs, or a manifest with one ROM path per line
+    if isdir(source):
+        return sorted(join(source, f) for f in os.listdir(source) if isfile(join(source, f)))
+    assert isfile(source)
+    base = os.path.dirname(os.path.abspath(source))
+    roms = []
+    with open(source) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            roms.append(line if os.path.isabs(line) else join(base, line))
+    return roms
+
+
+def estimate_unpacked_size(rom: str, expansion_factor: float = DEFAULT_EXPANSION_FACTOR) -> int:
+    return int(os.path.getsize(rom) * expansion_factor)
+
+
+def free_disk_bytes(path: str) -> int:
+    return shutil.disk_usage(path).free
+
+
+def result_paths(result: Dict, mounts: MountManager) -> Dict:
+    # the unpack_and_mount result as JSON: the mounts and filesystem handles are gone once the
+    # ROM is done, their images in the work dir stay (the parts of the split images read in
+    # place). The other results (extracted YAFFS2 folders, boot images, ...) are paths already.
+    ret = {}
+    for key, value in result.items():
+        if isinstance(value, ImageFileSystem):
+            ret[key] = value.path if value.parts is None else value.parts
+        else:
+            ret[key] = mounts.image_of(value) or value
+    return ret
+
+
+def run_rom(rom: str, work_dir: str, max_workers: Optional[int] = None, cache: Optional[ExtractionCache] = None,
+            partitions: Optional[Iterable[str]] = None, report: bool = False, trace: bool = False,
+            keep_intermediates: bool = False, disk_budget: Optional[int] = None, resume: bool = False,
+            inventory: bool = False, read_only: bool = True, max_mounts: Optional[int] = DEFAULT_MAX_MOUNTS,
+            result_mode: str = RESULT_MOUNT, virtual_splits: bool = False,
+            yaffs_paths: Optional[Iterable[str]] = None) -> Dict:
+    # report/trace: write the JSON run report/Chrome trace of the ROM next to its work dir
+    # inventory: the SQLite manifest of its files (see write_inventory), next to it too
+    # result_mode, virtual_splits, yaffs_paths: see unpack_and_mount
+    # The images are unmounted before returning, the loop devices of the host are shared by all
+    # the ROMs (see MountManager). The result holds the paths of the images (see result_paths).
+    start = time.time()
+    ret = {'rom': rom, 'work_dir': work_dir}
+    recorder = Recorder() if report or trace else None
+    try:
+        with MountManager(read_only, max_mounts) as mounts:
+            result = unpack_and_mount(rom, work_dir, max_workers=max_workers, cache=cache, partitions=partitions,
+                                      result_mode=result_mode, recorder=recorder,
+                                      keep_intermediates=keep_intermediates, disk_budget=disk_budget,
+                                      virtual_splits=virtual_splits, resume=resume, mounts=mounts,
+                                      yaffs_paths=yaffs_paths)
+            ret['result'] = result_paths(result, mounts)
+            if inventory:
+                ret['inventory'] = work_dir.rstrip(os.sep) + '.inventory.sqlite'
+                with optional_span(recorder, 'inventory', CATEGORY_STEP):
+                    write_inventory(result, ret['inventory'], max_workers, rom=rom)
+        ret['status'] = 'ok'
+    except Exception as e:
+        logger.error("ROM {} failed: {}".format(rom, e))
+        ret['status'] = 'error'
+        ret['error'] = '{}: {}'.format(type(e).__name__, e)
+        ret['traceback'] = traceback.format_exc()
+    ret['elapsed'] = round(time.time() - start, 3)
+    if report:
+        ret['report'] = work_dir.rstrip(os.sep) + '.report.json'
+        recorder.write_report(ret['report'], rom=rom, status=ret['status'], elapsed=ret['elapsed'])
+    if trace:
+        ret['trace'] = work_dir.rstrip(os.sep) + '.trace.json'
+        recorder.write_chrome_trace(ret['trace'])
+    return ret
+
+
+def run_batch(roms: List[str], out_dir: str, results_file: str, parallel_roms: int = 2,
+              max_workers: Optional[int] = None, expansion_factor: float = DEFAULT_EXPANSION_FACTOR,
+              reserve_bytes: int = DEFAULT_RESERVE_BYTES, poll_seconds: float = 5,
+              cache: Optional[ExtractionCache] = None, partitions: Optional[List[str]] = None,
+              report: bool = False, trace: bool = False, keep_intermediates: bool = False,
+              disk_budget: Optional[int] = None, resume: bool = False, inventory: bool = False,
+              read_only: bool = True, max_mounts: Optional[int] = DEFAULT_MAX_MOUNTS,
+              result_mode: str = RESULT_MOUNT, virtual_splits: bool = False,
+              yaffs_paths: Optional[List[str]] = None) -> List[Dict]:
+    # ROMs are started in order as long as the free space of out_dir, minus what the running ROMs
+    # are expected to still use, can hold their estimated unpacked size. A ROM that does not fit
+    # even with nothing running is started alone. disk_budget caps the work dir of each ROM, and
+    # so their estimate. resume: the work dirs are named after the position and name of the ROMs,
+    # a rerun of the batch skips what each ROM completed there (see unpack_and_mount).
+    assert isdir(out_dir)
+    assert parallel_roms > 0
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 1) // parallel_roms)
+    # inherited by the ROM processes and their stage workers
+    set_max_tools(max_workers * parallel_roms, join(out_dir, TOOL_SLOTS_DIR))
+    pending = [(i, rom, estimate_unpacked_size(rom, expansion_factor)) for i, rom in enumerate(roms)]
+    if disk_budget is not None:
+        pending = [(i, rom, min(estimate, disk_budget)) for i, rom, estimate in pending]
+    running = {}
+    results = []
+    with ProcessPoolExecutor(max_workers=parallel_roms) as pool, open(results_file, 'a') as out:
+        while pending or running:
+            while pending and len(running) < parallel_roms:
+                i, rom, estimate = pending[0]
+                reserved = sum(e for _, e in running.values())
+                if len(running) > 0 and free_disk_bytes(out_dir) - reserved < estimate + reserve_bytes:
+                    break
+                pending.pop(0)
+                work_dir = join(out_dir, '{:05d}_{}'.format(i, basename(rom)))
+                os.makedirs(work_dir, exist_ok=True)
+                logger.info("Starting {} (estimated {} bytes) in {}".format(rom, estimate, work_dir))
+                running[pool.submit(run_rom, rom, work_dir, max_workers, cache, partitions, report, trace,
+                                    keep_intermediates, disk_budget, resume, inventory, read_only,
+                                    max_mounts, result_mode, virtual_splits, yaffs_paths)] = (rom, estimate)
+            done, _ = wait(list(running), timeout=poll_seconds, return_when=FIRST_COMPLETED)
+            for fut in done:
+                rom, _ = running.pop(fut)
+                try:
+                    ret = fut.result()
+                except Exception as e:
+                    # the worker process itself died
+                    ret = {'rom': rom, 'status': 'error', 'error': '{}: {}'.format(type(e).__name__, e)}
+                results.append(ret)
+                out.write(json.dumps(ret) + '\n')
+                out.flush()
+                logger.info("Done {}: {}".format(rom, ret['status']))
+    return results
@@ -0,0 +1,371 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os.path import basename, isfile, join
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from arx import telemetry
+from arx.androidromextractor import unpack_and_mount, RESULT_FILESYSTEM
+from arx.ext4 import Ext4FileSystem
+from arx.fixtures import FixtureError, MIB, ROM_KINDS, DEFAULT_ENTROPY, build_rom, make_ext4_image, wrap, \
+    write_payload, write_rawprogram, write_sdat, write_sign_img, write_sparse, write_sparsechunks, \
+    write_update_app, write_lz4, write_splits, write_dz, write_kdz, compress_file, holds_image, tree_digest, yaffs_tree
+from arx.formats_extraction import extract_br, extract_dz, extract_kdz, extract_lz4, extract_ota_payload_bin, \
+    extract_sign_img, extract_update_app, sparse_chunks_to_raw, sparse_single_to_raw, stream_sdat2img, unsparse_joiner
+from arx.imagefs import ImageFileSystem, open_filesystem
+from arx.sdat2img.sdat2img import sdat2img
+from arx.shell_wrapper import catfiles
+from arx.telemetry import Recorder, CATEGORY_JOB
+from arx.utility import filetype_to_files
+
+logger = logging.getLogger('rom_analyzer')
+
+# Throughput and peak memory of each extraction format at several sizes, on synthetic ROMs
+# (see arx.fixtures). Every measure runs in a fresh process, fixtures are built outside of it.
+# A case whose output is not the source image (or its files, for whole ROMs) fails.
+
+DEFAULT_SIZES = (16, 64, 256)  # MiB
+DEFAULT_TOLERANCE = 0.2
+# filetype_to_files skips smaller files, so do ROMs whose images are classified as they are shipped
+SIZE_FILTER = 10 ** 7
+CLASSIFIED_KINDS = ('ext4', 'sparse', 'sparsechunks', 'split', 'yaffs')
+
+
+class Case(NamedTuple):
+    fn: Callable[..., Any]  # module level, it runs in a worker process
+    args: Tuple
+    size: int  # bytes of filesystem image processed
+    # the output is right: fn's return value -> bool, called once it returned
+    verify: Optional[Callable[[Any], bool]] = None
+
+
+def _holds_image(output: str, image: str, value: Any) -> bool:
+    return holds_image(output, image)
+
+
+def _same_files(expected: str, value: Any) -> bool:
+    # value: the system image of extract_rom
+    fs = open_filesystem(*value)
+    if fs is None:
+        return False
+    with fs:
+        return tree_digest(fs) == expected
+
+
+def image_case(fn: Callable[..., Any], args: Tuple, image: str, output: str) -> Case:
+    # a case writing output, which must be image (see holds_image)
+    return Case(fn, args, os.path.getsize(image), partial(_holds_image, output, image))
+
+
+# (ext4 image, run folder) -> the case to time
+Preparer = Callable[[str, str], Case]
+BENCHMARKS: List[Tuple[str, Preparer]] = []
+
+
+def benchmark(name: str):
+    def register(fn: Preparer) -> Preparer:
+        BENCHMARKS.append((name, fn))
+        return fn
+    return register
+
+
+@benchmark('sdat2img')
+def _sdat2img(image: str, run_dir: str) -> Case:
+    tl, nd = write_sdat(image, run_dir, 'system')
+    output = join(run_dir, 'system.new.dat.img')
+    return image_case(sdat2img, (tl, nd, output), image, output)
+
+
+def _streamed_sdat2img(compression: str, image: str, run_dir: str) -> Case:
+    files = write_sdat(image, run_dir, 'system', compression)
+    rom = wrap(list(files), join(run_dir, 'rom.zip'))
+    for f in files:
+        os.remove(f)
+    return image_case(stream_sdat2img, (rom, basename(files[0]), basename(files[1]), run_dir), image,
+                      join(run_dir, 'system.new.dat.img'))
+
+
+benchmark('sdat2img_stream_xz')(partial(_streamed_sdat2img, 'xz'))
+benchmark('sdat2img_stream_br')(partial(_streamed_sdat2img, 'br'))
+
+
+@benchmark('br')
+def _br(image: str, run_dir: str) -> Case:
+    _, nd = write_sdat(image, run_dir, 'system', 'br')
+    return Case(extract_br, (nd,), os.path.getsize(image))
+
+
+@benchmark('sparse')
+def _sparse(image: str, run_dir: str) -> Case:
+    return image_case(sparse_single_to_raw, (write_sparse(image, join(run_dir, 'system.img')),), image,
+                      join(run_dir, 'system.img.raw'))
+
+
+@benchmark('sparsechunks')
+def _sparsechunks(image: str, run_dir: str) -> Case:
+    return image_case(sparse_chunks_to_raw, ('system', write_sparsechunks(image, run_dir, 'system')), image,
+                      join(run_dir, 'system.img.raw'))
+
+
+@benchmark('rawprogram')
+def _rawprogram(image: str, run_dir: str) -> Case:
+    rawprogram, _ = write_rawprogram(image, run_dir, 'system')
+    return image_case(unsparse_joiner, (rawprogram,), image, join(run_dir, 'system.img'))
+
+
+@benchmark('update_app')
+def _update_app(image: str, run_dir: str) -> Case:
+    return image_case(extract_update_app, (write_update_app({'SYSTEM': image}, join(run_dir, 'UPDATE.APP')),), image,
+                      join(run_dir, 'output', 'SYSTEM.img'))
+
+
+@benchmark('payload')
+def _payload(image: str, run_dir: str) -> Case:
+    output_dir = join(run_dir, 'output')
+    os.makedirs(output_dir)
+    return image_case(extract_ota_payload_bin, (write_payload({'system': image}, join(run_dir, 'payload.bin')),
+                                                output_dir), image, join(output_dir, 'system.img'))
+
+
+@benchmark('sign')
+def _sign(image: str, run_dir: str) -> Case:
+    return image_case(extract_sign_img, (write_sign_img(image, join(run_dir, 'system-sign.img')),), image,
+                      join(run_dir, 'system.img'))
+
+
+@benchmark('lz4')
+def _lz4(image: str, run_dir: str) -> Case:
+    return image_case(extract_lz4, (write_lz4(image, join(run_dir, 'system.img.lz4')),), image,
+                      join(run_dir, 'system.img'))
+
+
+@benchmark('dz')
+def _dz(image: str, run_dir: str) -> Case:
+    return image_case(extract_dz, (write_dz({'system': image}, join(run_dir, 'FIXTURE.dz')),), image,
+                      join(run_dir, 'system.img'))
+
+
+@benchmark('kdz')
+def _kdz(image: str, run_dir: str) -> Case:
+    build = join(run_dir, 'build')
+    os.makedirs(build)
+    kdz = write_kdz(write_dz({'system': image}, join(build, 'FIXTURE.dz')), join(run_dir, 'FIXTURE.kdz'))
+    shutil.rmtree(build)
+    return image_case(extract_kdz, (kdz,), image, join(run_dir, 'system.img'))
+
+
+@benchmark('catfiles')
+def _catfiles(image: str, run_dir: str) -> Case:
+    output = join(run_dir, 'system.img')
+    return image_case(catfiles, (write_splits(image, run_dir, 'system', 4), output), image, output)
+
+
+@benchmark('classify')
+def _classify(image: str, run_dir: str) -> Case:
+    # one file per format filetype_to_files tells apart
+    write_sparse(image, join(run_dir, 'system.img'))
+    write_sign_img(image, join(run_dir, 'system-sign.img'))
+    write_update_app({'SYSTEM': image}, join(run_dir, 'UPDATE.APP'))
+    shutil.copyfile(image, join(run_dir, 'vendor.img'))
+    compress_file(shutil.copyfile(image, join(run_dir, 'product.img')), 'xz')
+    size = sum(os.path.getsize(join(run_dir, f)) for f in os.listdir(run_dir))
+    return Case(filetype_to_files, (run_dir,), size)
+
+
+def extract_rom(rom: str, work_dir: str) -> Optional[Tuple[str, Optional[List[str]]]]:
+    # unpack_and_mount of a synthetic ROM, read in userspace: no privileges needed. The image and
+    # parts of its system partition, None when there is none.
+    result = unpack_and_mount(rom, work_dir, partitions=['system'], result_mode=RESULT_FILESYSTEM)
+    systems = [v for k, v in result.items() if k.lower().startswith('system') and isinstance(v, ImageFileSystem)]
+    for v in result.values():
+        if isinstance(v, ImageFileSystem):
+            v.close()
+    return (systems[0].path, systems[0].parts) if len(systems) == 1 else None
+
+
+def expected_digest(kind: str, image: str, run_dir: str) -> str:
+    # tree_digest of the system partition of a ROM build_rom made of image
+    if kind != 'yaffs':
+        with Ext4FileSystem(image) as fs:
+            return tree_digest(fs)
+    tree = yaffs_tree(image, tempfile.mkdtemp(dir=run_dir))
+    try:
+        return tree_digest(tree)
+    finally:
+        shutil.rmtree(tree, ignore_errors=True)
+
+
+def _rom(kind: str, image: str, run_dir: str) -> Case:
+    rom = build_rom(kind, run_dir, os.path.getsize(image), image=image)
+    if kind in CLASSIFIED_KINDS:
+        with zipfile.ZipFile(rom) as zf:
+            if any(i.file_size < SIZE_FILTER for i in zf.infolist()):
+                raise FixtureError(f'{kind} images of a {os.path.getsize(image) // MIB}M filesystem are too small '
+                                   f'to be picked up by filetype_to_files')
+    work_dir = join(run_dir, 'work')
+    os.makedirs(work_dir)
+    return Case(extract_rom, (rom, work_dir), os.path.getsize(image),
+                partial(_same_files, expected_digest(kind, image, run_dir)))
+
+
+for _kind in ROM_KINDS:
+    benchmark('rom_' + _kind)(partial(_rom, _kind))
+
+
+def _measure(name: str, case: Case) -> Tuple[Any, List[telemetry.Span]]:
+    # worker side: the job span covers the commands and the process pools of the case
+    recorder = Recorder()
+    telemetry.install(recorder)
+    with recorder.span(name, CATEGORY_JOB, size=case.size):
+        value = case.fn(*case.args)
+    return value, recorder.spans
+
+
+def base_image(fixtures_dir: str, size_mib: int, seed: int, entropy: float) -> str:
+    # the filesystem every case is built from, kept across runs
+    os.makedirs(fixtures_dir, exist_ok=True)
+    image = join(fixtures_dir, 'system-{}M-s{}-e{}.img'.format(size_mib, seed, entropy))
+    if not isfile(image):
+        make_ext4_image(image + '.tmp', size_mib * MIB, seed, entropy=entropy)
+        os.replace(image + '.tmp', image)
+    return image
+
+
+def run_benchmark(name: str, prepare: Preparer, image: str, run_dir: str, repeat: int = 1,
+                  keep: bool = False) -> Dict[str, Any]:
+    # best of repeat runs
+    ret = {'benchmark': name, 'size': os.path.getsize(image), 'status': 'ok'}
+    best = None
+    for _ in range(repeat):
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.makedirs(run_dir)
+        try:
+            case = prepare(image, run_dir)
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                value, spans = pool.submit(_measure, name, case).result()
+            ok = value is not None and value is not False
+            if ok and case.verify is not None and not case.verify(value):
+                ret['error'] = 'wrong output'
+                ok = False
+        except FixtureError as e:
+            ret.update(status='skipped', error=str(e))
+            break
+        except Exception as e:
+            ret.update(status='error', error='{}: {}'.format(type(e).__name__, e))
+            break
+        finally:
+            if not keep:
+                shutil.rmtree(run_dir, ignore_errors=True)
+        if not ok:
+            ret['status'] = 'failed'
+        job = [s for s in spans if s.category == CATEGORY_JOB][0]
+        if best is None or job.wall < best.wall:
+            best = job
+        # a fresh process per run, so its high-water mark is the one of the case, and of each command
+        ret['peak_rss'] = max([ret.get('peak_rss', 0), job.process_peak_rss] +
+                              [s.process_peak_rss for s in spans if s.category == telemetry.CATEGORY_CMD])
+        ret['commands'] = sorted({s.name for s in spans if s.category == telemetry.CATEGORY_CMD})
+    if best is not None:
+        ret.update(wall=round(best.wall, 4), cpu=round(best.cpu_user + best.cpu_system, 4),
+                   read_bytes=best.read_bytes, write_bytes=best.write_bytes,
+                   throughput=round(case.size / MIB / best.wall, 2) if best.wall > 0 else None)
+    return ret
+
+
+def run_benchmarks(out_dir: str, names: Optional[List[str]] = None, sizes: Tuple[int, ...] = DEFAULT_SIZES,
+                   repeat: int = 1, seed: int = 0, entropy: float = DEFAULT_ENTROPY,
+                   keep: bool = False) -> List[Dict[str, Any]]:
+    selected = [(n, p) for n, p in BENCHMARKS if names is None or n in names]
+    results = []
+    for size_mib in sizes:
+        image = base_image(join(out_dir, 'fixtures'), size_mib, seed, entropy)
+        for name, prepare in selected:
+            result = run_benchmark(name, prepare, image, join(out_dir, 'runs', f'{name}-{size_mib}M'), repeat, keep)
+            logger.warning(format_result(result))
+            results.append(result)
+    return results
+
+
+def format_result(r: Dict[str, Any]) -> str:
+    if r['status'] in ('skipped', 'error'):
+        return '{:<22} {:>6}M  {}: {}'.format(r['benchmark'], r['size'] // MIB, r['status'], r.get('error'))
+    return '{:<22} {:>6}M  {:>9.2f} MB/s  wall {:>8.3f}s  cpu {:>8.3f}s  peak rss {:>7.1f}M  {}'.format(
+        r['benchmark'], r['size'] // MIB, r['throughput'] or 0, r['wall'], r['cpu'], r['peak_rss'] / MIB, r['status'])
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float = DEFAULT_TOLERANCE
+            ) -> List[str]:
+    # regressions of results against baseline: throughput down or peak memory up by more than tolerance
+    old = {(r['benchmark'], r['size']): r for r in baseline if r.get('throughput')}
+    regressions = []
+    for r in results:
+        b = old.get((r['benchmark'], r['size']))
+        if b is None:
+            continue
+        if r['status'] != 'ok':
+            regressions.append('{} {}M: {}'.format(r['benchmark'], r['size'] // MIB, r['status']))
+            continue
+        if r['throughput'] < b['throughput'] * (1 - tolerance):
+            regressions.append('{} {}M: {:.2f} MB/s, was {:.2f} MB/s'.format(
+                r['benchmark'], r['size'] // MIB, r['throughput'], b['throughput']))
+        if r['peak_rss'] > b['peak_rss'] * (1 + tolerance):
+            regressions.append('{} {}M: peak rss {:.1f}M, was {:.1f}M'.format(
+                r['benchmark'], r['size'] // MIB, r['peak_rss'] / MIB, b['peak_rss'] / MIB))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="AndroidROMeXtractor benchmarks on synthetic ROMs")
+    parser.add_argument('-o', '--output', dest='out_dir', required=True,
+                        help='Work folder: fixtures are kept in it, cases run in it')
+    parser.add_argument('-b', '--benchmarks', dest='benchmarks',
+                        help='Comma separated benchmarks (default: all, see --list)')
+    parser.add_argument('-s', '--sizes', dest='sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='Comma separated filesystem sizes in MiB (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=1, help='Runs per case, the best counts')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Seed of the fixture contents')
+    parser.add_argument('--entropy', dest='entropy', type=float, default=DEFAULT_ENTROPY,
+                        help='Share of incompressible bytes in the fixture files (default: %(default)s)')
+    parser.add_argument('--save', dest='save', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', dest='baseline', help='Results JSON file to compare against, exit 1 on regression')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed throughput loss / peak memory growth against the baseline (default: %(default)s)')
+    parser.add_argument('--keep', dest='keep', action='store_true', help='Keep the run folders')
+    parser.add_argument('--list', dest='list', action='store_true', help='List the benchmarks and exit')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Log the extraction steps')
+    args = parser.parse_args()
+
+    if args.list:
+        print('\n'.join(n for n, _ in BENCHMARKS))
+        sys.exit()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+    logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    names = None
+    if args.benchmarks is not None:
+        names = [n for n in args.benchmarks.split(',') if n.strip() != '']
+        unknown = set(names) - {n for n, _ in BENCHMARKS}
+        if unknown:
+            sys.exit('Unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+    sizes = tuple(int(s) for s in args.sizes.split(','))
+
+    results = run_benchmarks(args.out_dir, names, sizes, args.repeat, args.seed, args.entropy, args.keep)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            logger.error('REGRESSION {}'.format(r))
+        if regressions:
+            sys.exit(1)
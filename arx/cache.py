@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from os.path import basename, isdir, isfile, join
+from typing import Callable, Dict, List, Optional, Tuple
+
+from arx.fileio import copy_file
+
+logger = logging.getLogger('rom_analyzer')
+
+# bump when a change in the extraction stages makes the cached artifacts stale
+CACHE_VERSION = 1
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+MANIFEST = 'manifest.json'
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class ExtractionCache:
+    # Content addressed store: an entry is a folder named after its key, holding a manifest and
+    # copies of the cached files. Entries are written in a temporary folder and renamed in place,
+    # so concurrent extractions never see half written entries. The least recently used entries
+    # are evicted once the cache is over max_bytes.
+
+    def __init__(self, cache_dir: str, max_bytes: int, intermediates: bool = False):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.intermediates = intermediates
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        return hashlib.sha256('\n'.join((str(CACHE_VERSION),) + parts).encode()).hexdigest()
+
+    def rom_key(self, rom: str, *variant: str) -> str:
+        return self.key('rom', file_sha256(rom), *variant)
+
+    def artifact_key(self, kind: str, inputs: List[str]) -> str:
+        return self.key(kind, *(file_sha256(i) for i in inputs))
+
+    def _entry_dir(self, key: str) -> str:
+        return join(self.cache_dir, key[:2], key)
+
+    def get(self, key: str, dst_dir: str) -> Optional[Tuple[List[str], Dict]]:
+        # Copies (reflinks when the filesystem can) the cached files in dst_dir: callers are free
+        # to modify them, e.g. by mounting them read-write.
+        entry = self._entry_dir(key)
+        try:
+            with open(join(entry, MANIFEST)) as f:
+                manifest = json.load(f)
+            files = []
+            for i, name in enumerate(manifest['files']):
+                dst = join(dst_dir, 'cached_{}'.format(i), name) if len(manifest['files']) > 1 else join(dst_dir, name)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                copy_file(join(entry, str(i)), dst)
+                files.append(dst)
+            os.utime(join(entry, MANIFEST))
+        except (OSError, ValueError, KeyError):
+            return None
+        logger.info("cache hit {}".format(key))
+        return files, manifest['meta']
+
+    def put(self, key: str, files: List[str], meta: Dict):
+        entry = self._entry_dir(key)
+        if isdir(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        try:
+            size = 0
+            for i, f in enumerate(files):
+                size += copy_file(f, join(tmp, str(i)))
+            with open(join(tmp, MANIFEST), 'w') as out:
+                json.dump({'files': [basename(f) for f in files], 'meta': meta, 'size': size}, out)
+            os.rename(tmp, entry)
+        except OSError as e:
+            # e.g. a concurrent extraction stored the same entry first
+            logger.warning("cache store of {} failed: {}".format(key, e))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        logger.info("cache store {} ({} bytes)".format(key, size))
+        self.evict()
+
+    def cached_artifact(self, kind: str, inputs: List[str], output: str, producer: Callable[[], bool]) -> bool:
+        # Produces output from inputs, or takes it from the cache when the inputs were seen before
+        if not self.intermediates:
+            return producer()
+        key = self.artifact_key(kind, inputs)
+        hit = self.get(key, os.path.dirname(output))
+        if hit is not None and hit[0][0] == output:
+            return True
+        ret = producer()
+        if ret and isfile(output):
+            self.put(key, [output], {'kind': kind})
+        return ret
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        ret = []
+        for prefix in os.listdir(self.cache_dir):
+            if prefix.startswith('.tmp_') or not isdir(join(self.cache_dir, prefix)):
+                continue
+            for key in os.listdir(join(self.cache_dir, prefix)):
+                manifest = join(self.cache_dir, prefix, key, MANIFEST)
+                try:
+                    with open(manifest) as f:
+                        size = json.load(f)['size']
+                    ret.append((os.path.getmtime(manifest), size, join(self.cache_dir, prefix, key)))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return ret
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for last_used, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            logger.info("cache evict {} (last used {})".format(basename(entry), time.ctime(last_used)))
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
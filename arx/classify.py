@@ -0,0 +1,197 @@
+import os
+import struct
+import threading
+
+from os.path import basename
+from typing import Callable, Dict, List, Optional, Tuple
+
+from arx.erofs import EROFS_MAGIC, EROFS_SUPERBLOCK_OFFSET
+from arx.ext4 import EXT4_SUPERBLOCK_OFFSET, EXT4_SUPERBLOCK_SIZE, is_ext4_superblock
+from arx.kdz import DZ_MAGIC, KDZ_MAGICS
+from arx.sparse_image import SPARSE_HEADER, SPARSE_HEADER_MAGIC
+from arx.update_app import UPDATE_APP_MAGIC
+
+# Enough for every signature below: the ext4/erofs superblocks end at 2048, UPDATE.APP starts at 92
+HEADER_SIZE = 4096
+
+YAFFS_HEADER = b'\x03\x00\x00\x00\x01\x00\x00\x00\xFF\xFF\x00\x00'
+UBI_MAGIC = b'UBI#'
+ZIP_MAGIC = b'PK\x03\x04'
+ZIP_JAR_EXTRA_ID = 0xCAFE
+SEVEN_ZIP_MAGIC = b'7z\xBC\xAF\x27\x1C'
+RAR_MAGIC = b'Rar!\x1A\x07'
+LZ4_FRAME_MAGIC = b'\x04\x22\x4D\x18'
+LZ4_LEGACY_MAGIC = b'\x02\x21\x4C\x18'
+PAC_MAGIC = 'BP_R'.encode('utf-16-le')  # the version string, e.g. BP_R1.0.0
+SIN_V3_MAGIC = b'\x03SIN'
+EXT_COMPAT_HAS_JOURNAL = 0x4
+EXT_INCOMPAT_RECOVER = 0x4
+# features that make libmagic call an ext filesystem ext4
+EXT4_INCOMPAT = 0x0040 | 0x0080 | 0x0200 | 0x0400 | 0x8000
+EXT4_RO_COMPAT = 0x0008 | 0x0010 | 0x0020 | 0x0040
+
+# The descriptions start like libmagic's, so callers can match either
+Classifier = Callable[[bytes, str], Optional[str]]
+CLASSIFIERS: List[Tuple[str, Classifier]] = []
+
+
+def classifier(name: str):
+    def register(fn: Classifier) -> Classifier:
+        CLASSIFIERS.append((name, fn))
+        return fn
+    return register
+
+
+@classifier('sparse')
+def _sparse(header: bytes, name: str) -> Optional[str]:
+    if len(header) >= SPARSE_HEADER.size and struct.unpack_from('<I', header)[0] == SPARSE_HEADER_MAGIC:
+        major, minor = struct.unpack_from('<HH', header, 4)
+        return 'Android sparse image, version: {}.{}'.format(major, minor)
+    return None
+
+
+@classifier('ext')
+def _ext(header: bytes, name: str) -> Optional[str]:
+    sb = header[EXT4_SUPERBLOCK_OFFSET:EXT4_SUPERBLOCK_OFFSET + EXT4_SUPERBLOCK_SIZE]
+    if not is_ext4_superblock(sb):
+        return None
+    compat, incompat, ro_compat = struct.unpack_from('<III', sb, 0x5C)
+    if incompat & EXT4_INCOMPAT or ro_compat & EXT4_RO_COMPAT:
+        kind = 'ext4'
+    elif compat & EXT_COMPAT_HAS_JOURNAL:
+        kind = 'ext3'
+    else:
+        kind = 'ext2'
+    ret = 'Linux rev 1.0 {} filesystem data'.format(kind)
+    if incompat & EXT_INCOMPAT_RECOVER:
+        ret += ' (needs journal recovery)'
+    return ret
+
+
+@classifier('erofs')
+def _erofs(header: bytes, name: str) -> Optional[str]:
+    if len(header) >= EROFS_SUPERBLOCK_OFFSET + 4 \
+            and struct.unpack_from('<I', header, EROFS_SUPERBLOCK_OFFSET)[0] == EROFS_MAGIC:
+        return 'EROFS filesystem'
+    return None
+
+
+@classifier('yaffs')
+def _yaffs(header: bytes, name: str) -> Optional[str]:
+    return 'YAFFS' if header[:len(YAFFS_HEADER)] == YAFFS_HEADER else None
+
+
+@classifier('ubi')
+def _ubi(header: bytes, name: str) -> Optional[str]:
+    return 'UBI image' if header.startswith(UBI_MAGIC) else None
+
+
+@classifier('zip')
+def _zip(header: bytes, name: str) -> Optional[str]:
+    if not header.startswith(ZIP_MAGIC) or len(header) < 30:
+        return None
+    # like libmagic: a jar starts with the META-INF/ entry, marked by the 0xCAFE extra field
+    name_length, extra_length = struct.unpack_from('<HH', header, 26)
+    first = header[30:30 + name_length]
+    extra = header[30 + name_length:30 + name_length + extra_length]
+    if first == b'META-INF/' and len(extra) >= 2 and struct.unpack_from('<H', extra)[0] == ZIP_JAR_EXTRA_ID:
+        return 'Java archive data (JAR)'
+    return 'Zip archive data'
+
+
+@classifier('7z')
+def _7z(header: bytes, name: str) -> Optional[str]:
+    return '7-zip archive data' if header.startswith(SEVEN_ZIP_MAGIC) else None
+
+
+@classifier('rar')
+def _rar(header: bytes, name: str) -> Optional[str]:
+    return 'RAR archive data' if header.startswith(RAR_MAGIC) else None
+
+
+@classifier('lz4')
+def _lz4(header: bytes, name: str) -> Optional[str]:
+    return 'LZ4 compressed data' if header.startswith((LZ4_FRAME_MAGIC, LZ4_LEGACY_MAGIC)) else None
+
+
+@classifier('kdz')
+def _kdz(header: bytes, name: str) -> Optional[str]:
+    return 'LG KDZ firmware' if header[4:8] in KDZ_MAGICS else None
+
+
+@classifier('dz')
+def _dz(header: bytes, name: str) -> Optional[str]:
+    return 'LG DZ firmware' if header.startswith(DZ_MAGIC) else None
+
+
+@classifier('pac')
+def _pac(header: bytes, name: str) -> Optional[str]:
+    return 'Spreadtrum PAC firmware' if header.startswith(PAC_MAGIC) else None
+
+
+@classifier('sin')
+def _sin(header: bytes, name: str) -> Optional[str]:
+    if header.startswith(SIN_V3_MAGIC) or (name.lower().endswith('.sin') and header[:1] in (b'\x01', b'\x02')):
+        return 'Sony SIN firmware'
+    return None
+
+
+@classifier('update_app')
+def _update_app(header: bytes, name: str) -> Optional[str]:
+    # the first entry follows 92 bytes of zeros
+    pos = header.find(UPDATE_APP_MAGIC, 0, 128)
+    return 'Huawei UPDATE.APP firmware' if pos >= 0 and header[:pos].count(0) == pos else None
+
+
+@classifier('brotli')
+def _brotli(header: bytes, name: str) -> Optional[str]:
+    # brotli streams have no signature
+    return 'Brotli compressed data' if name.endswith('.br') else None
+
+
+class FileClassifier:
+    # Tells the type of a file from its first bytes, libmagic is the fallback when no classifier
+    # matches. Results are kept until the size or the mtime of the file change.
+
+    def __init__(self, use_libmagic: bool = True):
+        self.use_libmagic = use_libmagic
+        self._cache: Dict[str, Tuple[int, int, str]] = {}
+        self._lock = threading.Lock()
+
+    def classify_header(self, header: bytes, name: str) -> Optional[str]:
+        for _, fn in CLASSIFIERS:
+            ret = fn(header, name)
+            if ret is not None:
+                return ret
+        return None
+
+    def classify(self, path: str) -> str:
+        st = os.stat(path)
+        with self._lock:
+            hit = self._cache.get(path)
+        if hit is not None and hit[0] == st.st_size and hit[1] == st.st_mtime_ns:
+            return hit[2]
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        ret = self.classify_header(header, basename(path))
+        if ret is None:
+            ret = self._libmagic(path) if self.use_libmagic else 'data'
+        with self._lock:
+            self._cache[path] = (st.st_size, st.st_mtime_ns, ret)
+        return ret
+
+    @staticmethod
+    def _libmagic(path: str) -> str:
+        try:
+            import magic  # only needed for the formats the classifiers don't know
+        except ImportError:
+            # what file says of unknown blobs
+            return 'data'
+        return magic.from_file(path)
+
+
+_default = FileClassifier()
+
+
+def classify(path: str) -> str:
+    return _default.classify(path)
@@ -0,0 +1,200 @@
+import asyncio
+import atexit
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+
+from collections import deque
+from typing import Callable, List, NamedTuple, Optional
+
+from arx import telemetry
+from arx.slots import Slots
+
+logger = logging.getLogger('rom_analyzer')
+
+# External tools (7za, unrar, FlashToolConsole, ...) print a line per member: only the first and
+# last lines are kept, enough for the success messages and the headers callers parse
+READ_SIZE = 64 * 1024
+HEAD_LINES = 50
+TAIL_LINES = 200
+MAX_LINE_LENGTH = 4096  # progress bars redrawn with \r make endless lines
+TOOLS_POLL_SECONDS = 0.05
+
+
+class CommandResult(NamedTuple):
+    returncode: int  # negative: killed by that signal
+    output: str  # stdout and stderr, first HEAD_LINES and last TAIL_LINES lines
+    lines: int
+    timed_out: bool
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+
+class _Retained:
+
+    def __init__(self, on_line: Optional[Callable[[str], None]] = None):
+        self.on_line = on_line
+        self.head: List[str] = []
+        self.tail = deque(maxlen=TAIL_LINES)
+        self.lines = 0
+        self._partial = b''
+
+    def feed(self, data: bytes):
+        data = self._partial + data
+        *lines, self._partial = data.split(b'\n')
+        self._partial = self._partial[-MAX_LINE_LENGTH:]
+        for raw in lines:
+            self._line(raw[-MAX_LINE_LENGTH:])
+
+    def close(self):
+        if self._partial:
+            self._line(self._partial)
+            self._partial = b''
+
+    def _line(self, raw: bytes):
+        line = raw.decode(errors='ignore').rstrip('\r')
+        self.lines += 1
+        if len(self.head) < HEAD_LINES:
+            self.head.append(line)
+        else:
+            self.tail.append(line)
+        if self.on_line is not None:
+            self.on_line(line)
+
+    def text(self) -> str:
+        skipped = self.lines - len(self.head) - len(self.tail)
+        middle = ['[... {} lines ...]'.format(skipped)] if skipped > 0 else []
+        return '\n'.join(self.head + middle + list(self.tail))
+
+
+# external tools running at once among all the processes using the same slots folder: the stage
+# workers and ROMs of a batch, which inherit the limit of the process they were forked from. See
+# set_max_tools.
+_tools: Optional[Slots] = None
+
+
+def set_max_tools(n: Optional[int], slots_dir: Optional[str] = None):
+    # n: None for no limit. slots_dir: shared with the other invocations using it (a batch and its
+    # reruns, ...), by default a temporary folder of this invocation, removed when it exits.
+    global _tools
+    if n is None:
+        _tools = None
+        return
+    if slots_dir is None:
+        slots_dir = tempfile.mkdtemp(prefix='arx-tool-slots-')
+        # the pool workers leave with os._exit, only this process removes it
+        atexit.register(shutil.rmtree, slots_dir, True)
+    _tools = Slots(max(1, n), slots_dir)
+
+
+def command_name(cmd: List[str]) -> str:
+    # the program doing the work: "timeout -s SIGKILL -k 0 5m aunpack ..." -> aunpack
+    i = 0
+    if os.path.basename(cmd[0]) == 'timeout':
+        i = 1
+        while i < len(cmd) and cmd[i].startswith('-'):
+            i += 2 if cmd[i] in ('-s', '-k') else 1
+        i += 1
+    if i + 1 < len(cmd) and os.path.basename(cmd[i]).startswith('python'):
+        i += 1
+    return os.path.basename(cmd[min(i, len(cmd) - 1)])
+
+
+def _kill_group(pid: int):
+    # the command and everything it started (a new session each, see _run)
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def run_async(cmd: List[str], env: Optional[dict] = None, timeout: Optional[float] = None,
+                    on_line: Optional[Callable[[str], None]] = None) -> CommandResult:
+    # timeout: seconds, then the whole process group is killed. on_line sees every output line.
+    # Waits for a slot when set_max_tools limits the tools running at once.
+    tools = _tools
+    slot = None
+    if tools is not None:
+        slot = tools.try_acquire()
+        if slot is None:
+            logger.info("commands: {} waits for one of {} tool slots".format(command_name(cmd), len(tools.slots)))
+        while slot is None:
+            await asyncio.sleep(TOOLS_POLL_SECONDS)
+            slot = tools.try_acquire()
+    try:
+        return await _run(cmd, env, timeout, on_line)
+    finally:
+        if slot is not None:
+            tools.release(slot)
+
+
+async def _run(cmd: List[str], env: Optional[dict], timeout: Optional[float],
+               on_line: Optional[Callable[[str], None]]) -> CommandResult:
+    loop = asyncio.get_event_loop()
+    start = time.time()
+    # spawned and reaped here rather than by asyncio: no child watcher needed in worker threads,
+    # and wait4 gives the resource usage of the command. No stdin: prompts fail instead of hanging.
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+                            start_new_session=True)
+    retained = _Retained(on_line)
+    waiter = None
+    timed_out = False
+
+    async def communicate():
+        nonlocal waiter
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), proc.stdout)
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                retained.feed(data)
+        finally:
+            transport.close()
+        waiter = loop.run_in_executor(None, os.wait4, proc.pid, 0)
+        return await asyncio.shield(waiter)
+
+    try:
+        try:
+            _, status, rusage = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            _kill_group(proc.pid)
+            if waiter is None:
+                waiter = loop.run_in_executor(None, os.wait4, proc.pid, 0)
+            _, status, rusage = await waiter
+    except BaseException:
+        # cancelled, interrupted: no orphan left behind
+        _kill_group(proc.pid)
+        if waiter is None:
+            os.waitpid(proc.pid, 0)
+        raise
+    finally:
+        proc.stdout.close()
+    retained.close()
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    # in the thread of the event loop, the one that ran the command
+    telemetry.add_child_usage(rusage)
+    recorder = telemetry.current()
+    if recorder is not None:
+        recorder.add(telemetry.rusage_span(command_name(cmd), telemetry.CATEGORY_CMD, start, rusage,
+                                           {'cmd': cmd, 'returncode': proc.returncode, 'lines': retained.lines,
+                                            'timed_out': timed_out}))
+    return CommandResult(proc.returncode, retained.text(), retained.lines, timed_out)
+
+
+def run(cmd: List[str], env: Optional[dict] = None, timeout: Optional[float] = None,
+        on_line: Optional[Callable[[str], None]] = None) -> CommandResult:
+    # run_async in an event loop of its own, the caller may be in any thread
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run_async(cmd, env, timeout, on_line))
+    finally:
+        loop.close()
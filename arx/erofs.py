@@ -0,0 +1,123 @@
+import struct
+
+from typing import Iterator, List, Optional, Tuple
+
+from arx.imagefs import ImageFileSystem, ImageFsError, DataRun, DirEntry, Stat
+
+# See linux/fs/erofs/erofs_fs.h
+EROFS_SUPERBLOCK_OFFSET = 1024
+EROFS_MAGIC = 0xE0F5E1E2
+EROFS_SUPERBLOCK = struct.Struct('<IIIBBHQQIIII16s16sI')
+EROFS_SLOT_SIZE = 32  # nids count 32 bytes slots from the metadata area
+EROFS_NULL_ADDR = 0xFFFFFFFF
+INODE_COMPACT = struct.Struct('<HHHHIIIIHHI')
+INODE_EXTENDED = struct.Struct('<HHHHQIIIIQII16x')
+XATTR_IBODY_HEADER_SIZE = 12
+XATTR_ENTRY_SIZE = 4
+DIRENT = struct.Struct('<QHBx')
+CHUNK_FORMAT_BLKBITS_MASK = 0x1F
+CHUNK_FORMAT_INDEXES = 0x20
+CHUNK_INDEX = struct.Struct('<HHI')
+
+LAYOUT_FLAT_PLAIN = 0
+LAYOUT_COMPRESSED_FULL = 1
+LAYOUT_FLAT_INLINE = 2
+LAYOUT_COMPRESSED_COMPACT = 3
+LAYOUT_CHUNK_BASED = 4
+
+
+def is_erofs_image(image: str) -> bool:
+    with open(image, 'rb') as f:
+        f.seek(EROFS_SUPERBLOCK_OFFSET)
+        sb = f.read(EROFS_SUPERBLOCK.size)
+    if len(sb) < EROFS_SUPERBLOCK.size:
+        return False
+    magic, _, _, blkszbits = EROFS_SUPERBLOCK.unpack(sb)[:4]
+    return magic == EROFS_MAGIC and 9 <= blkszbits <= 16
+
+
+class ErofsFileSystem(ImageFileSystem):
+    # Uncompressed erofs: flat, tail packed and chunk based files. Compressed files (lz4/lzma
+    # clusters) can be listed but not read.
+
+    def __init__(self, image: str, parts: Optional[List[str]] = None):
+        super().__init__(image, parts)
+        if not is_erofs_image(parts[0] if parts else image):
+            self.close()
+            raise ImageFsError(f'{image} is not an erofs image')
+        _, _, _, blkszbits, _, root_nid, _, build_time, _, _, meta_blkaddr, _, _, _, _ = \
+            self._unpack(EROFS_SUPERBLOCK, EROFS_SUPERBLOCK_OFFSET)
+        self.block_size = 1 << blkszbits
+        self.root_inode = root_nid
+        self.build_time = build_time
+        self._meta_offset = meta_blkaddr * self.block_size
+
+    def _inode(self, nid: int) -> Tuple[int, int, int, int, int, int, int, int, int]:
+        # (layout, mode, size, i_u, uid, gid, mtime, nlink, offset of the data after the inode)
+        off = self._meta_offset + nid * EROFS_SLOT_SIZE
+        i_format, xattr_icount, mode = self._unpack('<HHH', off)
+        if i_format & 1:
+            _, _, _, _, size, i_u, _, uid, gid, mtime, _, nlink = self._unpack(INODE_EXTENDED, off)
+            inode_size = INODE_EXTENDED.size
+        else:
+            _, _, _, nlink, size, _, i_u, _, uid, gid, _ = self._unpack(INODE_COMPACT, off)
+            inode_size = INODE_COMPACT.size
+            mtime = self.build_time
+        xattr_size = 0
+        if xattr_icount > 0:
+            xattr_size = XATTR_IBODY_HEADER_SIZE + (xattr_icount - 1) * XATTR_ENTRY_SIZE
+        return i_format >> 1 & 0x7, mode, size, i_u, uid, gid, mtime, nlink, off + inode_size + xattr_size
+
+    def _stat(self, inode: int) -> Stat:
+        _, mode, size, _, uid, gid, mtime, nlink, _ = self._inode(inode)
+        return Stat(inode, mode, size, uid, gid, mtime, nlink)
+
+    def _data_runs(self, inode: int) -> List[DataRun]:
+        layout, _, size, i_u, _, _, _, _, inline = self._inode(inode)
+        bs = self.block_size
+        if layout == LAYOUT_FLAT_PLAIN:
+            return [(0, i_u * bs, size)] if size > 0 else []
+        if layout == LAYOUT_FLAT_INLINE:
+            # every block but the last one from i_u on, the tail right after the inode
+            full_blocks = max(0, -(-size // bs) - 1)
+            runs = [(0, i_u * bs, full_blocks * bs)] if full_blocks > 0 else []
+            if size > full_blocks * bs:
+                runs.append((full_blocks * bs, inline, size - full_blocks * bs))
+            return runs
+        if layout == LAYOUT_CHUNK_BASED:
+            return self._chunk_runs(i_u, size, inline)
+        raise ImageFsError(f'Compressed erofs inode {inode} in {self.path} is not supported')
+
+    def _chunk_runs(self, chunk_format: int, size: int, indexes: int) -> List[DataRun]:
+        chunk_size = self.block_size << (chunk_format & CHUNK_FORMAT_BLKBITS_MASK)
+        n_chunks = -(-size // chunk_size)
+        runs = []
+        if chunk_format & CHUNK_FORMAT_INDEXES:
+            indexes = (indexes + 7) & ~7
+        for i in range(n_chunks):
+            if chunk_format & CHUNK_FORMAT_INDEXES:
+                _, _, blkaddr = self._unpack(CHUNK_INDEX, indexes + i * CHUNK_INDEX.size)
+            else:
+                blkaddr, = self._unpack('<I', indexes + i * 4)
+            if blkaddr != EROFS_NULL_ADDR:
+                runs.append((i * chunk_size, blkaddr * self.block_size, min(chunk_size, size - i * chunk_size)))
+        return runs
+
+    def _dir_entries(self, inode: int) -> Iterator[DirEntry]:
+        data = self._read_inode(inode)
+        for block in range(0, len(data), self.block_size):
+            end = min(block + self.block_size, len(data))
+            first_nameoff = struct.unpack_from('<H', data, block + 8)[0]
+            n = first_nameoff // DIRENT.size
+            for i in range(n):
+                nid, nameoff, _ = DIRENT.unpack_from(data, block + i * DIRENT.size)
+                if i + 1 < n:
+                    name_end = block + DIRENT.unpack_from(data, block + (i + 1) * DIRENT.size)[1]
+                else:
+                    # the last name of a block is padded with NULs
+                    name_end = end
+                    while name_end > block + nameoff and data[name_end - 1] == 0:
+                        name_end -= 1
+                name = data[block + nameoff:name_end].decode(errors='surrogateescape')
+                if name not in ('.', '..'):
+                    yield DirEntry(name, nid)
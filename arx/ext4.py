@@ -0,0 +1,230 @@
+import stat
+import struct
+
+from typing import Iterator, List, Optional, Tuple
+
+from arx.imagefs import ImageFileSystem, ImageFsError, DataRun, DirEntry, Stat
+
+EXT4_SUPERBLOCK_OFFSET = 1024
+EXT4_SUPERBLOCK_SIZE = 1024
+EXT4_MAGIC = b'\x53\xEF'
+EXT4_MAGIC_OFFSET = 0x38
+EXT4_ROOT_INODE = 2
+EXT4_GOOD_OLD_INODE_SIZE = 128
+EXT4_MAX_EXTENT_DEPTH = 5
+COMPAT_HAS_JOURNAL = 0x4
+INCOMPAT_FILETYPE = 0x2
+INCOMPAT_64BIT = 0x80
+EXTENTS_FL = 0x80000
+INLINE_DATA_FL = 0x10000000
+I_BLOCK_OFFSET = 0x28
+I_BLOCK_SIZE = 60
+EXTENT_MAGIC = 0xF30A
+EXTENT_HEADER_SIZE = 12
+EXTENT_ENTRY_SIZE = 12
+EXTENT_INIT_MAX_LEN = 32768
+XATTR_MAGIC = 0xEA020000
+XATTR_ENTRY_SIZE = 16
+XATTR_INDEX_SYSTEM = 7
+DIRENT_HEADER_SIZE = 8
+
+
+def is_ext4_superblock(sb: bytes) -> bool:
+    # Sanity checks on the primary superblock, so that a stray 0xEF53 in file data is not taken
+    # for the beginning of a filesystem
+    if len(sb) < 0x5C or sb[EXT4_MAGIC_OFFSET:EXT4_MAGIC_OFFSET + 2] != EXT4_MAGIC:
+        return False
+    inodes_count, blocks_count = struct.unpack_from('<II', sb, 0x0)
+    first_data_block, log_block_size = struct.unpack_from('<II', sb, 0x14)
+    blocks_per_group, = struct.unpack_from('<I', sb, 0x20)
+    inodes_per_group, = struct.unpack_from('<I', sb, 0x28)
+    rev_level, = struct.unpack_from('<I', sb, 0x4C)
+    block_group_nr, = struct.unpack_from('<H', sb, 0x5A)
+    if log_block_size > 6:
+        return False
+    block_size = 1024 << log_block_size
+    return inodes_count > 0 and blocks_count > 0 \
+        and first_data_block == (1 if block_size == 1024 else 0) \
+        and 0 < blocks_per_group <= 8 * block_size \
+        and 0 < inodes_per_group <= 8 * block_size \
+        and rev_level <= 1 \
+        and block_group_nr == 0
+
+
+def is_ext4_image(image: str) -> bool:
+    with open(image, 'rb') as f:
+        f.seek(EXT4_SUPERBLOCK_OFFSET)
+        return is_ext4_superblock(f.read(EXT4_SUPERBLOCK_SIZE))
+
+
+def has_journal(image: str) -> bool:
+    # ext3/4: mounted read-only with noload, a journal to replay would need write access
+    with open(image, 'rb') as f:
+        f.seek(EXT4_SUPERBLOCK_OFFSET)
+        sb = f.read(EXT4_SUPERBLOCK_SIZE)
+    if not is_ext4_superblock(sb):
+        return False
+    feature_compat, = struct.unpack_from('<I', sb, 0x5C)
+    return feature_compat & COMPAT_HAS_JOURNAL != 0
+
+
+class Ext4FileSystem(ImageFileSystem):
+    # ext2/3/4 images, journal ignored: block maps, extent trees, linear and hashed directories,
+    # inline data
+
+    root_inode = EXT4_ROOT_INODE
+
+    def __init__(self, image: str, parts: Optional[List[str]] = None):
+        super().__init__(image, parts)
+        sb = self._mm[EXT4_SUPERBLOCK_OFFSET:EXT4_SUPERBLOCK_OFFSET + EXT4_SUPERBLOCK_SIZE]
+        if not is_ext4_superblock(sb):
+            self.close()
+            raise ImageFsError(f'{image} is not an ext4 image')
+        first_data_block, log_block_size = struct.unpack_from('<II', sb, 0x14)
+        self.block_size = 1024 << log_block_size
+        self.inodes_per_group, = struct.unpack_from('<I', sb, 0x28)
+        rev_level, = struct.unpack_from('<I', sb, 0x4C)
+        self.inode_size = struct.unpack_from('<H', sb, 0x58)[0] if rev_level >= 1 else 128
+        self.feature_incompat, = struct.unpack_from('<I', sb, 0x60)
+        desc_size = 32
+        if self.feature_incompat & INCOMPAT_64BIT:
+            desc_size = struct.unpack_from('<H', sb, 0xFE)[0] or 32
+        self._desc_size = desc_size
+        self._gdt_offset = (first_data_block + 1) * self.block_size
+
+    def _inode_offset(self, inode: int) -> int:
+        group, i = divmod(inode - 1, self.inodes_per_group)
+        desc = self._gdt_offset + group * self._desc_size
+        table, = self._unpack('<I', desc + 0x8)
+        if self._desc_size >= 64:
+            table |= self._unpack('<I', desc + 0x28)[0] << 32
+        return table * self.block_size + i * self.inode_size
+
+    def _stat(self, inode: int) -> Stat:
+        off = self._inode_offset(inode)
+        mode, uid, size_lo, _atime, _ctime, mtime, _dtime, gid, nlink = self._unpack('<HHIIIIIHH', off)
+        size_hi, = self._unpack('<I', off + 0x6C)
+        uid_hi, gid_hi = self._unpack('<HH', off + 0x78)
+        return Stat(inode, mode, size_hi << 32 | size_lo, uid_hi << 16 | uid, gid_hi << 16 | gid, mtime, nlink)
+
+    def _flags(self, inode: int) -> int:
+        return self._unpack('<I', self._inode_offset(inode) + 0x20)[0]
+
+    def _data_runs(self, inode: int) -> List[DataRun]:
+        off = self._inode_offset(inode)
+        flags = self._flags(inode)
+        st = self._stat(inode)
+        i_block = off + I_BLOCK_OFFSET
+        if flags & INLINE_DATA_FL:
+            return self._inline_runs(off, st.st_size)
+        if stat.S_ISLNK(st.st_mode) and st.st_size < I_BLOCK_SIZE and not flags & EXTENTS_FL:
+            # fast symlink, the target is in i_block
+            return [(0, i_block, st.st_size)]
+        if flags & EXTENTS_FL:
+            extents = sorted(self._extents(i_block, EXT4_MAX_EXTENT_DEPTH))
+        else:
+            n_blocks = -(-st.st_size // self.block_size)
+            extents = self._block_map(self._unpack('<15I', i_block), n_blocks)
+        runs = []
+        for logical, physical, length in extents:
+            if runs and runs[-1][0] + runs[-1][2] == logical * self.block_size \
+                    and runs[-1][1] + runs[-1][2] == physical * self.block_size:
+                runs[-1] = (runs[-1][0], runs[-1][1], runs[-1][2] + length * self.block_size)
+            else:
+                runs.append((logical * self.block_size, physical * self.block_size, length * self.block_size))
+        return runs
+
+    def _extents(self, node: int, depth_left: int) -> Iterator[Tuple[int, int, int]]:
+        # (logical block, physical block, number of blocks) of the extent tree rooted at node
+        magic, entries, _, depth = self._unpack('<HHHH', node)
+        if magic != EXTENT_MAGIC or depth_left < 0:
+            raise ImageFsError(f'Bad extent tree node at {node:#x} in {self.path}')
+        for i in range(entries):
+            entry = node + EXTENT_HEADER_SIZE + i * EXTENT_ENTRY_SIZE
+            if depth == 0:
+                logical, length, start_hi, start_lo = self._unpack('<IHHI', entry)
+                if length > EXTENT_INIT_MAX_LEN:
+                    # uninitialized extent: allocated but reads as zeros
+                    continue
+                yield logical, start_hi << 32 | start_lo, length
+            else:
+                _, leaf_lo, leaf_hi = self._unpack('<IIH', entry)
+                yield from self._extents((leaf_hi << 32 | leaf_lo) * self.block_size, depth_left - 1)
+
+    def _block_map(self, i_block: Tuple[int, ...], n_blocks: int) -> List[Tuple[int, int, int]]:
+        # ext2/3 direct and (double, triple) indirect blocks, as (logical, physical, 1) merged later
+        per_block = self.block_size // 4
+        ret = []
+
+        def walk(block: int, level: int, logical: int):
+            if logical >= n_blocks:
+                return
+            if level == 0:
+                if block != 0:
+                    ret.append((logical, block, 1))
+                return
+            if block == 0:
+                return
+            span = per_block ** (level - 1)
+            pointers = self._unpack('<{}I'.format(per_block), block * self.block_size)
+            for i, p in enumerate(pointers):
+                walk(p, level - 1, logical + i * span)
+
+        for i in range(12):
+            walk(i_block[i], 0, i)
+        logical = 12
+        for level in (1, 2, 3):
+            walk(i_block[11 + level], level, logical)
+            logical += per_block ** level
+        return ret
+
+    def _inline_runs(self, off: int, size: int) -> List[DataRun]:
+        # the first bytes are in i_block, the rest in the system.data extended attribute
+        runs = [(0, off + I_BLOCK_OFFSET, min(size, I_BLOCK_SIZE))]
+        if size > I_BLOCK_SIZE:
+            value = self._inline_xattr(off)
+            if value is None:
+                raise ImageFsError(f'Missing inline data attribute at {off:#x} in {self.path}')
+            runs.append((I_BLOCK_SIZE, value[0], min(value[1], size - I_BLOCK_SIZE)))
+        return runs
+
+    def _inline_xattr(self, off: int) -> Optional[Tuple[int, int]]:
+        # (offset, size) of the value of system.data among the in-inode extended attributes
+        if self.inode_size <= EXT4_GOOD_OLD_INODE_SIZE:
+            return None
+        extra_isize, = self._unpack('<H', off + EXT4_GOOD_OLD_INODE_SIZE)
+        header = off + EXT4_GOOD_OLD_INODE_SIZE + extra_isize
+        end = off + self.inode_size
+        if self._unpack('<I', header)[0] != XATTR_MAGIC:
+            return None
+        first = entry = header + 4
+        while entry + XATTR_ENTRY_SIZE <= end and self._unpack('<I', entry)[0] != 0:
+            name_len, name_index, value_offs, _, value_size = self._unpack('<BBHII', entry)
+            name = self._mm[entry + XATTR_ENTRY_SIZE:entry + XATTR_ENTRY_SIZE + name_len]
+            if name_index == XATTR_INDEX_SYSTEM and name == b'data':
+                return first + value_offs, value_size
+            entry += (XATTR_ENTRY_SIZE + name_len + 3) & ~3
+        return None
+
+    def _dir_entries(self, inode: int) -> Iterator[DirEntry]:
+        data = self._read_inode(inode)
+        pos = 0
+        block_size = self.block_size
+        if self._flags(inode) & INLINE_DATA_FL:
+            # 4 bytes of parent inode instead of . and .., then a single "block" of entries
+            pos = 4
+            block_size = len(data)
+        has_file_type = self.feature_incompat & INCOMPAT_FILETYPE
+        while pos + DIRENT_HEADER_SIZE <= len(data):
+            child, rec_len, name_len = struct.unpack_from('<IHH', data, pos)
+            if has_file_type:
+                name_len &= 0xFF
+            if rec_len < DIRENT_HEADER_SIZE:
+                # corrupted entry, skip the rest of the block
+                pos = (pos // block_size + 1) * block_size if block_size == self.block_size else len(data)
+                continue
+            if child != 0:
+                name = data[pos + DIRENT_HEADER_SIZE:pos + DIRENT_HEADER_SIZE + name_len].decode(errors='surrogateescape')
+                if name not in ('.', '..'):
+                    yield DirEntry(name, child)
+            pos += rec_len
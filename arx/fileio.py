@@ -0,0 +1,138 @@
+import errno
+import fcntl
+import os
+import struct
+
+from typing import BinaryIO, List
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+FILL_BUFFER_SIZE = 4 * 1024 * 1024
+# linux/fs.h: _IOW(0x94, 13, struct file_clone_range {s64 src_fd; u64 src_offset, src_length, dest_offset})
+FICLONERANGE = 0x4020940D
+FILE_CLONE_RANGE = struct.Struct('=qQQQ')
+# the filesystem can't share extents at all, as opposed to a range it refuses (unaligned, ...)
+_NO_REFLINK_ERRNOS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.ENOSYS)
+
+
+def copy_range(src_fd: int, src_offset: int, dst_fd: int, dst_offset: int, length: int) -> int:
+    # copy_file_range keeps the data in the kernel (and may reflink), fall back to pread/pwrite
+    copied = 0
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    while copied < length:
+        todo = min(length - copied, COPY_CHUNK_SIZE)
+        n = 0
+        if copy_file_range is not None:
+            try:
+                n = copy_file_range(src_fd, dst_fd, todo, src_offset + copied, dst_offset + copied)
+            except OSError:
+                copy_file_range = None
+        if copy_file_range is None:
+            data = os.pread(src_fd, todo, src_offset + copied)
+            n = len(data)
+            if n > 0:
+                os.pwrite(dst_fd, data, dst_offset + copied)
+        if n <= 0:
+            raise EOFError(f'Unexpected end of input after {copied}/{length} bytes')
+        copied += n
+    return copied
+
+
+def clone_range(src_fd: int, src_offset: int, dst_fd: int, dst_offset: int, length: int) -> bool:
+    # Reflink (btrfs, XFS): dst shares the extents of src, nothing is copied. Offsets must be
+    # multiples of the block size, and length too unless the range ends src.
+    arg = FILE_CLONE_RANGE.pack(src_fd, src_offset, length, dst_offset)
+    try:
+        fcntl.ioctl(dst_fd, FICLONERANGE, arg)
+    except OSError as e:
+        if e.errno in _NO_REFLINK_ERRNOS:
+            raise
+        return False
+    return True
+
+
+def concat_files(src_files: List[str], dst_file: str) -> int:
+    # dst_file = src_files one after the other: reflinked where the filesystem allows it, else
+    # copied in the kernel, holes stay holes. Returns the size of dst_file.
+    out_fd = os.open(dst_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    reflink = True
+    offset = 0
+    try:
+        for src in src_files:
+            with open(src, 'rb') as fin:
+                in_fd = fin.fileno()
+                size = os.fstat(in_fd).st_size
+                cloned = False
+                if reflink and size > 0:
+                    try:
+                        cloned = clone_range(in_fd, 0, out_fd, offset, size)
+                    except OSError:
+                        reflink = False
+                if not cloned:
+                    for data_offset, length in data_segments(in_fd, size):
+                        copy_range(in_fd, data_offset, out_fd, offset + data_offset, length)
+            offset += size
+        os.ftruncate(out_fd, offset)
+    except BaseException:
+        os.close(out_fd)
+        os.remove(dst_file)
+        raise
+    os.close(out_fd)
+    return offset
+
+
+def copy_stream(src: BinaryIO, dst_fd: int, dst_offset: int, length: int) -> int:
+    # Sequential sources (decompressors, pipes) can't use copy_range
+    buf = bytearray(min(length, COPY_CHUNK_SIZE))
+    view = memoryview(buf)
+    copied = 0
+    while copied < length:
+        todo = min(length - copied, len(buf))
+        n = src.readinto(view[:todo])
+        if not n:
+            raise EOFError(f'Unexpected end of input after {copied}/{length} bytes')
+        os.pwrite(dst_fd, view[:n], dst_offset + copied)
+        copied += n
+    return copied
+
+
+def write_fill(dst_fd: int, dst_offset: int, length: int, pattern: bytes):
+    assert len(pattern) > 0
+    buf = pattern * max(1, FILL_BUFFER_SIZE // len(pattern))
+    written = 0
+    while written < length:
+        todo = min(length - written, len(buf))
+        os.pwrite(dst_fd, buf[:todo] if todo < len(buf) else buf, dst_offset + written)
+        written += todo
+
+
+def copy_file(src: str, dst: str) -> int:
+    # Copies only the data segments of src, holes stay holes in dst
+    size = os.path.getsize(src)
+    with open(src, 'rb') as fin:
+        in_fd = fin.fileno()
+        out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for offset, length in data_segments(in_fd, size):
+                copy_range(in_fd, offset, out_fd, offset, length)
+            os.ftruncate(out_fd, size)
+        finally:
+            os.close(out_fd)
+    return size
+
+
+def data_segments(fd: int, size: int):
+    seek_data = getattr(os, 'SEEK_DATA', None)
+    if seek_data is None:
+        if size > 0:
+            yield 0, size
+        return
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, seek_data)
+        except OSError:
+            # ENXIO: no more data after pos
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        pos = end
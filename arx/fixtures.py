@@ -0,0 +1,604 @@
+import hashlib
+import logging
+import lzma
+import os
+import random
+import shutil
+import stat
+import struct
+import subprocess
+import tempfile
+import zipfile
+import zlib
+
+from functools import partial
+from os.path import basename, isdir, isfile, join
+from typing import Dict, List, Optional, Tuple, Union
+
+from arx.fileio import copy_range
+from arx.imagefs import ImageFileSystem
+from arx.kdz import KDZ_HEADER, KDZ_MAGICS, KDZ_RECORD, DZ_CHUNK_HEADER, DZ_CHUNK_HEADER_SIZE, DZ_CHUNK_MAGIC, \
+    DZ_HEADER, DZ_HEADER_SIZE, DZ_MAGIC, SECTOR_SIZE
+from arx.payload import PAYLOAD_HEADER, PAYLOAD_MAGIC, METADATA_SIGNATURE_SIZE, OP_REPLACE, OP_REPLACE_XZ, \
+    OP_REPLACE_ZSTD, OP_ZERO, WIRE_LENGTH_DELIMITED, WIRE_VARINT
+from arx.shell_wrapper import run_cmd
+from arx.sparse_image import SPARSE_HEADER, SPARSE_HEADER_MAGIC, CHUNK_HEADER, CHUNK_TYPE_RAW, CHUNK_TYPE_FILL, \
+    CHUNK_TYPE_DONT_CARE
+from arx.update_app import ENTRY_HEADER, UPDATE_APP_MAGIC, DEFAULT_CRC_BLOCK_SIZE, crc16_x25
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger('rom_analyzer')
+
+# Synthetic ROMs for every path of unpack_and_mount, built from a real ext4 image (mke2fs -d) of
+# deterministic pseudo random files. Real ROMs are too big to share and can't be redistributed.
+
+BLOCK_SIZE = 4096
+MIB = 1024 * 1024
+# share of the filesystem taken by files, and share of their bytes that are random (the rest compresses)
+DEFAULT_FILL = 0.6
+DEFAULT_ENTROPY = 0.5
+# biggest RAW sparse chunk / payload operation / transfer list command
+SPARSE_CHUNK_BLOCKS = 4096
+PAYLOAD_OP_BLOCKS = 512
+TRANSFER_COMMAND_BLOCKS = 1024
+DZ_CHUNK_BLOCKS = 2048
+DZ_FIRST_SECTOR = 0x8000  # of the first partition on the device
+KDZ_HEADER_SIZE = 0x518
+SPARSECHUNK_SIZE = 64 * MIB  # of the image slice each sparsechunk covers
+SIGN_HEADER_SIZE = 16448  # skipped by extract_sign_img
+UPDATE_APP_PREAMBLE = 92
+YAFFS_CHUNK_SIZE = 2048
+YAFFS_SPARE_SIZE = 64
+YAFFS_OBJECT_FILE = 1
+YAFFS_OBJECT_SYMLINK = 2
+YAFFS_OBJECT_DIRECTORY = 3
+YAFFS_ROOT_ID = 1
+YAFFS_FIRST_OBJECT_ID = 257
+YAFFS_SEQUENCE_NUMBER = 0x1000
+YAFFS_TAGS = struct.Struct('<IIII')  # sequence number, object id, chunk id, bytes
+COMMANDS = {
+    '7z': ['/usr/bin/7za', 'a', '-bd', '-y'],
+    'rar': ['/usr/bin/rar', 'a', '-ep', '-idq', '-y'],
+    'br': ['/usr/bin/brotli', '--quality=1', '--force', '--output'],
+    'lz4': ['/usr/bin/lz4', '-1', '-q', '-f'],
+}
+ROM_KINDS = ('ext4', 'sdat', 'sdat_br', 'sdat_xz', 'sparse', 'sparsechunks', 'split', 'rawprogram', 'update_app', 'sign',
+             'lz4', 'kdz', 'yaffs', 'payload')
+WRAPPERS = ('zip', '7z', 'rar')
+
+
+class FixtureError(Exception):
+    pass
+
+
+def random_content(rng: random.Random, size: int, entropy: float = DEFAULT_ENTROPY) -> bytes:
+    # entropy: share of incompressible bytes, the rest is text
+    n_random = int(size * entropy)
+    text = b'ro.build.fingerprint=arx/fixture/%d:user/release-keys\n' % rng.randrange(1 << 30)
+    head = rng.getrandbits(8 * n_random).to_bytes(n_random, 'little') if n_random > 0 else b''
+    return head + (text * ((size - n_random) // len(text) + 1))[:size - n_random]
+
+
+def populate_tree(root: str, size: int, seed: int = 0, entropy: float = DEFAULT_ENTROPY) -> Dict[str, int]:
+    # A system like tree of about size bytes, returns {relative path: size}
+    rng = random.Random(seed)
+    files = {}
+    total = 0
+    i = 0
+    while total < size:
+        folder = join(('app', 'framework', 'lib', 'etc', 'bin')[i % 5], 'd{:02}'.format(i % 7))
+        os.makedirs(join(root, folder), exist_ok=True)
+        length = min(size - total, int(rng.paretovariate(1.2) * 16 * 1024))
+        path = join(folder, 'f{:05}.bin'.format(i))
+        with open(join(root, path), 'wb') as f:
+            f.write(random_content(rng, length, entropy))
+        files[path] = length
+        total += length
+        i += 1
+    with open(join(root, 'build.prop'), 'w') as f:
+        f.write('ro.build.version.release=10\nro.arx.fixture.seed={}\n'.format(seed))
+    os.symlink('build.prop', join(root, 'default.prop'))
+    return files
+
+
+def make_ext4_image(image: str, size: int, seed: int = 0, fill: float = DEFAULT_FILL,
+                    entropy: float = DEFAULT_ENTROPY) -> str:
+    # size is rounded to whole blocks
+    assert size >= MIB
+    tree = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(image)))
+    try:
+        populate_tree(tree, int(size * fill), seed, entropy)
+        blocks = size // BLOCK_SIZE
+        if run_cmd(['mke2fs', '-q', '-F', '-t', 'ext4', '-b', str(BLOCK_SIZE), '-L', 'system', '-d', tree, image,
+                    str(blocks)]) is None:
+            raise FixtureError(f'mke2fs failed on {image}')
+    finally:
+        shutil.rmtree(tree, ignore_errors=True)
+    return image
+
+
+def _block_runs(raw: str, max_blocks: int, begin: int = 0, end: Optional[int] = None):
+    # (kind, first block, number of blocks, data) runs of raw: kind is 'zero', 'fill' (uniform 4 bytes
+    # pattern, data is the pattern) or 'data'. Data runs are at most max_blocks long.
+    zero_block = bytes(BLOCK_SIZE)
+    with open(raw, 'rb') as f:
+        n_blocks = -(-os.fstat(f.fileno()).st_size // BLOCK_SIZE)
+        end = n_blocks if end is None else end
+        f.seek(begin * BLOCK_SIZE)
+        run = None
+        for block in range(begin, end):
+            data = f.read(BLOCK_SIZE).ljust(BLOCK_SIZE, b'\x00')
+            if data == zero_block:
+                kind, payload = 'zero', b''
+            elif data == data[:4] * (BLOCK_SIZE // 4):
+                kind, payload = 'fill', data[:4]
+            else:
+                kind, payload = 'data', data
+            if run is not None and run[0] == kind and (kind == 'zero' or kind == 'fill' and run[3] == payload
+                                                       or kind == 'data' and run[2] < max_blocks):
+                run[2] += 1
+                if kind == 'data':
+                    run[3].append(payload)
+                continue
+            if run is not None:
+                yield run[0], run[1], run[2], b''.join(run[3]) if run[0] == 'data' else run[3]
+            run = [kind, block, 1, [payload] if kind == 'data' else payload]
+        if run is not None:
+            yield run[0], run[1], run[2], b''.join(run[3]) if run[0] == 'data' else run[3]
+
+
+def _image_blocks(raw: str) -> int:
+    return -(-os.path.getsize(raw) // BLOCK_SIZE)
+
+
+def write_sparse(raw: str, sparse_img: str, begin: int = 0, end: Optional[int] = None) -> str:
+    # Android sparse image of raw like img2simg (zeros are DONT_CARE). With begin/end only those
+    # blocks are encoded and the rest of the image is DONT_CARE, like a sparsechunk.
+    total = _image_blocks(raw)
+    end = total if end is None else end
+    with open(sparse_img, 'wb') as out:
+        # the header is rewritten once the chunks are counted
+        out.write(bytes(SPARSE_HEADER.size))
+        n_chunks = 0
+        if begin > 0:
+            out.write(CHUNK_HEADER.pack(CHUNK_TYPE_DONT_CARE, 0, begin, CHUNK_HEADER.size))
+            n_chunks += 1
+        for kind, _, count, data in _block_runs(raw, SPARSE_CHUNK_BLOCKS, begin, end):
+            if kind == 'zero':
+                out.write(CHUNK_HEADER.pack(CHUNK_TYPE_DONT_CARE, 0, count, CHUNK_HEADER.size))
+            elif kind == 'fill':
+                out.write(CHUNK_HEADER.pack(CHUNK_TYPE_FILL, 0, count, CHUNK_HEADER.size + 4) + data)
+            else:
+                out.write(CHUNK_HEADER.pack(CHUNK_TYPE_RAW, 0, count, CHUNK_HEADER.size + len(data)) + data)
+            n_chunks += 1
+        if end < total:
+            out.write(CHUNK_HEADER.pack(CHUNK_TYPE_DONT_CARE, 0, total - end, CHUNK_HEADER.size))
+            n_chunks += 1
+        out.seek(0)
+        out.write(SPARSE_HEADER.pack(SPARSE_HEADER_MAGIC, 1, 0, SPARSE_HEADER.size, CHUNK_HEADER.size, BLOCK_SIZE,
+                                     total, n_chunks, 0))
+    return sparse_img
+
+
+def write_sparsechunks(raw: str, dst_dir: str, name: str, n_chunks: int = 4) -> List[str]:
+    # name.img_sparsechunk.0..n-1, each covering a slice of the image like the Motorola ones
+    total = _image_blocks(raw)
+    bounds = [total * i // n_chunks for i in range(n_chunks + 1)]
+    return [write_sparse(raw, join(dst_dir, f'{name}.img_sparsechunk.{i}'), bounds[i], bounds[i + 1])
+            for i in range(n_chunks)]
+
+
+def write_splits(raw: str, dst_dir: str, name: str, n_parts: int = 2) -> List[str]:
+    # name_1.img..name_n.img, the image cut in slices of whole blocks like the Lenovo/ZTE ones
+    size = os.path.getsize(raw)
+    total = _image_blocks(raw)
+    bounds = [min(size, total * i // n_parts * BLOCK_SIZE) for i in range(n_parts + 1)]
+    parts = []
+    with open(raw, 'rb') as fin:
+        for i in range(n_parts):
+            part = join(dst_dir, f'{name}_{i + 1}.img')
+            with open(part, 'wb') as out:
+                copy_range(fin.fileno(), bounds[i], out.fileno(), 0, bounds[i + 1] - bounds[i])
+            parts.append(part)
+    return parts
+
+
+def _rangeset(ranges: List[Tuple[int, int]]) -> str:
+    return ','.join(str(n) for n in [2 * len(ranges)] + [b for r in ranges for b in r])
+
+
+def write_sdat(raw: str, dst_dir: str, name: str, compression: Optional[str] = None, version: int = 4) -> Tuple[str, str]:
+    # name.transfer.list and name.new.dat[.br|.xz|.lz4] of raw, zero blocks become zero commands
+    transfer_list = join(dst_dir, f'{name}.transfer.list')
+    new_dat = join(dst_dir, f'{name}.new.dat')
+    total = _image_blocks(raw)
+    commands = []
+    new_blocks = 0
+    with open(new_dat, 'wb') as out:
+        for kind, start, count, data in _block_runs(raw, TRANSFER_COMMAND_BLOCKS):
+            if kind == 'zero':
+                commands.append('zero ' + _rangeset([(start, start + count)]))
+                continue
+            commands.append('new ' + _rangeset([(start, start + count)]))
+            out.write(data if kind == 'data' else data * (count * BLOCK_SIZE // 4))
+            new_blocks += count
+    header = [str(version), str(new_blocks)] + (['0', '0'] if version >= 2 else [])
+    with open(transfer_list, 'w') as f:
+        f.write('\n'.join(header + ['erase ' + _rangeset([(0, total)])] + commands) + '\n')
+    if compression is not None:
+        new_dat = compress_file(new_dat, compression)
+    return transfer_list, new_dat
+
+
+def compress_file(src: str, compression: str) -> str:
+    # src.<compression>, src is removed
+    dst = f'{src}.{compression}'
+    if compression == 'xz':
+        with open(src, 'rb') as fin, lzma.open(dst, 'wb', preset=1) as fout:
+            shutil.copyfileobj(fin, fout, MIB)
+    elif compression == 'br' and brotli is not None:
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            c = brotli.Compressor(quality=1)
+            for block in iter(lambda: fin.read(MIB), b''):
+                fout.write(c.process(block))
+            fout.write(c.finish())
+    elif compression == 'lz4' and lz4 is not None:
+        with open(src, 'rb') as fin, lz4.frame.open(dst, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, MIB)
+    elif compression == 'br':
+        _run(COMMANDS['br'] + [dst, src])
+    elif compression == 'lz4':
+        _run(COMMANDS['lz4'] + [src, dst])
+    else:
+        raise FixtureError(f'Unknown compression {compression}')
+    os.remove(src)
+    return dst
+
+
+def write_rawprogram(raw: str, dst_dir: str, label: str, n_pieces: int = 4, sector_size: int = 512) -> Tuple[str, List[str]]:
+    # rawprogram0.xml and label_1..n.img pieces, the trailing zeros of each piece are left out
+    total = _image_blocks(raw)
+    bounds = [total * i // n_pieces for i in range(n_pieces + 1)]
+    sectors_per_block = BLOCK_SIZE // sector_size
+    pieces = []
+    lines = ['<?xml version="1.0" ?>', '<data>']
+    with open(raw, 'rb') as f:
+        for i in range(n_pieces):
+            f.seek(bounds[i] * BLOCK_SIZE)
+            data = f.read((bounds[i + 1] - bounds[i]) * BLOCK_SIZE).rstrip(b'\x00')
+            piece = join(dst_dir, f'{label}_{i + 1}.img')
+            with open(piece, 'wb') as out:
+                out.write(data)
+            pieces.append(piece)
+            lines.append('  <program SECTOR_SIZE_IN_BYTES="{}" file_sector_offset="0" filename="{}" label="{}" '
+                         'num_partition_sectors="{}" physical_partition_number="0" start_sector="{}"/>'.format(
+                             sector_size, basename(piece), label, (bounds[i + 1] - bounds[i]) * sectors_per_block,
+                             bounds[i] * sectors_per_block))
+    lines.append('</data>')
+    rawprogram = join(dst_dir, 'rawprogram0.xml')
+    with open(rawprogram, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return rawprogram, pieces
+
+
+def write_update_app(entries: Dict[str, str], update_app: str, block_size: int = DEFAULT_CRC_BLOCK_SIZE) -> str:
+    # entries: {file type (e.g. SYSTEM): image}
+    with open(update_app, 'wb') as out:
+        out.write(bytes(UPDATE_APP_PREAMBLE))
+        for seq, (file_type, image) in enumerate(entries.items()):
+            with open(image, 'rb') as f:
+                crcs = b''.join(struct.pack('<H', crc16_x25(block))
+                                for block in iter(lambda: f.read(block_size), b''))
+                out.write(ENTRY_HEADER.pack(UPDATE_APP_MAGIC, ENTRY_HEADER.size + len(crcs), 1, b'HW7x27\xff\xff',
+                                            seq, os.fstat(f.fileno()).st_size, b'2020.01.01', b'00.00.00',
+                                            file_type.encode(), b'', 0, block_size, 0))
+                out.write(crcs)
+                f.seek(0)
+                shutil.copyfileobj(f, out, MIB)
+            # entries are 4 bytes aligned
+            out.write(bytes(-out.tell() % 4))
+    return update_app
+
+
+def write_dz(entries: Dict[str, str], dz: str, sector_size: int = SECTOR_SIZE) -> str:
+    # entries: {partition: image}, one after the other on the device. A zlib chunk per run of
+    # non zero blocks, the zero ones are wiped (trim count) rather than shipped.
+    chunks = []
+    sector = DZ_FIRST_SECTOR
+    for partition, image in entries.items():
+        runs = [(start, count) for kind, start, count, _ in _block_runs(image, DZ_CHUNK_BLOCKS) if kind != 'zero']
+        total = _image_blocks(image)
+        with open(image, 'rb') as f:
+            for i, (start, count) in enumerate(runs):
+                f.seek(start * BLOCK_SIZE)
+                data = f.read(count * BLOCK_SIZE).ljust(count * BLOCK_SIZE, b'\x00')
+                end = runs[i + 1][0] if i + 1 < len(runs) else total
+                chunk_sector = sector + start * BLOCK_SIZE // sector_size
+                chunks.append((partition, f'{partition}_{chunk_sector}.bin', zlib.compress(data, 1), len(data),
+                               chunk_sector, (end - start) * BLOCK_SIZE // sector_size))
+        sector += total * BLOCK_SIZE // sector_size
+    with open(dz, 'wb') as out:
+        out.write(DZ_HEADER.pack(DZ_MAGIC, 2, 1, 0, b'LM-FIXTURE', b'FIXTURE10a_00', len(chunks),
+                                 bytes(16)).ljust(DZ_HEADER_SIZE, b'\x00'))
+        for partition, name, data, file_size, chunk_sector, trim_count in chunks:
+            out.write(DZ_CHUNK_HEADER.pack(DZ_CHUNK_MAGIC, partition.encode(), name.encode(), len(data), file_size,
+                                           hashlib.md5(data).digest(), chunk_sector, trim_count, 0,
+                                           zlib.crc32(data)).ljust(DZ_CHUNK_HEADER_SIZE, b'\x00'))
+            out.write(data)
+    return dz
+
+
+def write_kdz(dz: str, kdz: str) -> str:
+    # the DZ and a stand-in for the flashing dll
+    dll = b'MZ' + bytes(1022)
+    with open(kdz, 'wb') as out:
+        dz_offset = KDZ_HEADER_SIZE + len(dll)
+        table = KDZ_RECORD.pack(b'LGUP_c.dll', len(dll), KDZ_HEADER_SIZE) \
+            + KDZ_RECORD.pack(basename(dz).encode(), os.path.getsize(dz), dz_offset)
+        out.write((KDZ_HEADER.pack(KDZ_HEADER_SIZE, KDZ_MAGICS[1]) + table).ljust(KDZ_HEADER_SIZE, b'\x00'))
+        out.write(dll)
+        with open(dz, 'rb') as f:
+            shutil.copyfileobj(f, out, MIB)
+    return kdz
+
+
+def write_sign_img(raw: str, sign_img: str) -> str:
+    with open(raw, 'rb') as fin, open(sign_img, 'wb') as fout:
+        fout.write(b'SIGNATURE'.ljust(SIGN_HEADER_SIZE, b'\x00'))
+        shutil.copyfileobj(fin, fout, MIB)
+    return sign_img
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint((field << 3) | wire_type)
+
+
+def _varint(value: int) -> bytes:
+    ret = bytearray()
+    while True:
+        b = value & 0x7F
+        value >>= 7
+        if value:
+            ret.append(b | 0x80)
+        else:
+            ret.append(b)
+            return bytes(ret)
+
+
+def _message(fields: List[Tuple[int, object]]) -> bytes:
+    # (field number, int or bytes) -> protobuf message
+    ret = b''
+    for field, value in fields:
+        if isinstance(value, int):
+            ret += _key(field, WIRE_VARINT) + _varint(value)
+        else:
+            ret += _key(field, WIRE_LENGTH_DELIMITED) + _varint(len(value)) + value
+    return ret
+
+
+def _zstd_compress(data: bytes) -> bytes:
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=1).compress(data)
+    if shutil.which('zstd') is None:
+        raise FixtureError('zstd is not installed')
+    return subprocess.run(['zstd', '-1', '--stdout'], input=data, stdout=subprocess.PIPE, check=True).stdout
+
+
+def write_payload(images: Dict[str, str], payload: str, compress: bool = True, zstd: bool = False) -> str:
+    # Full A/B OTA payload.bin of {partition name: image}: REPLACE(_XZ) and ZERO operations,
+    # REPLACE_ZSTD rather than REPLACE_XZ with zstd
+    blob = tempfile.TemporaryFile()
+    partitions = []
+    for name, image in images.items():
+        operations = []
+        with open(image, 'rb') as f:
+            n_blocks = _image_blocks(image)
+            for start in range(0, n_blocks, PAYLOAD_OP_BLOCKS):
+                count = min(PAYLOAD_OP_BLOCKS, n_blocks - start)
+                data = f.read(count * BLOCK_SIZE).ljust(count * BLOCK_SIZE, b'\x00')
+                extent = _message([(1, start), (2, count)])
+                if data.count(0) == len(data):
+                    operations.append(_message([(1, OP_ZERO), (6, extent)]))
+                    continue
+                op_type = OP_REPLACE
+                if compress:
+                    packed = _zstd_compress(data) if zstd else lzma.compress(data, preset=1)
+                    if len(packed) < len(data):
+                        op_type, data = OP_REPLACE_ZSTD if zstd else OP_REPLACE_XZ, packed
+                operations.append(_message([(1, op_type), (2, blob.tell()), (3, len(data)), (6, extent),
+                                            (8, hashlib.sha256(data).digest())]))
+                blob.write(data)
+        info = _message([(1, os.path.getsize(image))])
+        partitions.append(_message([(1, name.encode()), (7, info)] + [(8, op) for op in operations]))
+    manifest = _message([(3, BLOCK_SIZE), (12, 0)] + [(13, p) for p in partitions])
+    with open(payload, 'wb') as out, blob:
+        out.write(PAYLOAD_HEADER.pack(PAYLOAD_MAGIC, 2, len(manifest)))
+        out.write(METADATA_SIGNATURE_SIZE.pack(0))
+        out.write(manifest)
+        blob.seek(0)
+        shutil.copyfileobj(blob, out, MIB)
+    return payload
+
+
+def _yaffs_header(object_type: int, parent: int, name: str, mode: int, size: int = 0, alias: str = '') -> bytes:
+    # yaffs_obj_hdr as written by mkyaffs2image: unused fields are 0xFF
+    hdr = bytearray(b'\xff' * YAFFS_CHUNK_SIZE)
+    struct.pack_into('<II', hdr, 0, object_type, parent)
+    hdr[10:266] = name.encode()[:255].ljust(256, b'\x00')
+    struct.pack_into('<IIIIIIi', hdr, 268, mode, 0, 0, 0, 0, 0, size)
+    hdr[300:460] = alias.encode()[:159].ljust(160, b'\x00')
+    return bytes(hdr)
+
+
+def _yaffs_chunk(out, data: bytes, object_id: int, chunk_id: int, n_bytes: int):
+    spare = YAFFS_TAGS.pack(YAFFS_SEQUENCE_NUMBER, object_id, chunk_id, n_bytes) + bytes(12)
+    out.write(data.ljust(YAFFS_CHUNK_SIZE, b'\xff'))
+    out.write(spare.ljust(YAFFS_SPARE_SIZE, b'\xff'))
+
+
+def write_yaffs2(tree: str, image: str) -> str:
+    # YAFFS2 image of a folder, 2048+64 bytes chunks with packed tags like mkyaffs2image
+    ids = {tree: YAFFS_ROOT_ID}
+    next_id = YAFFS_FIRST_OBJECT_ID
+    with open(image, 'wb') as out:
+        _yaffs_chunk(out, _yaffs_header(YAFFS_OBJECT_DIRECTORY, YAFFS_ROOT_ID, '', 0o40755), YAFFS_ROOT_ID, 0, 0xFFFF)
+        for root, dirs, files in os.walk(tree):
+            dirs.sort()
+            for name in dirs + sorted(files):
+                path = join(root, name)
+                object_id, next_id = next_id, next_id + 1
+                st = os.lstat(path)
+                if os.path.islink(path):
+                    hdr = _yaffs_header(YAFFS_OBJECT_SYMLINK, ids[root], name, st.st_mode, alias=os.readlink(path))
+                elif isdir(path):
+                    ids[path] = object_id
+                    hdr = _yaffs_header(YAFFS_OBJECT_DIRECTORY, ids[root], name, st.st_mode)
+                else:
+                    hdr = _yaffs_header(YAFFS_OBJECT_FILE, ids[root], name, st.st_mode, st.st_size)
+                _yaffs_chunk(out, hdr, object_id, 0, 0xFFFF)
+                if isfile(path) and not os.path.islink(path):
+                    with open(path, 'rb') as f:
+                        for chunk_id, data in enumerate(iter(lambda: f.read(YAFFS_CHUNK_SIZE), b''), 1):
+                            _yaffs_chunk(out, data, object_id, chunk_id, len(data))
+    return image
+
+
+def yaffs_tree(system: str, tree: str) -> str:
+    # the files of the YAFFS2 image build_partition makes of the ext4 image system, in tree
+    with open(system, 'rb') as f:
+        seed = int.from_bytes(hashlib.sha256(f.read(MIB)).digest()[:4], 'little')
+    populate_tree(tree, os.path.getsize(system), seed)
+    return tree
+
+
+def write_lz4(raw: str, dst: str) -> str:
+    tmp = dst[:-len('.lz4')]
+    if tmp != raw:
+        shutil.copyfile(raw, tmp)
+    return compress_file(tmp, 'lz4')
+
+
+def _run(cmd: List[str]) -> str:
+    if not isfile(cmd[0]):
+        raise FixtureError(f'{cmd[0]} is not installed')
+    output = run_cmd(cmd, print_cmd=False)
+    if output is None:
+        raise FixtureError('{} failed'.format(os.path.basename(cmd[0])))
+    return output
+
+
+def wrap(files: List[str], archive: str, wrapper: str = 'zip') -> str:
+    # Archive of files, flat; payload.bin is stored, like in the OTAs
+    assert wrapper in WRAPPERS
+    if wrapper == 'zip':
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for f in files:
+                compress_type = zipfile.ZIP_STORED if basename(f) == 'payload.bin' else zipfile.ZIP_DEFLATED
+                zf.write(f, basename(f), compress_type)
+    else:
+        _run(COMMANDS[wrapper] + [archive] + files)
+    return archive
+
+
+def build_rom(kind: str, dst_dir: str, size: int, wrapper: str = 'zip', seed: int = 0, fill: float = DEFAULT_FILL,
+              entropy: float = DEFAULT_ENTROPY, image: Optional[str] = None) -> str:
+    # ROM archive with a system partition of size bytes in the given form, image: an ext4 image to reuse
+    assert kind in ROM_KINDS
+    os.makedirs(dst_dir, exist_ok=True)
+    build = tempfile.mkdtemp(dir=dst_dir)
+    try:
+        system = join(build, 'system.img')
+        if image is None:
+            make_ext4_image(system, size, seed, fill, entropy)
+        else:
+            shutil.copyfile(image, system)
+        files = build_partition(kind, system, build)
+        archive = join(dst_dir, 'rom-{}-{}M-{}.{}'.format(kind, size // MIB, seed, wrapper))
+        return wrap(files, archive, wrapper)
+    finally:
+        shutil.rmtree(build, ignore_errors=True)
+
+
+def build_partition(kind: str, system: str, dst_dir: str) -> List[str]:
+    # files a ROM of the given kind ships for the ext4 image system (which may be consumed)
+    if kind == 'ext4':
+        return [system]
+    if kind.startswith('sdat'):
+        return list(write_sdat(system, dst_dir, 'system', kind[len('sdat_'):] or None))
+    if kind == 'sparse':
+        os.replace(write_sparse(system, system + '.sparse'), system)
+        return [system]
+    if kind == 'sparsechunks':
+        return write_sparsechunks(system, dst_dir, 'system', max(2, os.path.getsize(system) // SPARSECHUNK_SIZE))
+    if kind == 'split':
+        return write_splits(system, dst_dir, 'system')
+    if kind == 'rawprogram':
+        rawprogram, pieces = write_rawprogram(system, dst_dir, 'system')
+        return [rawprogram] + pieces
+    if kind == 'update_app':
+        return [write_update_app({'SYSTEM': system}, join(dst_dir, 'UPDATE.APP'))]
+    if kind == 'sign':
+        return [write_sign_img(system, join(dst_dir, 'system-sign.img'))]
+    if kind == 'lz4':
+        return [write_lz4(system, system + '.lz4')]
+    if kind == 'kdz':
+        dz = write_dz({'system': system}, join(dst_dir, 'FIXTURE10a_00.dz'))
+        kdz = write_kdz(dz, join(dst_dir, 'FIXTURE10a_00.kdz'))
+        os.remove(dz)
+        return [kdz]
+    if kind == 'yaffs':
+        tree = yaffs_tree(system, tempfile.mkdtemp(dir=dst_dir))
+        os.replace(write_yaffs2(tree, system + '.yaffs'), system)
+        shutil.rmtree(tree, ignore_errors=True)
+        return [system]
+    if kind == 'payload':
+        return [write_payload({'system': system}, join(dst_dir, 'payload.bin'))]
+    raise FixtureError(f'Unknown ROM kind {kind}')
+
+
+def holds_image(output: str, image: str) -> bool:
+    # output is image, possibly followed by zeros (the padding of rawprogram layouts, ...)
+    if not isfile(output) or os.path.getsize(output) < os.path.getsize(image):
+        return False
+    with open(output, 'rb') as out, open(image, 'rb') as f:
+        for block in iter(lambda: f.read(MIB), b''):
+            if out.read(len(block)) != block:
+                return False
+        return all(b.count(0) == len(b) for b in iter(lambda: out.read(MIB), b''))
+
+
+def tree_digest(root: Union[str, ImageFileSystem]) -> str:
+    # sha256 of the paths, types, symlink targets and file contents of a folder or of an image
+    if isinstance(root, ImageFileSystem):
+        walk, lstat, readlink = root.walk('/'), partial(root.stat, follow_symlinks=False), root.readlink
+        top, opener = '/', root.open
+    else:
+        walk, lstat, readlink, top, opener = os.walk(root), os.lstat, os.readlink, root, partial(open, mode='rb')
+    entries = []
+    for folder, dirs, files in walk:
+        for name in dirs + files:
+            path = join(folder, name)
+            entries.append((os.path.relpath(path, top), path))
+    sha = hashlib.sha256()
+    for rel, path in sorted(entries):
+        mode = lstat(path).st_mode
+        sha.update('{}\0{:o}\0'.format(rel, stat.S_IFMT(mode)).encode(errors='surrogateescape'))
+        if stat.S_ISLNK(mode):
+            sha.update(readlink(path).encode(errors='surrogateescape'))
+        elif stat.S_ISREG(mode):
+            with opener(path) as f:
+                for block in iter(lambda: f.read(MIB), b''):
+                    sha.update(block)
+    return sha.hexdigest()
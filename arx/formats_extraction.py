@@ -1,56 +1,47 @@
+import logging
 import os
 import xml.etree.ElementTree as ET
-from collections import defaultdict
 
 from os.path import isdir, isfile, abspath, dirname, realpath, join, basename
-from typing import Optional
+from typing import Optional, List, Iterable
 
+from arx.kdz import KdzReader, DzReader, KdzError
+from arx.rawprogram import assemble_rawprogram
 from arx.shell_wrapper import run_cmd, file_info, find, findw
+from arx.sparse_image import sparse_to_raw, locate_ext4_superblock, SparseImageError
+from arx.streams import open_member, read_member_lines, new_data_image_name, StreamError
+from arx.payload import PayloadReader, PayloadError
+from arx.sdat2img.sdat2img import sdat2img_stream, read_transfer_list, Sdat2ImgError
+from arx.update_app import UpdateAppReader, UpdateAppError
 from arx.utility import get_parent_folder
+from arx.workdir_index import WorkDirIndex
 
+logger = logging.getLogger('rom_analyzer')
 
-def unsparse_joiner(rawprogram0_xml: str) -> bool:
+
+def unsparse_joiner(rawprogram0_xml: str, partitions: Optional[Iterable[str]] = None) -> bool:
     assert isfile(rawprogram0_xml)
-    work_dir = os.path.dirname(rawprogram0_xml)
-    xml = ET.parse(rawprogram0_xml)
-    partitions = defaultdict(list)
-    for e in xml.findall("program"):
-        attribs = e.attrib
-        filename = attribs.get("filename")
-        if filename is None:
-            continue
-        partitions[attribs["label"]].append(filename)
-    for k, v in partitions.items():
-        if len(v) > 1:
-            kind = 'huawei' if '.unsparse' in v[0] else 'huawei2'
-            script_path = abspath(join(dirname(realpath(__file__)), 'sh_scripts', 'combine_unsparse.sh'))
-            assert isfile(script_path)
-            output = run_cmd(['bash', script_path, work_dir, k, os.path.basename(rawprogram0_xml), kind])
-            if output is None or len(output) <= 0:
-                raise Exception('combine_unsparse.sh fail')
-            newimg = join(work_dir, k + '.img')
+    try:
+        for newimg in assemble_rawprogram(rawprogram0_xml, partitions=partitions):
             assert isfile(newimg)
+    except (OSError, ET.ParseError) as e:
+        logger.error('Error during rawprogram assembly: {}'.format(e))
+        return False
     return True
 
 
-def sparsechunks_to_raw(tmp_dir, sc_name: str) -> str:
+def sparse_chunks_list(tmp_dir, sc_name: str, index: Optional[WorkDirIndex] = None) -> List[str]:
     assert isdir(tmp_dir)
-    sparse_chunks = findw(tmp_dir, f"{sc_name}.img_sparsechunk.*")
+    sparse_chunks = findw(tmp_dir, f"{sc_name}.img_sparsechunk.*", index)
     if sparse_chunks is not None:
         sparse_chunks.sort()
-        raw_img = sparse_chunks_to_raw(sc_name, sparse_chunks)
-        return raw_img
+        return sparse_chunks
     else:
         raise Exception("Flawed logic: can't find sparse chunks")
 
 
-def x7z_tar_md5(file_tar_md5: str, dst_dir: str = None) -> bool:
-    assert isfile(file_tar_md5)
-    if dst_dir is None:
-        dst_dir = get_parent_folder(file_tar_md5)
-    # the following " '-o' + " is correct
-    output = run_cmd(['/usr/bin/7z', 'x', file_tar_md5, '-o' + dst_dir, '-aos'])
-    return "Everything is Ok" in output
+def sparsechunks_to_raw(tmp_dir, sc_name: str, index: Optional[WorkDirIndex] = None) -> str:
+    return sparse_chunks_to_raw(sc_name, sparse_chunks_list(tmp_dir, sc_name, index))
 
 
 def extract_lz4(img_lz4: str) -> bool:
@@ -60,40 +51,50 @@ def extract_lz4(img_lz4: str) -> bool:
     return "decoded" in output
 
 
-def extract_kdz(kdz_file: str) -> bool:
+def extract_kdz(kdz_file: str, partitions: Optional[Iterable[str]] = None) -> bool:
+    # the DZ is read inside the KDZ, never copied out
     assert isfile(kdz_file)
     output_dir = get_parent_folder(kdz_file)
-    script_path = abspath(join(dirname(os.path.realpath(__file__)), 'kdztools', 'unkdz.py'))
-    assert isfile(script_path)
-    output = run_cmd(['python3', script_path, "-f", kdz_file, "-x", "-d", output_dir])
-    return "Extracting" in output
+    try:
+        records = KdzReader(kdz_file).dz_records()
+        if len(records) == 0:
+            logger.error('No DZ in {}'.format(kdz_file))
+            return False
+        for r in records:
+            reader = DzReader(kdz_file, r.offset)
+            logger.info("{}: {} {}, partitions: {}".format(r.name, reader.model, reader.version,
+                                                             ', '.join(reader.partitions)))
+            reader.extract_all(output_dir, partitions)
+    except (KdzError, OSError) as e:
+        logger.error('Error during KDZ extraction: {}'.format(e))
+        return False
+    return True
 
 
-def extract_dz(dz_file: str) -> bool:
+def extract_dz(dz_file: str, partitions: Optional[Iterable[str]] = None) -> bool:
     assert isfile(dz_file)
     output_dir = get_parent_folder(dz_file)
-    script_path = abspath(join(dirname(realpath(__file__)), 'kdztools', 'undz.py'))
-    assert isfile(script_path)
-    output = run_cmd(['python3', script_path, "-f", dz_file, "-l"])
-    if output is None:
+    try:
+        reader = DzReader(dz_file)
+        logger.info("DZ {} {}, partitions: {}".format(reader.model, reader.version, ', '.join(reader.partitions)))
+        reader.extract_all(output_dir, partitions)
+    except (KdzError, OSError) as e:
+        logger.error('Error during DZ extraction: {}'.format(e))
         return False
-    for line in output.split("\n"):
-        if "system_" in line and " : " in line:
-            n = line.split(" : ")[0]
-            if "/" in n:
-                n = int(n.split("/")[0])
-                output = run_cmd(['python3', script_path, "-f", dz_file, "-s", str(n), "-d", output_dir])
-                sys_img = os.path.join(output_dir, "system.image")
-                return isfile(sys_img)
-    return False
-
-
-def extract_update_app(update_app: str) -> bool:
+    return True
+
+
+def extract_update_app(update_app: str, partitions: Optional[Iterable[str]] = None) -> bool:
     assert isfile(update_app)
-    splitupdate_pl = abspath(join(dirname(realpath(__file__)), 'huawei_firmware_extractor', 'splitupdate'))
-    assert isfile(splitupdate_pl)
-    output = run_cmd(['perl', splitupdate_pl, update_app])
-    return output is not None
+    dst_dir = join(dirname(update_app), 'output')
+    try:
+        with UpdateAppReader(update_app) as reader:
+            logger.info("UPDATE.APP entries: {}".format(', '.join(e.file_type for e in reader.entries)))
+            reader.extract_all(dst_dir, partitions)
+    except (UpdateAppError, OSError) as e:
+        logger.error('Error during UPDATE.APP extraction: {}'.format(e))
+        return False
+    return True
 
 
 def extract_sign_img(sign_img: str) -> bool:
@@ -117,13 +118,39 @@ def extract_br(img_dat_br: str) -> bool:
     return "ext4 filesystem data" in file_info(ret)
 
 
+def stream_sdat2img(archive: str, transfer_list_member: str, new_data_member: str, output_dir: str) -> bool:
+    # zip member -> decompressor -> transfer list, only the final image is written
+    assert isfile(archive)
+    assert isdir(output_dir)
+    new_img = join(output_dir, new_data_image_name(new_data_member))
+    try:
+        transfer_list = read_transfer_list(read_member_lines(archive, transfer_list_member))
+        with open_member(archive, new_data_member) as new_data:
+            result = sdat2img_stream(transfer_list, new_data, new_img)
+    except (Sdat2ImgError, StreamError, OSError, EOFError) as e:
+        logger.error('Error during streamed sdat2img of {}: {}'.format(new_data_member, e))
+        return False
+    logger.info("sdat2img {}:{} -> {} ({} blocks, {})".format(
+        basename(archive), new_data_member, new_img, result.blocks_written, result.android_version))
+    return True
+
+
+def sparse_images_to_raw(imgs: List[str], raw_img: str, skip_bytes: int = 0) -> bool:
+    logger.info("sparse_to_raw {} -> {} (skip={})".format(' '.join(imgs), raw_img, skip_bytes))
+    try:
+        sparse_to_raw(imgs, raw_img, skip_bytes)
+    except (SparseImageError, OSError) as e:
+        logger.error('Error during sparse conversion: {}'.format(e))
+        return False
+    return True
+
+
 def sparse_single_to_raw(img: str) -> Optional[str]:
     assert isfile(img)
     fname = basename(img)
     dir_path = os.path.dirname(img)
     raw_img = os.path.join(dir_path, f'{fname}.raw')
-    output = run_cmd(['/usr/local/bin/simg2img', img, raw_img])
-    if output is None:
+    if not sparse_images_to_raw([img], raw_img):
         return None
     assert isfile(raw_img)
     return raw_img
@@ -134,24 +161,16 @@ def sparse_chunks_to_raw(sc_name: str, imgs: list) -> Optional[str]:
     for i in imgs:
         assert isfile(i)
     dir_path = os.path.dirname(imgs[0])
-    raw_img = os.path.join(dir_path, f'{sc_name}.img.raw.tmp')
+    raw_img = os.path.join(dir_path, f'{sc_name}.img.raw')
     assert not isfile(raw_img)
-    output = run_cmd(['/usr/local/bin/simg2img'] + imgs + [raw_img])
-    if output is None:
+    try:
+        offset = locate_ext4_superblock(imgs)
+    except SparseImageError as e:
+        logger.error('Error during sparse conversion: {}'.format(e))
+        return None
+    # the filesystem may not start at the beginning of the chunks: decode from its superblock
+    if not sparse_images_to_raw(imgs, raw_img, offset if offset is not None else 0):
         return None
-    assert isfile(raw_img)
-    with open(raw_img, 'rb') as f:
-        s = f.read()
-        offset = s.find(b'\x53\xEF')
-        offset -= 1080
-        tmp_raw = raw_img
-        raw_img = tmp_raw.replace(".tmp", "")
-        if offset > 0:
-            output = run_cmd(['/bin/dd', f'if={tmp_raw}', f'of={raw_img}', f'ibs={offset}', 'skip=1'])
-            if output is None:
-                return None
-        else:
-            os.rename(tmp_raw, raw_img)
     assert isfile(raw_img)
     return raw_img
 
@@ -174,13 +193,19 @@ def extract_sin(img_sin: str) -> bool:
     return "Extraction finished" in output
 
 
-def extract_ota_payload_bin(bin_file: str, output_dir: str) -> bool:
+def extract_ota_payload_bin(bin_file: str, output_dir: str, partitions: Optional[Iterable[str]] = None,
+                            offset: int = 0) -> bool:
+    # offset: where payload.bin starts in bin_file, e.g. when it is read in place from the OTA zip
     assert isdir(output_dir)
     assert isfile(bin_file)
-
-    script_path = abspath(join(dirname(realpath(__file__)), 'extract_android_ota_payload', 'extract_android_ota_payload.py'))
-    output = run_cmd(['python2', script_path, bin_file, output_dir])
-    return output is not None
+    try:
+        reader = PayloadReader(bin_file, offset)
+        logger.info("payload.bin partitions: {}".format(', '.join(p.name for p in reader.partitions)))
+        reader.extract_all(output_dir, partitions)
+    except (PayloadError, OSError) as e:
+        logger.error('Error during payload.bin extraction: {}'.format(e))
+        return False
+    return True
 
 
 def extract_ubi_image(sys_img: str):
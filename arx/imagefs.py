@@ -0,0 +1,362 @@
+import io
+import mmap
+import os
+import posixpath
+import shutil
+import stat
+import struct
+
+from bisect import bisect_right
+from functools import lru_cache
+from os.path import isfile
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+# symlinks followed while resolving a path, as Linux does
+MAX_SYMLINKS = 40
+EXTRACT_BUFFER_SIZE = 1024 * 1024
+
+
+class ImageFsError(Exception):
+    pass
+
+
+class Stat(NamedTuple):
+    st_ino: int
+    st_mode: int
+    st_size: int
+    st_uid: int
+    st_gid: int
+    st_mtime: int
+    st_nlink: int
+
+
+class DirEntry(NamedTuple):
+    name: str
+    inode: int
+
+
+# (offset in the file, offset in the image or None for a hole, length), all in bytes
+DataRun = Tuple[int, Optional[int], int]
+
+
+class SplitImage:
+    # Read-only view of parts (system_1.img, system_2.img, ...) as the image they are the pieces
+    # of, without concatenating them: each part is mapped, slices spanning two parts are joined.
+
+    def __init__(self, parts: List[str]):
+        self._files = []
+        self._maps: List[mmap.mmap] = []
+        self._starts: List[int] = []
+        size = 0
+        try:
+            for p in parts:
+                f = open(p, 'rb')
+                self._files.append(f)
+                length = os.fstat(f.fileno()).st_size
+                if length == 0:
+                    continue
+                self._maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                self._starts.append(size)
+                size += length
+        except BaseException:
+            self.close()
+            raise
+        self._size = size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[int, bytes]:
+        if isinstance(key, int):
+            if key < 0:
+                key += self._size
+            if not 0 <= key < self._size:
+                raise IndexError('index out of range')
+            return self[key:key + 1][0]
+        start, stop, step = key.indices(self._size)
+        assert step == 1
+        if stop <= start:
+            return b''
+        i = bisect_right(self._starts, start) - 1
+        offset = start - self._starts[i]
+        if offset + stop - start <= len(self._maps[i]):
+            return self._maps[i][offset:offset + stop - start]
+        chunks = []
+        while start < stop:
+            n = min(stop - start, len(self._maps[i]) - offset)
+            chunks.append(self._maps[i][offset:offset + n])
+            start += n
+            i += 1
+            offset = 0
+        return b''.join(chunks)
+
+    def close(self):
+        for m in self._maps:
+            m.close()
+        for f in self._files:
+            f.close()
+
+
+@lru_cache(maxsize=None)
+def _compiled(fmt: str) -> struct.Struct:
+    return struct.Struct(fmt)
+
+
+class ImageFile(io.RawIOBase):
+    # Streams a file out of the image mapping, holes read as zeros
+
+    def __init__(self, mm: Union[mmap.mmap, SplitImage], runs: List[DataRun], size: int):
+        super().__init__()
+        self._mm = mm
+        self._runs = runs
+        self._starts = [r[0] for r in runs]
+        self._size = size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b) -> int:
+        todo = min(len(b), self._size - self._pos)
+        if todo <= 0:
+            return 0
+        i = bisect_right(self._starts, self._pos) - 1
+        n = todo
+        if i >= 0:
+            start, phys, length = self._runs[i]
+            if self._pos < start + length:
+                n = min(todo, start + length - self._pos)
+                if phys is not None:
+                    src = phys + self._pos - start
+                    b[:n] = self._mm[src:src + n]
+                    self._pos += n
+                    return n
+        if i + 1 < len(self._runs):
+            n = min(n, self._runs[i + 1][0] - self._pos)
+        b[:n] = bytes(n)
+        self._pos += n
+        return n
+
+
+class ImageFileSystem:
+    # Read-only access to the files of a filesystem image, without mounting it. Directories are
+    # read on first access. Subclasses decode their on-disk format through _stat, _dir_entries
+    # and _data_runs.
+
+    root_inode = 0
+
+    def __init__(self, image: str, parts: Optional[List[str]] = None):
+        # parts: the files image is split in, read in place (see SplitImage)
+        self.path = image
+        self.parts = parts
+        self._f = None
+        if parts is not None:
+            self._mm = SplitImage(parts)
+            if len(self._mm) == 0:
+                self._mm.close()
+                raise ImageFsError(f'{image} is empty')
+        else:
+            assert isfile(image)
+            self._f = open(image, 'rb')
+            try:
+                self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                self._f.close()
+                raise ImageFsError(f'{image} is empty')
+        self._dirs: Dict[int, Dict[str, int]] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self) -> str:
+        return '{}({!r})'.format(type(self).__name__, self.path)
+
+    def close(self):
+        self._mm.close()
+        if self._f is not None:
+            self._f.close()
+
+    def _unpack(self, fmt: Union[str, struct.Struct], offset: int) -> tuple:
+        st = fmt if isinstance(fmt, struct.Struct) else _compiled(fmt)
+        if isinstance(self._mm, SplitImage):
+            return st.unpack(self._mm[offset:offset + st.size])
+        return st.unpack_from(self._mm, offset)
+
+    def _stat(self, inode: int) -> Stat:
+        raise NotImplementedError
+
+    def _dir_entries(self, inode: int) -> Iterator[DirEntry]:
+        # every entry but . and ..
+        raise NotImplementedError
+
+    def _data_runs(self, inode: int) -> List[DataRun]:
+        raise NotImplementedError
+
+    def _read_inode(self, inode: int) -> bytes:
+        st = self._stat(inode)
+        with ImageFile(self._mm, self._data_runs(inode), st.st_size) as f:
+            return f.read()
+
+    def _readlink(self, inode: int) -> str:
+        return self._read_inode(inode).decode(errors='surrogateescape')
+
+    def _directory(self, inode: int) -> Dict[str, int]:
+        entries = self._dirs.get(inode)
+        if entries is None:
+            if not stat.S_ISDIR(self._stat(inode).st_mode):
+                raise NotADirectoryError(inode)
+            entries = {e.name: e.inode for e in self._dir_entries(inode)}
+            self._dirs[inode] = entries
+        return entries
+
+    def lookup(self, path: str, follow_symlinks: bool = True) -> int:
+        # inode of path, symlinks are resolved inside the image
+        inode = self.root_inode
+        parts = [p for p in path.split('/') if p not in ('', '.')]
+        links = 0
+        parents = []
+        while parts:
+            name = parts.pop(0)
+            if name == '..':
+                inode = parents.pop() if parents else self.root_inode
+                continue
+            child = self._directory(inode).get(name)
+            if child is None:
+                raise FileNotFoundError(posixpath.join('/', path))
+            if stat.S_ISLNK(self._stat(child).st_mode) and (parts or follow_symlinks):
+                links += 1
+                if links > MAX_SYMLINKS:
+                    raise ImageFsError(f'Too many levels of symbolic links in {path}')
+                target = self._readlink(child)
+                if target.startswith('/'):
+                    inode = self.root_inode
+                    parents = []
+                parts = [p for p in target.split('/') if p not in ('', '.')] + parts
+                continue
+            parents.append(inode)
+            inode = child
+        return inode
+
+    def stat(self, path: str, follow_symlinks: bool = True) -> Stat:
+        return self._stat(self.lookup(path, follow_symlinks))
+
+    def exists(self, path: str) -> bool:
+        try:
+            self.lookup(path)
+        except (FileNotFoundError, NotADirectoryError, ImageFsError):
+            return False
+        return True
+
+    def isdir(self, path: str) -> bool:
+        return self.exists(path) and stat.S_ISDIR(self.stat(path).st_mode)
+
+    def isfile(self, path: str) -> bool:
+        return self.exists(path) and stat.S_ISREG(self.stat(path).st_mode)
+
+    def scandir(self, path: str = '/') -> List[DirEntry]:
+        return [DirEntry(name, inode) for name, inode in self._directory(self.lookup(path)).items()]
+
+    def listdir(self, path: str = '/') -> List[str]:
+        return list(self._directory(self.lookup(path)))
+
+    def readlink(self, path: str) -> str:
+        inode = self.lookup(path, follow_symlinks=False)
+        if not stat.S_ISLNK(self._stat(inode).st_mode):
+            raise ImageFsError(f'{path} is not a symbolic link')
+        return self._readlink(inode)
+
+    def open(self, path: str) -> io.BufferedReader:
+        inode = self.lookup(path)
+        st = self._stat(inode)
+        if not stat.S_ISREG(st.st_mode):
+            raise IsADirectoryError(path) if stat.S_ISDIR(st.st_mode) else ImageFsError(f'{path} is not a file')
+        return io.BufferedReader(ImageFile(self._mm, self._data_runs(inode), st.st_size))
+
+    def read(self, path: str) -> bytes:
+        with self.open(path) as f:
+            return f.read()
+
+    def walk(self, top: str = '/'):
+        # like os.walk, symlinks to directories are not followed
+        dirs, files = [], []
+        for name, inode in self._directory(self.lookup(top)).items():
+            (dirs if stat.S_ISDIR(self._stat(inode).st_mode) else files).append(name)
+        yield top, dirs, files
+        for name in dirs:
+            yield from self.walk(posixpath.join(top, name))
+
+
+def extract_tree(fs: ImageFileSystem, dst_dir: str, paths: Iterable[str] = ('/',)) -> int:
+    # Copies paths of fs (whole folders, files, symlinks) into dst_dir with their mode and mtime,
+    # returns the number of files copied. Missing paths are skipped, device nodes and the like too.
+    n = 0
+    dirs = []
+    for path in paths:
+        try:
+            st = fs.stat(path, follow_symlinks=False)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        top = posixpath.normpath(posixpath.join('/', path))
+        os.makedirs(os.path.join(dst_dir, posixpath.dirname(top).lstrip('/')), exist_ok=True)
+        if not stat.S_ISDIR(st.st_mode):
+            n += _extract_entry(fs, top, st, os.path.join(dst_dir, top.lstrip('/')))
+            continue
+        for root, _, files in fs.walk(top):
+            out = os.path.join(dst_dir, root.lstrip('/'))
+            os.makedirs(out, exist_ok=True)
+            dirs.append((out, fs.stat(root)))
+            for name in files:
+                path = posixpath.join(root, name)
+                n += _extract_entry(fs, path, fs.stat(path, follow_symlinks=False), os.path.join(out, name))
+    # last, read-only folders would refuse their files
+    for out, st in reversed(dirs):
+        os.chmod(out, stat.S_IMODE(st.st_mode) | stat.S_IWUSR | stat.S_IXUSR)
+        os.utime(out, (st.st_mtime, st.st_mtime))
+    return n
+
+
+def _extract_entry(fs: ImageFileSystem, path: str, st: Stat, out: str) -> int:
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(fs.readlink(path), out)
+        return 1
+    if not stat.S_ISREG(st.st_mode):
+        return 0
+    with fs.open(path) as src, open(out, 'wb') as dst:
+        shutil.copyfileobj(src, dst, EXTRACT_BUFFER_SIZE)
+    os.chmod(out, stat.S_IMODE(st.st_mode) | stat.S_IRUSR)
+    os.utime(out, (st.st_mtime, st.st_mtime))
+    return 1
+
+
+def open_filesystem(image: str, parts: Optional[List[str]] = None) -> Optional[ImageFileSystem]:
+    # None when image is not a filesystem readable here. The superblocks are in the first part.
+    from arx.ext4 import Ext4FileSystem, is_ext4_image  # circular dependency
+    from arx.erofs import ErofsFileSystem, is_erofs_image  # circular dependency
+    from arx.yaffs import YaffsFileSystem, is_yaffs2_image  # circular dependency
+    head = parts[0] if parts else image
+    if is_ext4_image(head):
+        return Ext4FileSystem(image, parts)
+    if is_erofs_image(head):
+        return ErofsFileSystem(image, parts)
+    if parts is None and is_yaffs2_image(image):
+        return YaffsFileSystem(image)
+    return None
@@ -0,0 +1,266 @@
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import sqlite3
+import stat
+
+from concurrent.futures import ProcessPoolExecutor
+from os.path import isdir, isfile, join
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from arx.imagefs import ImageFileSystem, open_filesystem
+
+logger = logging.getLogger('rom_analyzer')
+
+READ_SIZE = 1024 * 1024
+# files hashed by a worker at a time: one big file, or small ones up to about these many
+BATCH_FILES = 256
+BATCH_BYTES = 64 * 1024 * 1024
+FUZZY_MAX_RESULT = 2 * 64 + 20
+ZIP_MAGIC = b'PK\x03\x04'
+DEX_MAGIC = b'dex\n'
+APK_MANIFEST = b'AndroidManifest.xml'
+
+SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE files (
+    partition TEXT, path TEXT, size INTEGER, mode INTEGER, uid INTEGER, gid INTEGER, mtime INTEGER, link TEXT,
+    sha256 TEXT, ssdeep TEXT, is_apk INTEGER, is_dex INTEGER, PRIMARY KEY (partition, path));
+CREATE TABLE hashes (
+    device TEXT, inode INTEGER, size INTEGER, mtime INTEGER, sha256 TEXT, ssdeep TEXT, is_apk INTEGER,
+    is_dex INTEGER, PRIMARY KEY (device, inode, size, mtime));
+'''
+
+# where a worker reads a file from: (SOURCE_DIR, root), (SOURCE_FILE, path), (SOURCE_IMAGE, image, parts)
+SOURCE_DIR = 'dir'
+SOURCE_FILE = 'file'
+SOURCE_IMAGE = 'image'
+
+
+class Entry(NamedTuple):
+    partition: str  # key of the unpack_and_mount result
+    path: str  # absolute in the partition, the file name for boot/ramdisk images
+    size: int
+    mode: int
+    uid: int
+    gid: int
+    mtime: int
+    link: Optional[str]
+    device: str  # with inode, size and mtime: the key of the cached hashes
+    inode: int
+
+
+class Digest(NamedTuple):
+    sha256: Optional[str]
+    ssdeep: Optional[str]
+    is_apk: bool
+    is_dex: bool
+
+
+_fuzzy = None
+
+
+def _libfuzzy():
+    # ssdeep's library through ctypes, None when it is not installed
+    global _fuzzy
+    if _fuzzy is None:
+        name = ctypes.util.find_library('fuzzy')
+        try:
+            lib = ctypes.CDLL(name or 'libfuzzy.so.2')
+            lib.fuzzy_new.restype = ctypes.c_void_p
+            lib.fuzzy_update.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t]
+            lib.fuzzy_digest.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint]
+            lib.fuzzy_free.argtypes = [ctypes.c_void_p]
+            _fuzzy = lib
+        except (OSError, AttributeError):
+            logger.warning("libfuzzy not found, no ssdeep hashes")
+            _fuzzy = False
+    return _fuzzy or None
+
+
+def _digest(f) -> Digest:
+    # one pass: sha256, ssdeep and the APK/DEX magics
+    sha = hashlib.sha256()
+    lib = _libfuzzy()
+    state = lib.fuzzy_new() if lib is not None else None
+    try:
+        head = f.read(READ_SIZE)
+        is_zip = head.startswith(ZIP_MAGIC)
+        has_manifest = False
+        tail = b''
+        block = head
+        while block:
+            sha.update(block)
+            if state is not None:
+                lib.fuzzy_update(state, block, len(block))
+            if is_zip and not has_manifest:
+                # the name is in the local header and the central directory of the member
+                has_manifest = APK_MANIFEST in tail + block
+                tail = block[1 - len(APK_MANIFEST):]
+            block = f.read(READ_SIZE)
+        fuzzy = None
+        if state is not None:
+            out = ctypes.create_string_buffer(FUZZY_MAX_RESULT)
+            if lib.fuzzy_digest(state, out, 0) == 0:
+                fuzzy = out.value.decode()
+    finally:
+        if state is not None:
+            lib.fuzzy_free(state)
+    return Digest(sha.hexdigest(), fuzzy, is_zip and has_manifest, head.startswith(DEX_MAGIC))
+
+
+# filesystems opened by this worker process
+_filesystems: Dict[Tuple, ImageFileSystem] = {}
+
+
+def _open(source: Tuple, path: str):
+    kind = source[0]
+    if kind == SOURCE_DIR:
+        return open(join(source[1], path.lstrip('/')), 'rb')
+    if kind == SOURCE_FILE:
+        return open(source[1], 'rb')
+    fs = _filesystems.get(source)
+    if fs is None:
+        fs = _filesystems[source] = open_filesystem(source[1], list(source[2]) if source[2] else None)
+    return fs.open(path)
+
+
+def _digest_batch(source: Tuple, paths: List[str]) -> List[Optional[Digest]]:
+    # Worker side, None for the files that can't be read
+    ret = []
+    for p in paths:
+        try:
+            with _open(source, p) as f:
+                ret.append(_digest(f))
+        except Exception as e:
+            logger.warning("inventory: can't read {}: {}".format(p, e))
+            ret.append(None)
+    return ret
+
+
+def _dir_entries(partition: str, root: str) -> Iterator[Entry]:
+    # mount points and unyaffs folders, other mounts under root are not entered
+    st = os.lstat(root)
+    device = str(st.st_dev)
+    for top, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not os.path.ismount(join(top, d))]
+        for name in dirs + files:
+            path = join(top, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            link = os.readlink(path) if stat.S_ISLNK(st.st_mode) else None
+            yield Entry(partition, '/' + os.path.relpath(path, root), st.st_size, st.st_mode, st.st_uid, st.st_gid,
+                        st.st_mtime_ns, link, device, st.st_ino)
+
+
+def _image_entries(partition: str, fs: ImageFileSystem) -> Iterator[Entry]:
+    # inode numbers are those of the image, the image file itself is the device
+    st = os.stat(fs.path if fs.parts is None else fs.parts[0])
+    device = '{}:{}'.format(st.st_dev, st.st_ino)
+    for top, dirs, files in fs.walk('/'):
+        for name in dirs + files:
+            path = top.rstrip('/') + '/' + name
+            try:
+                st = fs.stat(path, follow_symlinks=False)
+                link = fs.readlink(path) if stat.S_ISLNK(st.st_mode) else None
+            except Exception as e:
+                logger.warning("inventory: can't stat {} in {}: {}".format(path, partition, e))
+                continue
+            yield Entry(partition, path, st.st_size, st.st_mode, st.st_uid, st.st_gid, st.st_mtime, link, device,
+                        st.st_ino)
+
+
+def _file_entry(partition: str, path: str) -> Entry:
+    st = os.stat(path)
+    return Entry(partition, os.path.basename(path), st.st_size, st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns,
+                 None, str(st.st_dev), st.st_ino)
+
+
+def _sources(result: Dict) -> Iterator[Tuple[Tuple, List[Entry]]]:
+    for partition, value in sorted(result.items(), key=lambda kv: kv[0]):
+        if isinstance(value, ImageFileSystem):
+            parts = tuple(value.parts) if value.parts is not None else None
+            yield (SOURCE_IMAGE, value.path, parts), list(_image_entries(partition, value))
+        elif isdir(value):
+            yield (SOURCE_DIR, value), list(_dir_entries(partition, value))
+        elif isfile(value):
+            yield (SOURCE_FILE, value), [_file_entry(partition, value)]
+        else:
+            logger.warning("inventory: nothing to read for {} ({})".format(partition, value))
+
+
+def _batches(entries: List[Entry]) -> Iterator[List[Entry]]:
+    # biggest first, so that the last batches to finish are short
+    batch, size = [], 0
+    for e in sorted(entries, key=lambda e: e.size, reverse=True):
+        if batch and (len(batch) >= BATCH_FILES or size + e.size > BATCH_BYTES):
+            yield batch
+            batch, size = [], 0
+        batch.append(e)
+        size += e.size
+    if batch:
+        yield batch
+
+
+def _cached_hashes(manifest: str) -> Dict[Tuple, Digest]:
+    if not isfile(manifest):
+        return {}
+    try:
+        db = sqlite3.connect(manifest)
+        try:
+            rows = db.execute('SELECT device, inode, size, mtime, sha256, ssdeep, is_apk, is_dex FROM hashes').fetchall()
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        logger.warning("inventory: ignoring the hashes of {}: {}".format(manifest, e))
+        return {}
+    return {tuple(r[:4]): Digest(r[4], r[5], bool(r[6]), bool(r[7])) for r in rows}
+
+
+def write_inventory(result: Dict, manifest: str, workers: Optional[int] = None, rom: Optional[str] = None) -> int:
+    # SQLite manifest of every file of an unpack_and_mount result: path, size, mode, owner, mtime,
+    # symlink target, and for regular files sha256, ssdeep and whether they are APKs or DEX files.
+    # Hashes of a previous manifest at the same path are reused for the files whose device, inode,
+    # size and mtime did not change. Returns the number of files hashed.
+    cached = _cached_hashes(manifest)
+    rows = []
+    hashed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = []
+        for source, entries in _sources(result):
+            todo = []
+            for e in entries:
+                digest = cached.get((e.device, e.inode, e.size, e.mtime)) if stat.S_ISREG(e.mode) else None
+                if stat.S_ISREG(e.mode) and digest is None:
+                    todo.append(e)
+                else:
+                    rows.append((e, digest))
+            for batch in _batches(todo):
+                jobs.append((batch, pool.submit(_digest_batch, source, [e.path for e in batch])))
+            logger.info("inventory: {} files in {}, {} to hash".format(len(entries), source[1], len(todo)))
+        for batch, job in jobs:
+            digests = job.result()
+            hashed += len(batch)
+            rows.extend(zip(batch, digests))
+    tmp = manifest + '.tmp'
+    if isfile(tmp):
+        os.remove(tmp)
+    db = sqlite3.connect(tmp)
+    try:
+        db.executescript(SCHEMA)
+        db.executemany('INSERT INTO meta VALUES (?, ?)', [('rom', rom), ('files', str(len(rows)))])
+        db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       [(e.partition, e.path, e.size, e.mode, e.uid, e.gid, e.mtime, e.link)
+                        + (tuple(d) if d is not None else (None, None, None, None)) for e, d in rows])
+        db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       [(e.device, e.inode, e.size, e.mtime) + tuple(d) for e, d in rows if d is not None])
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmp, manifest)
+    logger.info("inventory: {} files, {} hashed -> {}".format(len(rows), hashed, manifest))
+    return hashed
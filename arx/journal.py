@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from os.path import isdir, join
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from arx.cache import file_sha256
+
+logger = logging.getLogger('rom_analyzer')
+
+# bump when a change in the extraction steps makes the journals of older runs stale
+JOURNAL_VERSION = 2
+JOURNAL = '.arx_journal.jsonl'
+HASH_WORKERS = 4
+# written in the output folder once the extraction is done (see arx.main), not part of any step
+RUN_OUTPUTS = ('report.json', 'trace.json', 'inventory.sqlite')
+
+
+class Checkpoint(NamedTuple):
+    step: str
+    # path relative to the work dir -> size, mtime, sha256 (None: size only)
+    files: Dict[str, Tuple[int, int, Optional[str]]]
+    data: Dict
+
+
+class Journal:
+    # Steps of an extraction completed in work_dir, appended (and synced) to a JSON lines file as
+    # they finish: a header naming the run (ROM, options) and the files that were there before,
+    # then one checkpoint per step with every file of the work dir at that point, its size, mtime
+    # and sha256. Only the artifacts of the step are hashed, the files unchanged since the previous
+    # checkpoint keep their hash. resume() keeps the last checkpoint whose files are all intact and
+    # removes what came after it, so the interrupted step starts over from the very files it
+    # started from.
+
+    def __init__(self, work_dir: str, run: Dict, protected: Iterable[str] = ()):
+        assert isdir(work_dir)
+        self.work_dir = os.path.abspath(work_dir)
+        self.path = join(self.work_dir, JOURNAL)
+        self.run = run
+        self.protected = {os.path.abspath(p) for p in protected}
+        self.checkpoints: List[Checkpoint] = []
+        self.preexisting: Dict[str, Tuple[int, int]] = {}  # not ours, unless they change: size, mtime
+        # sha256 of the files hashed by this process, by path, size and mtime
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}
+        loaded = self._load()
+        if loaded is None:
+            self.preexisting = {p: self._stat(p) for p in self._files()}
+        if not loaded:
+            self._rewrite()
+
+    def _load(self) -> Optional[bool]:
+        # None: no journal of this run, False: it has to be rewritten (torn)
+        torn = False
+        try:
+            with open(self.path) as f:
+                records = []
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # torn by a kill while appending, the step was not done
+                        torn = True
+                        break
+        except OSError:
+            return None
+        if len(records) == 0 or records[0].get('version') != JOURNAL_VERSION:
+            return None
+        if records[0].get('run') != self.run:
+            logger.warning("journal: {} is from another run ({}), starting over".format(self.path, records[0].get('run')))
+            return None
+        self.preexisting = {p: tuple(v) for p, v in records[0]['preexisting'].items()}
+        for r in records[1:]:
+            self.checkpoints.append(Checkpoint(r['step'], {p: tuple(v) for p, v in r['files'].items()}, r['data']))
+        return not torn
+
+    def _rewrite(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as out:
+            out.write(json.dumps({'version': JOURNAL_VERSION, 'run': self.run,
+                                  'preexisting': self.preexisting}) + '\n')
+            for cp in self.checkpoints:
+                out.write(self._record(cp) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, self.path)
+        self._sync_dir()
+
+    def _sync_dir(self):
+        fd = os.open(self.work_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _record(cp: Checkpoint) -> str:
+        return json.dumps({'step': cp.step, 'files': cp.files, 'data': cp.data})
+
+    def _files(self) -> List[str]:
+        # relative paths of the files of the work dir, mount points are not entered
+        ret = []
+        for root, dirs, files in os.walk(self.work_dir):
+            dirs[:] = [d for d in dirs if not os.path.ismount(join(root, d))]
+            for name in files:
+                path = join(root, name)
+                if path == self.path or path == self.path + '.tmp' or path in self.protected:
+                    continue
+                if root == self.work_dir and name in RUN_OUTPUTS:
+                    continue
+                ret.append(os.path.relpath(path, self.work_dir))
+        return ret
+
+    def _stat(self, rel: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(join(self.work_dir, rel))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def _sha256(self, rel: str) -> Optional[str]:
+        path = join(self.work_dir, rel)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        known = self._hashes.get(rel)
+        if known is not None and known[:2] == (st.st_size, st.st_mtime_ns):
+            return known[2]
+        sha = file_sha256(path)
+        self._hashes[rel] = (st.st_size, st.st_mtime_ns, sha)
+        return sha
+
+    def _hash_all(self, rels: List[str]) -> Dict[str, Optional[str]]:
+        # hashlib releases the GIL on big blocks, the files are read in parallel
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            return dict(zip(rels, pool.map(self._sha256, rels)))
+
+    def done(self, step: str) -> Optional[Checkpoint]:
+        for cp in self.checkpoints:
+            if cp.step == step:
+                return cp
+        return None
+
+    def commit(self, step: str, data: Optional[Dict] = None, size_only: Iterable[str] = ()):
+        # step is done, with the files now in the work dir. size_only: files that may change
+        # afterwards without being damaged (images mounted read-write), only their size is checked
+        size_only = {os.path.relpath(os.path.abspath(p), self.work_dir) for p in size_only}
+        previous = self.checkpoints[-1].files if self.checkpoints else {}
+        files = {}
+        artifacts = []
+        for p in self._files():
+            st = self._stat(p)
+            if st is None or self.preexisting.get(p) == st:
+                continue
+            known = previous.get(p)
+            if p in size_only:
+                files[p] = st + (None,)
+            elif known is not None and known[:2] == st:
+                files[p] = known
+            else:
+                artifacts.append(p)
+        for p, sha in self._hash_all(artifacts).items():
+            st = self._stat(p)
+            if sha is not None and st is not None:
+                files[p] = st + (sha,)
+        cp = Checkpoint(step, files, data or {})
+        with open(self.path, 'a') as out:
+            out.write(self._record(cp) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+        self.checkpoints.append(cp)
+        logger.info("journal: {} done, {} files, {} hashed".format(step, len(files), len(artifacts)))
+
+    def _intact(self, cp: Checkpoint) -> bool:
+        for p, (size, _, _) in cp.files.items():
+            try:
+                if os.path.getsize(join(self.work_dir, p)) != size:
+                    logger.warning("journal: {} of {} changed size".format(p, cp.step))
+                    return False
+            except OSError:
+                logger.warning("journal: {} of {} is missing".format(p, cp.step))
+                return False
+        hashes = self._hash_all([p for p, (_, _, sha) in cp.files.items() if sha is not None])
+        for p, sha in hashes.items():
+            if sha != cp.files[p][2]:
+                logger.warning("journal: {} of {} is corrupted".format(p, cp.step))
+                return False
+        return True
+
+    def resume(self) -> Optional[Checkpoint]:
+        # the last intact checkpoint, None to start from the beginning. The files that are not part
+        # of it (outputs of the interrupted step) are removed, those that were there before are left.
+        kept = None
+        for i in reversed(range(len(self.checkpoints))):
+            if self._intact(self.checkpoints[i]):
+                kept = i
+                break
+        if kept is None:
+            dropped, self.checkpoints = self.checkpoints, []
+            files = {}
+        else:
+            dropped, self.checkpoints = self.checkpoints[kept + 1:], self.checkpoints[:kept + 1]
+            files = self.checkpoints[-1].files
+        for p in self._files():
+            if p not in files and p not in self.preexisting:
+                # whatever was added since the interrupted run goes too, resume is opt-in for that
+                logger.warning("journal: removing {}, not part of {}".format(
+                    join(self.work_dir, p), self.checkpoints[-1].step if self.checkpoints else 'any completed step'))
+                os.remove(join(self.work_dir, p))
+        if len(dropped) > 0:
+            self._rewrite()
+        if kept is None:
+            return None
+        logger.info("journal: resuming {} after {}".format(self.work_dir, ' '.join(cp.step for cp in self.checkpoints)))
+        return self.checkpoints[-1]
@@ -0,0 +1,221 @@
+import hashlib
+import logging
+import os
+import re
+import struct
+import zlib
+
+from os.path import isfile, join
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from arx.fileio import COPY_CHUNK_SIZE
+from arx.partitions import PartitionFilter
+from arx.scheduler import job_pool
+
+logger = logging.getLogger('rom_analyzer')
+
+# LG firmwares: a KDZ is a table of files (the DZ, a dll, ...) followed by their data. A DZ is a
+# header then chunks: a header naming the partition, the target sector and the zlib data.
+KDZ_MAGICS = (b'\x34\x31\x25\x80', b'\x32\x79\x44\x50')  # at offset 4, after the header size
+KDZ_HEADER = struct.Struct('<I4s')
+KDZ_RECORD = struct.Struct('<256sQQ')  # name, length, offset
+DZ_MAGIC = b'\x32\x96\x18\x74'
+DZ_HEADER = struct.Struct('<4sIII32s144sI16s')  # magic, major, minor, reserved, model, version, chunks, md5
+DZ_HEADER_SIZE = 512
+DZ_CHUNK_MAGIC = b'\x30\x12\x95\x78'
+DZ_CHUNK_HEADER = struct.Struct('<4s32s64sII16sIIII')  # + target sector, trim count, device, crc32 since v1
+DZ_CHUNK_HEADER_SIZE = 512
+SECTOR_SIZE = 512
+UFS_SECTOR_SIZE = 4096
+_CHUNK_SECTOR = re.compile(r'_(\d+)\.bin$')
+
+
+class KdzError(Exception):
+    pass
+
+
+class KdzRecord(NamedTuple):
+    name: str
+    offset: int
+    length: int
+
+
+class DzChunk(NamedTuple):
+    partition: str
+    name: str
+    data_offset: int  # of the zlib data in the file
+    data_length: int
+    file_size: int  # uncompressed
+    sector: int  # target sector on the device
+    trim_count: int  # sectors wiped from sector on
+    md5: bytes  # of the zlib data
+
+
+def _str(raw: bytes) -> str:
+    return raw.split(b'\x00', 1)[0].decode(errors='replace').strip()
+
+
+class KdzReader:
+    # The file table of a KDZ, the DZ is then read in place (see DzReader)
+
+    def __init__(self, kdz: str):
+        assert isfile(kdz)
+        self.path = kdz
+        size = os.path.getsize(kdz)
+        with open(kdz, 'rb') as f:
+            header = f.read(KDZ_HEADER.size)
+            if len(header) < KDZ_HEADER.size:
+                raise KdzError(f'{kdz} is too short')
+            header_size, magic = KDZ_HEADER.unpack(header)
+            if magic not in KDZ_MAGICS:
+                raise KdzError(f'Bad magic {magic!r} in {kdz}')
+            table = f.read(header_size - KDZ_HEADER.size)
+        self.records = []
+        for pos in range(0, len(table) - KDZ_RECORD.size + 1, KDZ_RECORD.size):
+            name, length, offset = KDZ_RECORD.unpack_from(table, pos)
+            name = _str(name)
+            if name == '':
+                break
+            if offset + length > size:
+                raise KdzError(f'Truncated {name} in {kdz}')
+            self.records.append(KdzRecord(name, offset, length))
+        if len(self.records) == 0:
+            raise KdzError(f'No files in {kdz}')
+
+    def dz_records(self) -> List[KdzRecord]:
+        return [r for r in self.records if r.name.lower().endswith('.dz')]
+
+
+def _inflate_chunk(dz: str, chunk: DzChunk, out_file: str, out_offset: int, verify: bool) -> bool:
+    # Worker side: chunks are independent zlib streams, each is written at its own offset.
+    # False when the MD5 of the compressed data does not match.
+    in_fd = os.open(dz, os.O_RDONLY)
+    out_fd = os.open(out_file, os.O_WRONLY)
+    md5 = hashlib.md5()
+    inflater = zlib.decompressobj()
+    pos = out_offset
+    try:
+        done = 0
+        while done < chunk.data_length:
+            data = os.pread(in_fd, min(COPY_CHUNK_SIZE, chunk.data_length - done), chunk.data_offset + done)
+            if len(data) == 0:
+                raise KdzError(f'Truncated chunk {chunk.name}')
+            done += len(data)
+            if verify:
+                md5.update(data)
+            try:
+                out = inflater.decompress(data)
+            except zlib.error as e:
+                raise KdzError(f'Corrupted chunk {chunk.name}: {e}')
+            os.pwrite(out_fd, out, pos)
+            pos += len(out)
+        out = inflater.flush()
+        os.pwrite(out_fd, out, pos)
+        pos += len(out)
+    finally:
+        os.close(out_fd)
+        os.close(in_fd)
+    if pos - out_offset != chunk.file_size:
+        raise KdzError(f'Chunk {chunk.name} inflates to {pos - out_offset} bytes, not {chunk.file_size}')
+    return not verify or md5.digest() == chunk.md5
+
+
+class DzReader:
+    # DZ either as a file or inside a KDZ at offset
+
+    def __init__(self, dz: str, offset: int = 0):
+        assert isfile(dz)
+        self.path = dz
+        self.offset = offset
+        with open(dz, 'rb') as f:
+            f.seek(offset)
+            header = f.read(DZ_HEADER_SIZE)
+            if len(header) < DZ_HEADER_SIZE:
+                raise KdzError(f'{dz} is too short')
+            magic, self.major, self.minor, _, model, version, chunk_count, _ = DZ_HEADER.unpack_from(header)
+            if magic != DZ_MAGIC:
+                raise KdzError(f'Bad magic {magic!r} in {dz}')
+            self.model = _str(model)
+            self.version = _str(version)
+            # one pass over the chunk headers, the data is skipped
+            self.chunks = []
+            pos = offset + DZ_HEADER_SIZE
+            for _ in range(chunk_count):
+                f.seek(pos)
+                raw = f.read(DZ_CHUNK_HEADER_SIZE)
+                if len(raw) < DZ_CHUNK_HEADER_SIZE:
+                    raise KdzError(f'Truncated chunk header at {pos:#x} in {dz}')
+                magic, partition, name, data_length, file_size, md5, sector, trim_count, _, _ = \
+                    DZ_CHUNK_HEADER.unpack_from(raw)
+                if magic != DZ_CHUNK_MAGIC:
+                    raise KdzError(f'Bad chunk magic {magic!r} at {pos:#x} in {dz}')
+                name = _str(name)
+                # v0 chunks have no target sector, their name has it: system_4194304.bin
+                m = _CHUNK_SECTOR.search(name)
+                if m is not None:
+                    sector = int(m.group(1))
+                self.chunks.append(DzChunk(_str(partition), name, pos + DZ_CHUNK_HEADER_SIZE, data_length, file_size,
+                                           sector, trim_count, md5))
+                pos += DZ_CHUNK_HEADER_SIZE + data_length
+        if len(self.chunks) == 0:
+            raise KdzError(f'No chunks in {dz}')
+        self.sector_size = self._sector_size()
+
+    def _sector_size(self) -> int:
+        # UFS devices count 4096 bytes sectors: their chunks overlap the next one at 512
+        by_sector = sorted(self.chunks, key=lambda c: c.sector)
+        for c, succ in zip(by_sector, by_sector[1:]):
+            if c.partition == succ.partition and c.sector + -(-c.file_size // SECTOR_SIZE) > succ.sector:
+                return UFS_SECTOR_SIZE
+        return SECTOR_SIZE
+
+    @property
+    def partitions(self) -> List[str]:
+        ret = []
+        for c in self.chunks:
+            if c.partition not in ret:
+                ret.append(c.partition)
+        return ret
+
+    def select(self, partitions: Optional[Iterable[str]] = None) -> List[str]:
+        keep = PartitionFilter(partitions)
+        return [p for p in self.partitions if keep.wants_partition(p)]
+
+    def partition_chunks(self, partition: str) -> List[DzChunk]:
+        return [c for c in self.chunks if c.partition == partition]
+
+    def partition_size(self, partition: str) -> int:
+        chunks = self.partition_chunks(partition)
+        first = min(c.sector for c in chunks)
+        return max(max((c.sector - first) * self.sector_size + c.file_size,
+                       (c.sector - first + c.trim_count) * self.sector_size) for c in chunks)
+
+    def extract_all(self, dst_dir: str, partitions: Optional[Iterable[str]] = None, verify: bool = True,
+                    workers: int = 1) -> Dict[str, str]:
+        # workers: processes inflating the chunks (see job_pool). The images of the partitions with
+        # chunks whose MD5 doesn't match are removed, and KdzError raised.
+        os.makedirs(dst_dir, exist_ok=True)
+        selected = self.select(partitions)
+        extracted = {}
+        for p in selected:
+            out_file = join(dst_dir, p.replace(os.sep, '_') + '.img')
+            with open(out_file, 'wb') as out:
+                # sparse: the wiped sectors between the chunks stay holes
+                out.truncate(self.partition_size(p))
+            extracted[p] = out_file
+        # the chunks of every partition share the pool
+        with job_pool(workers) as pool:
+            jobs = []
+            for p in selected:
+                chunks = self.partition_chunks(p)
+                first = min(c.sector for c in chunks)
+                logger.info("extracting {} ({} bytes, {} chunks)".format(p, self.partition_size(p), len(chunks)))
+                for c in chunks:
+                    jobs.append((p, pool.submit(_inflate_chunk, self.path, c, extracted[p],
+                                                (c.sector - first) * self.sector_size, verify)))
+            bad = {p for p, job in jobs if not job.result()}
+        for p in bad:
+            os.remove(extracted.pop(p))
+        if len(bad) > 0:
+            raise KdzError('MD5 mismatch in {} of {}'.format(', '.join(sorted(bad)), self.path))
+        return extracted
@@ -1,11 +1,19 @@
 import os
 import logging
+import signal
 import sys
 
 from argparse import ArgumentParser
 from os.path import isfile, isdir
 
-from arx.androidromextractor import unpack_and_mount
+from arx.androidromextractor import unpack_and_mount, RESULT_MOUNT, RESULT_FILESYSTEM
+from arx.batch import load_batch, run_batch
+from arx.cache import ExtractionCache
+from arx.commands import set_max_tools
+from arx.imagefs import ImageFileSystem
+from arx.inventory import write_inventory
+from arx.mounts import DEFAULT_MAX_MOUNTS, MountManager
+from arx.telemetry import Recorder, CATEGORY_STEP, optional_span
 
 
 # create logger with 'rom_analyzer'
@@ -24,8 +32,46 @@ logger.addHandler(ch)
 if __name__ == "__main__":
     parser = ArgumentParser(description="AndroidROMeXtractor")
     parser.add_argument('-o', '--output', dest='dstfolder', help='Output folder')
-    requiredNamed = parser.add_argument_group('required named arguments')
-    requiredNamed.add_argument('-i', '--input', dest='romfilepath', help='Input ROM file', required=True)
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, help='Max parallel extraction jobs (default: CPU count)')
+    parser.add_argument('-p', '--parallel-roms', dest='parallel_roms', type=int, default=2,
+                        help='Batch mode: ROMs processed concurrently (default: 2)')
+    parser.add_argument('-r', '--results', dest='results', help='Batch mode: JSON lines results file')
+    parser.add_argument('--cache-dir', dest='cache_dir', help='Cache extraction results in this folder')
+    parser.add_argument('--cache-size', dest='cache_size', type=float, default=100,
+                        help='Cache size limit in GB (default: 100)')
+    parser.add_argument('--cache-intermediates', dest='cache_intermediates', action='store_true',
+                        help='Also cache sdat2img and sparse conversions, keyed by their inputs')
+    parser.add_argument('--partitions', dest='partitions',
+                        help='Comma separated partitions to extract, e.g. system,vendor,product,boot (default: all)')
+    parser.add_argument('--no-mount', dest='no_mount', action='store_true',
+                        help='Read the filesystem images in userspace instead of mounting them (no privileges needed)')
+    parser.add_argument('--virtual-splits', dest='virtual_splits', action='store_true',
+                        help='With --no-mount, read split images (system_1.img, system_2.img, ...) in place '
+                             'instead of concatenating them')
+    parser.add_argument('--report', dest='report', action='store_true',
+                        help='Write a JSON report of the time and resources taken by each stage and command')
+    parser.add_argument('--trace', dest='trace', action='store_true',
+                        help='Write a Chrome trace (chrome://tracing, Perfetto) of the extraction')
+    parser.add_argument('--keep-intermediates', dest='keep_intermediates', action='store_true',
+                        help='Keep the archives, compressed and sparse images once they are converted')
+    parser.add_argument('--disk-budget', dest='disk_budget', type=float,
+                        help='Disk space in GB the work folder of a ROM may take: jobs wait for room, or fail')
+    parser.add_argument('--inventory', dest='inventory', action='store_true',
+                        help='Write a SQLite manifest of the extracted files with their sha256 and ssdeep hashes')
+    parser.add_argument('--read-write', dest='read_write', action='store_true',
+                        help='Mount the images read-write (journals are replayed beforehand) instead of read-only')
+    parser.add_argument('--max-mounts', dest='max_mounts', type=int, default=DEFAULT_MAX_MOUNTS,
+                        help='Loop devices mounted at once, among all the ROMs (default: {})'.format(DEFAULT_MAX_MOUNTS))
+    parser.add_argument('--yaffs-paths', dest='yaffs_paths',
+                        help='Comma separated files and folders to extract from YAFFS2 images, '
+                             'e.g. /app,/framework,/build.prop (default: all)')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='Journal the completed steps in the output folder, and resume a previous run there: '
+                             'the files added to it since then are removed')
+    requiredNamed = parser.add_argument_group('required named arguments (one of)')
+    inputs = requiredNamed.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-i', '--input', dest='romfilepath', help='Input ROM file')
+    inputs.add_argument('-b', '--batch', dest='batch', help='Directory of ROMs, or manifest file with one ROM per line')
     args = parser.parse_args()
 
     in_file = args.romfilepath
@@ -36,12 +82,69 @@ if __name__ == "__main__":
     dst_dir = args.dstfolder
     if dst_dir is not None and not isdir(dst_dir):
         os.makedirs(dst_dir, exist_ok=True)
-    logger.info('>>> BEGIN [unpack&mount]')
-    result = unpack_and_mount(in_file, dst_dir)
-    logger.info('<<< END [unpack&mount]')
-    logger.info(result)
-    for v in result.values():
-        if isdir(v):
-            logger.info(f'$ ls {v}')
-            logger.info(os.listdir(v))
+
+    partitions = None
+    if args.partitions is not None:
+        partitions = [p for p in args.partitions.split(',') if p.strip() != '']
+    yaffs_paths = None
+    if args.yaffs_paths is not None:
+        yaffs_paths = [p for p in args.yaffs_paths.split(',') if p.strip() != '']
+
+    disk_budget = None
+    if args.disk_budget is not None:
+        disk_budget = int(args.disk_budget * 1024 ** 3)
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = ExtractionCache(args.cache_dir, int(args.cache_size * 1024 ** 3), args.cache_intermediates)
+
+    if args.batch is not None:
+        if dst_dir is None:
+            sys.exit("Batch mode needs an output folder")
+        roms = load_batch(args.batch)
+        results_file = args.results if args.results is not None else os.path.join(dst_dir, 'results.jsonl')
+        logger.info('>>> BEGIN [batch] {} ROMs -> {}'.format(len(roms), results_file))
+        results = run_batch(roms, dst_dir, results_file, args.parallel_roms, args.jobs, cache=cache,
+                            partitions=partitions, report=args.report, trace=args.trace,
+                            keep_intermediates=args.keep_intermediates, disk_budget=disk_budget,
+                            resume=args.resume, inventory=args.inventory, read_only=not args.read_write,
+                            max_mounts=args.max_mounts,
+                            result_mode=RESULT_FILESYSTEM if args.no_mount else RESULT_MOUNT,
+                            virtual_splits=args.virtual_splits, yaffs_paths=yaffs_paths)
+        logger.info('<<< END [batch] {} ok, {} failed'.format(
+            sum(1 for r in results if r['status'] == 'ok'), sum(1 for r in results if r['status'] != 'ok')))
+        sys.exit()
+
+    # killed (docker stop, ...): leave through the with block, which unmounts everything
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    recorder = Recorder() if args.report or args.trace else None
+    # as many external tools at once as jobs, stage workers included
+    set_max_tools(args.jobs or os.cpu_count() or 1)
+    with MountManager(read_only=not args.read_write, max_mounts=args.max_mounts) as mounts:
+        logger.info('>>> BEGIN [unpack&mount]')
+        result = unpack_and_mount(in_file, dst_dir, max_workers=args.jobs, cache=cache, partitions=partitions,
+                                  result_mode=RESULT_FILESYSTEM if args.no_mount else RESULT_MOUNT, recorder=recorder,
+                                  keep_intermediates=args.keep_intermediates, disk_budget=disk_budget,
+                                  virtual_splits=args.virtual_splits, resume=args.resume, mounts=mounts,
+                                  yaffs_paths=yaffs_paths)
+        logger.info('<<< END [unpack&mount]')
+        report_dir = dst_dir if dst_dir is not None else os.getcwd()
+        if args.inventory:
+            with optional_span(recorder, 'inventory', CATEGORY_STEP):
+                write_inventory(result, os.path.join(report_dir, 'inventory.sqlite'), args.jobs, rom=in_file)
+            logger.info('Inventory: {}'.format(os.path.join(report_dir, 'inventory.sqlite')))
+        if args.report:
+            recorder.write_report(os.path.join(report_dir, 'report.json'), rom=in_file)
+            logger.info('Report: {}'.format(os.path.join(report_dir, 'report.json')))
+        if args.trace:
+            recorder.write_chrome_trace(os.path.join(report_dir, 'trace.json'))
+            logger.info('Trace: {}'.format(os.path.join(report_dir, 'trace.json')))
+        logger.info(result)
+        for v in result.values():
+            if isinstance(v, ImageFileSystem):
+                logger.info(f'$ ls {v.path}')
+                logger.info(v.listdir('/'))
+            elif isdir(v):
+                logger.info(f'$ ls {v}')
+                logger.info(os.listdir(v))
     logger.info('-- End ---')
@@ -0,0 +1,140 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from os.path import isdir, join
+from typing import List, Optional, Tuple
+
+from arx.ext4 import has_journal
+from arx.shell_wrapper import mount, umount
+from arx.slots import Slots
+
+logger = logging.getLogger('rom_analyzer')
+
+# loop devices are shared by the whole host: the processes using the same slots folder (the
+# ROMs of a batch, ...) hold at most max_mounts of them at once
+LOOP_SLOTS_DIR = '/tmp/arx-loop-slots'
+DEFAULT_MAX_MOUNTS = 32
+UMOUNT_RETRIES = 3
+UMOUNT_RETRY_SECONDS = 1.0
+
+
+class MountError(Exception):
+
+    def __init__(self, image: str, mnt_point: Optional[str], reason: str):
+        super().__init__('{}: {}{}'.format(image, reason, ' on {}'.format(mnt_point) if mnt_point else ''))
+        self.image = image
+        self.mnt_point = mnt_point
+        self.reason = reason
+
+
+def mount_options(image: str, read_only: bool) -> str:
+    if not read_only:
+        return 'loop'
+    options = ['loop', 'ro', 'noatime']
+    if has_journal(image):
+        # no journal replay: nothing is written, and no resize2fs repair is needed before
+        options.append('noload')
+    return ','.join(options)
+
+
+class MountManager:
+    # Mounts the images of unpack_and_mount results, read-only unless read_only is False, with at
+    # most max_mounts loop devices at once (None: no limit). close() (or leaving the with block)
+    # unmounts everything, removes the mount points and closes the filesystem handles tracked
+    # with track(), even after an error.
+
+    def __init__(self, read_only: bool = True, max_mounts: Optional[int] = DEFAULT_MAX_MOUNTS,
+                 slots_dir: str = LOOP_SLOTS_DIR):
+        self.read_only = read_only
+        self.max_mounts = max_mounts
+        self._slots = Slots(max_mounts, slots_dir) if max_mounts is not None else None
+        self._mounts: List[Tuple[str, str, Optional[str]]] = []  # image, mount point, slot
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def mount(self, image: str, parent_dir: str) -> str:
+        # the new mount point, in parent_dir
+        assert isdir(parent_dir)
+        slot = None
+        if self._slots is not None:
+            with self._lock:
+                if len(self._mounts) >= self.max_mounts:
+                    # waiting would be for our own mounts
+                    raise MountError(image, None, 'already {} mounts, the most at once'.format(self.max_mounts))
+            slot = self._slots.acquire(os.path.basename(image))
+        mnt_point = None
+        try:
+            mnt_point = tempfile.mkdtemp(dir=parent_dir)
+            options = mount_options(image, self.read_only)
+            if not mount(image, mnt_point, options):
+                raise MountError(image, mnt_point, 'mount -o {} failed'.format(options))
+        except BaseException:
+            if mnt_point is not None:
+                os.rmdir(mnt_point)
+            if slot is not None:
+                self._slots.release(slot)
+            raise
+        with self._lock:
+            self._mounts.append((image, mnt_point, slot))
+        return mnt_point
+
+    def image_of(self, mnt_point: str) -> Optional[str]:
+        # the image mounted on mnt_point by this manager, None if none is
+        with self._lock:
+            return next((i for i, m, _ in self._mounts if m == mnt_point), None)
+
+    def track(self, handle):
+        # an ImageFileSystem (or anything with close()) of the result
+        with self._lock:
+            self._handles.append(handle)
+
+    def unmount(self, mnt_point: str):
+        with self._lock:
+            entry = next((m for m in self._mounts if m[1] == mnt_point), None)
+            if entry is None:
+                raise MountError('?', mnt_point, 'not mounted here')
+            self._mounts.remove(entry)
+        image, _, slot = entry
+        try:
+            self._unmount(image, mnt_point)
+        finally:
+            if slot is not None:
+                self._slots.release(slot)
+
+    @staticmethod
+    def _unmount(image: str, mnt_point: str):
+        for _ in range(UMOUNT_RETRIES):
+            if umount(mnt_point) or not os.path.ismount(mnt_point):
+                break
+            # e.g. still busy with files an analysis left open
+            time.sleep(UMOUNT_RETRY_SECONDS)
+        else:
+            # the loop device goes once the last file is closed
+            if not umount(mnt_point, lazy=True):
+                raise MountError(image, mnt_point, 'umount failed')
+        os.rmdir(mnt_point)
+
+    def close(self) -> List[Exception]:
+        # last mounted first, the errors are logged and returned
+        errors = []
+        with self._lock:
+            handles, self._handles = self._handles, []
+            mnt_points = [m for _, m, _ in reversed(self._mounts)]
+        for h in handles:
+            h.close()
+        for m in mnt_points:
+            try:
+                self.unmount(m)
+            except (MountError, OSError) as e:
+                logger.error("mounts: {}".format(e))
+                errors.append(e)
+        return errors
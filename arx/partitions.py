@@ -0,0 +1,62 @@
+import re
+
+from os.path import basename
+from typing import Iterable, Optional
+
+# extensions of the files that hold (part of) a partition image, in any stage of the extraction
+IMAGE_EXTENSIONS = ('.img', '.br', '.lz4', '.dat', '.new', '.patch', '.list', '.transfer', '.sin', '.unsparse',
+                    '.ext4', '.ext2', '.image', '.raw', '.tmp', '.yaffs2', '.sparse')
+# images holding other partitions (dynamic partitions): never filtered out
+CONTAINER_PARTITIONS = frozenset(('super',))
+_SPARSECHUNK = re.compile(r'(\.img)?_sparsechunk\.\d+$')
+_SONY_SUFFIX = re.compile(r'_x-flash-.*$')
+_SPLIT_PART = re.compile(r'_\d+x?$')
+_AB_SLOT = re.compile(r'_[ab]$')
+
+
+def is_partition_image(file_name: str) -> bool:
+    name = basename(file_name).lower()
+    return name.endswith(IMAGE_EXTENSIONS) or _SPARSECHUNK.search(name) is not None
+
+
+def partition_of(file_name: str) -> str:
+    # system.new.dat.br, system.transfer.list, system_2.img, system.img_sparsechunk.3,
+    # system.img.ext4.lz4, system-sign.img, SYSTEM (UPDATE.APP), system_a, ... -> system
+    name = _SPARSECHUNK.sub('', basename(file_name).lower())
+    stripped = True
+    while stripped:
+        stripped = False
+        for ext in IMAGE_EXTENSIONS:
+            if name.endswith(ext) and len(name) > len(ext):
+                name = name[:-len(ext)]
+                stripped = True
+    name = _SONY_SUFFIX.sub('', name)
+    if name.endswith('-sign'):
+        name = name[:-len('-sign')]
+    name = _SPLIT_PART.sub('', name)
+    return _AB_SLOT.sub('', name)
+
+
+class PartitionFilter:
+    # Tells whether a file is needed to materialize the selected partitions: partition images are
+    # kept only if selected, every other file (archives, payload.bin, UPDATE.APP, xml, ...) is kept.
+    # A class rather than a closure so that it can be sent to worker processes.
+
+    def __init__(self, partitions: Optional[Iterable[str]] = None, exclude: Iterable[str] = ()):
+        # exclude: base names of files already handled elsewhere, e.g. a payload.bin read in place
+        self.partitions = None if partitions is None else frozenset(p.strip().lower() for p in partitions)
+        self.exclude = frozenset(exclude)
+
+    def __bool__(self) -> bool:
+        return self.partitions is not None or len(self.exclude) > 0
+
+    def wants_partition(self, partition: str) -> bool:
+        if self.partitions is None:
+            return True
+        partition = partition_of(partition)
+        return partition in self.partitions or partition in CONTAINER_PARTITIONS
+
+    def __call__(self, file_name: str) -> bool:
+        if basename(file_name) in self.exclude:
+            return False
+        return not is_partition_image(file_name) or self.wants_partition(file_name)
@@ -0,0 +1,294 @@
+import bz2
+import hashlib
+import logging
+import lzma
+import os
+import shutil
+import struct
+import subprocess
+
+from os.path import isfile, join
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from arx.partitions import PartitionFilter
+from arx.scheduler import job_pool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger('rom_analyzer')
+
+# A/B OTA payload, see update_engine/update_metadata.proto
+PAYLOAD_MAGIC = b'CrAU'
+PAYLOAD_HEADER = struct.Struct('>4sQQ')
+METADATA_SIGNATURE_SIZE = struct.Struct('>I')
+DEFAULT_BLOCK_SIZE = 4096
+# operations are sent to the workers in batches of about this much payload data
+BATCH_DATA_SIZE = 64 * 1024 * 1024
+
+OP_REPLACE = 0
+OP_REPLACE_BZ = 1
+OP_ZERO = 6
+OP_DISCARD = 7
+OP_REPLACE_XZ = 8
+OP_REPLACE_ZSTD = 14
+OP_NAMES = {0: 'REPLACE', 1: 'REPLACE_BZ', 2: 'MOVE', 3: 'BSDIFF', 4: 'SOURCE_COPY', 5: 'SOURCE_BSDIFF', 6: 'ZERO',
+            7: 'DISCARD', 8: 'REPLACE_XZ', 9: 'PUFFDIFF', 10: 'BROTLI_BSDIFF', 11: 'ZUCCHINI',
+            12: 'LZ4DIFF_BSDIFF', 13: 'LZ4DIFF_PUFFDIFF', 14: 'REPLACE_ZSTD'}
+
+# command line decoder, used when the Python bindings are not installed
+ZSTD_COMMAND = ['zstd', '--decompress', '--stdout']
+
+WIRE_VARINT = 0
+WIRE_64BIT = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_32BIT = 5
+
+
+class PayloadError(Exception):
+    pass
+
+
+class InstallOperation(NamedTuple):
+    type: int
+    data_offset: int  # relative to the data blob
+    data_length: int
+    dst_extents: Tuple[Tuple[int, int], ...]  # (start block, number of blocks)
+    data_sha256: bytes
+
+
+class PartitionUpdate(NamedTuple):
+    name: str
+    size: int
+    operations: List[InstallOperation]
+
+    @property
+    def file_name(self) -> str:
+        return self.name + '.img'
+
+
+def _varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise PayloadError('Truncated varint')
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _fields(buf: bytes):
+    # (field number, value) of a protobuf message: ints for scalars, bytes for embedded messages and strings
+    pos = 0
+    while pos < len(buf):
+        key, pos = _varint(buf, pos)
+        wire_type = key & 0x7
+        if wire_type == WIRE_VARINT:
+            value, pos = _varint(buf, pos)
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            length, pos = _varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == WIRE_64BIT:
+            value = struct.unpack_from('<Q', buf, pos)[0]
+            pos += 8
+        elif wire_type == WIRE_32BIT:
+            value = struct.unpack_from('<I', buf, pos)[0]
+            pos += 4
+        else:
+            raise PayloadError(f'Unsupported wire type {wire_type}')
+        if pos > len(buf):
+            raise PayloadError('Truncated message')
+        yield key >> 3, value
+
+
+def _parse_extent(buf: bytes) -> Tuple[int, int]:
+    start_block = num_blocks = 0
+    for field, value in _fields(buf):
+        if field == 1:
+            start_block = value
+        elif field == 2:
+            num_blocks = value
+    return start_block, num_blocks
+
+
+def _parse_operation(buf: bytes) -> InstallOperation:
+    op_type = data_offset = data_length = 0
+    dst_extents = []
+    data_sha256 = b''
+    for field, value in _fields(buf):
+        if field == 1:
+            op_type = value
+        elif field == 2:
+            data_offset = value
+        elif field == 3:
+            data_length = value
+        elif field == 6:
+            dst_extents.append(_parse_extent(value))
+        elif field == 8:
+            data_sha256 = value
+    return InstallOperation(op_type, data_offset, data_length, tuple(dst_extents), data_sha256)
+
+
+def _parse_partition(buf: bytes) -> PartitionUpdate:
+    name = ''
+    size = 0
+    operations = []
+    for field, value in _fields(buf):
+        if field == 1:
+            name = value.decode(errors='replace')
+        elif field == 7:  # new_partition_info
+            for info_field, info_value in _fields(value):
+                if info_field == 1:
+                    size = info_value
+        elif field == 8:
+            operations.append(_parse_operation(value))
+    return PartitionUpdate(name, size, operations)
+
+
+def _zstd_supported() -> bool:
+    return zstandard is not None or shutil.which(ZSTD_COMMAND[0]) is not None
+
+
+def _zstd_decompress(data: bytes, size: int) -> bytes:
+    # size: of the operation output
+    if zstandard is not None:
+        try:
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+        except zstandard.ZstdError as e:
+            raise ValueError(str(e))
+    result = subprocess.run(ZSTD_COMMAND, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise ValueError(result.stderr.decode(errors='replace').strip())
+    return result.stdout
+
+
+def _apply_operations(payload: str, blob_offset: int, block_size: int, out_file: str,
+                      operations: List[InstallOperation], verify: bool) -> List[int]:
+    # Process pool worker, returns the indexes in operations whose data does not match its hash
+    bad = []
+    in_fd = os.open(payload, os.O_RDONLY)
+    out_fd = os.open(out_file, os.O_WRONLY)
+    try:
+        for i, op in enumerate(operations):
+            if op.type in (OP_ZERO, OP_DISCARD):
+                # the output is preallocated sparse, zeroed blocks are already holes
+                continue
+            data = os.pread(in_fd, op.data_length, blob_offset + op.data_offset)
+            if len(data) != op.data_length:
+                raise PayloadError(f'Truncated payload data at {op.data_offset:#x}')
+            if verify and op.data_sha256 and hashlib.sha256(data).digest() != op.data_sha256:
+                # the partition fails, no use decoding it
+                bad.append(i)
+                continue
+            try:
+                if op.type == OP_REPLACE_XZ:
+                    data = lzma.decompress(data)
+                elif op.type == OP_REPLACE_BZ:
+                    data = bz2.decompress(data)
+                elif op.type == OP_REPLACE_ZSTD:
+                    data = _zstd_decompress(data, sum(n for _, n in op.dst_extents) * block_size)
+            except (lzma.LZMAError, OSError, ValueError) as e:
+                raise PayloadError(f'Corrupted data at {op.data_offset:#x}: {e}')
+            pos = 0
+            for start_block, num_blocks in op.dst_extents:
+                length = num_blocks * block_size
+                os.pwrite(out_fd, data[pos:pos + length], start_block * block_size)
+                pos += length
+    finally:
+        os.close(out_fd)
+        os.close(in_fd)
+    return bad
+
+
+class PayloadReader:
+    # payload.bin of a full A/B OTA, either as a file or stored (not deflated) in a zip at offset
+
+    def __init__(self, payload: str, offset: int = 0):
+        assert isfile(payload)
+        self.path = payload
+        self.offset = offset
+        with open(payload, 'rb') as f:
+            f.seek(offset)
+            header = f.read(PAYLOAD_HEADER.size)
+            if len(header) < PAYLOAD_HEADER.size:
+                raise PayloadError(f'{payload} is too short')
+            magic, version, manifest_size = PAYLOAD_HEADER.unpack(header)
+            if magic != PAYLOAD_MAGIC:
+                raise PayloadError(f'Bad magic {magic!r} in {payload}')
+            signature_size = 0
+            if version >= 2:
+                signature_size = METADATA_SIGNATURE_SIZE.unpack(f.read(METADATA_SIGNATURE_SIZE.size))[0]
+            manifest = f.read(manifest_size)
+            if len(manifest) < manifest_size:
+                raise PayloadError(f'Truncated manifest in {payload}')
+            self.data_offset = f.tell() + signature_size
+        self.version = version
+        self.block_size = DEFAULT_BLOCK_SIZE
+        self.partitions = []
+        for field, value in _fields(manifest):
+            if field == 3:
+                self.block_size = value
+            elif field == 13:
+                self.partitions.append(_parse_partition(value))
+        if len(self.partitions) == 0:
+            raise PayloadError(f'No partitions in {payload} (not an A/B payload?)')
+
+    def select(self, partitions: Optional[Iterable[str]] = None) -> List[PartitionUpdate]:
+        keep = PartitionFilter(partitions)
+        return [p for p in self.partitions if keep.wants_partition(p.name)]
+
+    def _batches(self, partition: PartitionUpdate):
+        batch = []
+        batch_size = 0
+        for op in partition.operations:
+            if op.type == OP_REPLACE_ZSTD and not _zstd_supported():
+                raise PayloadError('REPLACE_ZSTD operation in {}: needs the zstandard module or {}'.format(
+                    partition.name, ZSTD_COMMAND[0]))
+            if op.type not in (OP_REPLACE, OP_REPLACE_BZ, OP_REPLACE_XZ, OP_REPLACE_ZSTD, OP_ZERO, OP_DISCARD):
+                raise PayloadError('{} operation in {}: incremental OTAs are not supported'.format(
+                    OP_NAMES.get(op.type, op.type), partition.name))
+            batch.append(op)
+            batch_size += op.data_length
+            if batch_size >= BATCH_DATA_SIZE:
+                yield batch
+                batch = []
+                batch_size = 0
+        if len(batch) > 0:
+            yield batch
+
+    def extract_all(self, dst_dir: str, partitions: Optional[Iterable[str]] = None, verify: bool = True,
+                    workers: int = 1) -> Dict[str, str]:
+        # workers: processes applying the operations (see job_pool). The images of the partitions
+        # with operations whose data doesn't match its SHA-256 are removed, and PayloadError raised.
+        os.makedirs(dst_dir, exist_ok=True)
+        selected = self.select(partitions)
+        # unsupported operations fail before anything is written
+        batches = [(p, list(self._batches(p))) for p in selected]
+        extracted = {}
+        for p in selected:
+            out_file = join(dst_dir, p.file_name)
+            size = p.size or self.block_size * max((s + n for op in p.operations for s, n in op.dst_extents), default=0)
+            with open(out_file, 'wb') as out:
+                out.truncate(size)
+            extracted[p.name] = out_file
+        # batches of every partition share the pool, the biggest partition does not run alone at the end
+        with job_pool(workers) as pool:
+            jobs = []
+            for p, p_batches in batches:
+                logger.info("extracting {} ({} bytes, {} operations)".format(p.file_name, p.size, len(p.operations)))
+                for batch in p_batches:
+                    jobs.append((p, pool.submit(_apply_operations, self.path, self.data_offset, self.block_size,
+                                                extracted[p.name], batch, verify)))
+            bad = {p.name for p, job in jobs if job.result()}
+        for name in bad:
+            os.remove(extracted.pop(name))
+        if len(bad) > 0:
+            raise PayloadError('SHA-256 mismatch in {} of {}'.format(', '.join(sorted(bad)), self.path))
+        return extracted
@@ -0,0 +1,100 @@
+import logging
+import os
+import xml.etree.ElementTree as ET
+
+from collections import defaultdict
+from os.path import isfile, join
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from arx.fileio import copy_range
+from arx.partitions import PartitionFilter
+
+logger = logging.getLogger('rom_analyzer')
+
+DEFAULT_SECTOR_SIZE = 512
+# vendor variants of the former combine_unsparse.sh: they only differ in the trailing padding
+LAYOUTS = ('huawei', 'huawei2', 'lenovo', 'lenovo2', 'zte')
+
+
+class RawProgramPiece(NamedTuple):
+    filename: str
+    start_sector: int
+    num_sectors: int
+    sector_size: int
+
+
+def parse_rawprogram(rawprogram_xml: str) -> Dict[str, List[RawProgramPiece]]:
+    partitions = defaultdict(list)
+    for e in ET.parse(rawprogram_xml).findall("program"):
+        attribs = e.attrib
+        filename = attribs.get("filename")
+        if not filename:
+            continue
+        try:
+            piece = RawProgramPiece(
+                filename,
+                int(attribs["start_sector"].rstrip('.')),
+                int(attribs["num_partition_sectors"]),
+                int(attribs.get("SECTOR_SIZE_IN_BYTES", DEFAULT_SECTOR_SIZE)))
+        except ValueError:
+            # e.g. start_sector="NUM_DISK_SECTORS-33."
+            continue
+        partitions[attribs["label"]].append(piece)
+    for pieces in partitions.values():
+        pieces.sort(key=lambda p: p.start_sector)
+    return partitions
+
+
+def guess_layout(pieces: List[RawProgramPiece]) -> str:
+    return 'huawei' if '.unsparse' in pieces[0].filename else 'huawei2'
+
+
+def assemble_partition(work_dir: str, label: str, pieces: List[RawProgramPiece], layout: Optional[str] = None) -> str:
+    # Every piece is copied at its sector offset into a single output, the gaps between pieces
+    # are left as holes instead of being written out as zero files.
+    assert len(pieces) > 0
+    layout = guess_layout(pieces) if layout is None else layout
+    assert layout in LAYOUTS
+    base = pieces[0].start_sector
+    out_img = join(work_dir, label + '.img')
+    out_fd = os.open(out_img, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        size = 0
+        for p in pieces:
+            src = join(work_dir, p.filename)
+            if not isfile(src):
+                raise FileNotFoundError(src)
+            offset = (p.start_sector - base) * p.sector_size
+            length = os.path.getsize(src)
+            with open(src, 'rb') as f:
+                copy_range(f.fileno(), 0, out_fd, offset, length)
+            size = max(size, offset + length)
+        # same trailing padding as combine_unsparse.sh, but as a hole
+        if layout == 'zte' or label != 'system':
+            size *= 2
+        else:
+            size += pieces[0].num_sectors * pieces[0].sector_size
+        os.ftruncate(out_fd, size)
+    finally:
+        os.close(out_fd)
+    return out_img
+
+
+def assembled_pieces(rawprogram_xml: str, partitions: Optional[Iterable[str]] = None) -> List[str]:
+    # the piece files assemble_rawprogram joins, they are not needed once it is done
+    work_dir = os.path.dirname(rawprogram_xml)
+    keep = PartitionFilter(partitions)
+    return [join(work_dir, p.filename) for label, pieces in parse_rawprogram(rawprogram_xml).items()
+            if len(pieces) > 1 and keep.wants_partition(label) for p in pieces if p.filename != label + '.img']
+
+
+def assemble_rawprogram(rawprogram_xml: str, layout: Optional[str] = None,
+                        partitions: Optional[Iterable[str]] = None) -> List[str]:
+    work_dir = os.path.dirname(rawprogram_xml)
+    keep = PartitionFilter(partitions)
+    images = []
+    for label, pieces in parse_rawprogram(rawprogram_xml).items():
+        if len(pieces) > 1 and keep.wants_partition(label):
+            logger.info("rawprogram: assembling {} from {} pieces".format(label, len(pieces)))
+            images.append(assemble_partition(work_dir, label, pieces, layout))
+    return images
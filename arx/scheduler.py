@@ -0,0 +1,171 @@
+import logging
+import os
+import threading
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, Future, as_completed
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from arx.scratch import ScratchSpace
+from arx.telemetry import Recorder, CATEGORY_STAGE, job_name, optional_span, traced_submit
+from arx.workdir_index import WorkDirIndex
+
+logger = logging.getLogger('rom_analyzer')
+
+RESOURCE_CPU = 'cpu'
+RESOURCE_DISK = 'disk'
+DEFAULT_DISK_JOBS = 2
+
+
+class Stage(NamedTuple):
+    name: str
+    inputs: Tuple[str, ...]  # file name patterns looked up in the work directory index
+    method: Callable[[str], bool]  # per input file job, must be picklable
+    resource: str = RESOURCE_CPU
+    after: Tuple[str, ...] = ()  # stages whose outputs may be inputs of this one
+    output_dir: Optional[str] = None  # where the jobs write, when it is not next to their input
+    consumes: Optional[Callable[[str], List[str]]] = None  # files no longer needed once the job of an input succeeded
+    estimate: Optional[Callable[[str], int]] = None  # bytes the job of an input is expected to write
+
+
+def default_limits(max_workers: int) -> Dict[str, int]:
+    return {RESOURCE_CPU: max_workers, RESOURCE_DISK: min(max_workers, DEFAULT_DISK_JOBS)}
+
+
+class InlineExecutor(Executor):
+    # runs each job in the calling process as it is submitted
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        fut = Future()
+        try:
+            fut.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            fut.set_exception(e)
+        return fut
+
+
+def job_pool(workers: int = 1) -> Executor:
+    # for the jobs a job splits its work into (payload operations, checksums, ...): a stage job
+    # already holds one of the -j workers of the scheduler, so by default they run in it
+    return InlineExecutor() if workers <= 1 else ProcessPoolExecutor(max_workers=workers)
+
+
+class StageScheduler:
+    # Runs a graph of stages: a stage starts when the stages it comes after are done, its per-file
+    # jobs go to a bounded process pool, and concurrent jobs are capped per resource class.
+
+    def __init__(self, index: WorkDirIndex, max_workers: Optional[int] = None, limits: Optional[Dict[str, int]] = None,
+                 select: Optional[Callable[[str], bool]] = None, recorder: Optional[Recorder] = None,
+                 scratch: Optional[ScratchSpace] = None):
+        self.index = index
+        self.select = select
+        self.recorder = recorder
+        self.scratch = scratch
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.limits = default_limits(self.max_workers) if limits is None else limits
+        self._semaphores = {r: threading.BoundedSemaphore(n) for r, n in self.limits.items()}
+        self._index_lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self):
+        self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self
+
+    def __exit__(self, *args):
+        self._pool.shutdown(wait=True)
+        self._pool = None
+
+    def submit(self, resource: str, fn: Callable, *args, reserve: int = 0) -> Future:
+        # reserve: bytes the job will write, it waits for them to fit in the scratch space budget
+        assert self._pool is not None
+        if self.scratch is not None:
+            self.scratch.reserve(reserve, '{}({})'.format(job_name(fn), ', '.join(str(a) for a in args)))
+        sem = self._semaphores[resource]
+        sem.acquire()
+
+        def done(_):
+            sem.release()
+            if self.scratch is not None:
+                self.scratch.release(reserve)
+
+        try:
+            if self.recorder is not None:
+                fut = traced_submit(self._pool.submit, self.recorder, job_name(fn), fn, *args)
+            else:
+                fut = self._pool.submit(fn, *args)
+        except Exception:
+            done(None)
+            raise
+        fut.add_done_callback(done)
+        return fut
+
+    def map(self, resource: str, fn: Callable, items: Iterable[Any],
+            estimate: Optional[Callable[[Any], int]] = None) -> List[Any]:
+        futures = [self.submit(resource, fn, item, reserve=estimate(item) if estimate else 0) for item in items]
+        return [f.result() for f in futures]
+
+    def starmap(self, resource: str, fn: Callable, items: Iterable[Tuple],
+                estimate: Optional[Callable[..., int]] = None) -> List[Any]:
+        futures = [self.submit(resource, fn, *item, reserve=estimate(*item) if estimate else 0) for item in items]
+        return [f.result() for f in futures]
+
+    def consume(self, paths: Iterable[str]):
+        if self.scratch is not None:
+            with self._index_lock:
+                self.scratch.consume(paths)
+
+    def find_inputs(self, stage: Stage) -> List[str]:
+        with self._index_lock:
+            files = []
+            for pattern in stage.inputs:
+                files.extend(self.index.findw(pattern) or [])
+        if self.select is not None:
+            files = [f for f in files if self.select(f)]
+        return files
+
+    def refresh(self, directories: Iterable[str]):
+        with self._index_lock:
+            for d in set(directories):
+                self.index.refresh(d)
+
+    def run_stage(self, stage: Stage, deps: List[Future]):
+        for d in deps:
+            d.result()
+        inputs = self.find_inputs(stage)
+        if len(inputs) == 0:
+            return
+        logger.info("stage {}: {} input(s)".format(stage.name, len(inputs)))
+        with optional_span(self.recorder, stage.name, CATEGORY_STAGE, inputs=inputs):
+            futures = {self.submit(stage.resource, stage.method, f, reserve=stage.estimate(f) if stage.estimate else 0): f
+                       for f in inputs}
+            failed = []
+            # the inputs of a job go as soon as it is done, not when the whole stage is
+            for fut in as_completed(futures):
+                if not fut.result():
+                    failed.append(futures[fut])
+                elif stage.consumes is not None:
+                    self.consume(stage.consumes(futures[fut]))
+        # the extractors write next to their input (or in a subfolder of it)
+        dirs = [os.path.dirname(f) for f in inputs]
+        if stage.output_dir is not None:
+            dirs.append(stage.output_dir)
+        self.refresh(dirs)
+        if len(failed) > 0:
+            raise Exception(f"'{stage.name}' search and unpack failed: {failed}")
+
+    def run(self, stages: List[Stage]):
+        names = {s.name for s in stages}
+        for s in stages:
+            for a in s.after:
+                assert a in names, f"Stage {s.name} comes after unknown stage {a}"
+        futures: Dict[str, Future] = {}
+        with ThreadPoolExecutor(max_workers=len(stages)) as coordinators:
+            pending = list(stages)
+            while pending:
+                ready = [s for s in pending if all(a in futures for a in s.after)]
+                assert len(ready) > 0, "Cycle in stage graph"
+                for s in ready:
+                    futures[s.name] = coordinators.submit(self.run_stage, s, [futures[a] for a in s.after])
+                    pending.remove(s)
+            errors = [f.exception() for f in futures.values() if f.exception() is not None]
+        if len(errors) > 0:
+            raise errors[0]
@@ -0,0 +1,93 @@
+import logging
+import os
+import shutil
+import threading
+
+from contextlib import contextmanager
+
+from os.path import isdir, isfile
+from typing import Iterable, Optional
+
+from arx.telemetry import disk_usage
+from arx.workdir_index import WorkDirIndex
+
+logger = logging.getLogger('rom_analyzer')
+
+BUDGET_POLL_SECONDS = 1.0
+
+
+class DiskBudgetError(Exception):
+    pass
+
+
+class ScratchSpace:
+    # Intermediate files of an extraction in work_dir: what a job consumed (an archive it unpacked,
+    # a sparse image it converted, ...) is removed as soon as the job succeeded, unless
+    # keep_intermediates. Before writing, jobs reserve the bytes they expect to produce: they wait
+    # while other jobs are running and the work dir would go over budget_bytes (or the volume would
+    # fill up), and fail when nothing else is running, as waiting would not free anything.
+
+    def __init__(self, work_dir: str, index: Optional[WorkDirIndex] = None, keep_intermediates: bool = False,
+                 budget_bytes: Optional[int] = None, protected: Iterable[str] = ()):
+        assert isdir(work_dir)
+        self.work_dir = work_dir
+        self.index = index
+        self.keep_intermediates = keep_intermediates
+        self.budget_bytes = budget_bytes
+        self.protected = {os.path.abspath(p) for p in protected}
+        self.removed_bytes = 0
+        self._reserved = 0
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def consume(self, paths: Iterable[str]):
+        # paths are no longer needed by any stage
+        if self.keep_intermediates:
+            return
+        for p in paths:
+            if os.path.abspath(p) in self.protected or not isfile(p):
+                continue
+            size = os.lstat(p).st_blocks * 512
+            try:
+                os.remove(p)
+            except OSError as e:
+                logger.warning("Can't remove {}: {}".format(p, e))
+                continue
+            if self.index is not None:
+                self.index.remove(p)
+            self.removed_bytes += size
+            logger.debug("scratch: removed {} ({} bytes)".format(p, size))
+
+    def usage(self) -> int:
+        return disk_usage(self.work_dir)
+
+    def _fits(self, nbytes: int) -> bool:
+        if self.budget_bytes is not None and self.usage() + self._reserved + nbytes > self.budget_bytes:
+            return False
+        return shutil.disk_usage(self.work_dir).free - self._reserved >= nbytes
+
+    def reserve(self, nbytes: int, what: str = ''):
+        # blocks until nbytes more fit, then they are held until release(nbytes)
+        with self._cond:
+            while not self._fits(nbytes):
+                if self._running == 0:
+                    raise DiskBudgetError('{} needs about {} bytes, {} are used out of a budget of {} in {}'.format(
+                        what or 'A job', nbytes, self.usage(), self.budget_bytes, self.work_dir))
+                logger.info("scratch: {} waits for {} bytes".format(what, nbytes))
+                self._cond.wait(BUDGET_POLL_SECONDS)
+            self._reserved += nbytes
+            self._running += 1
+
+    def release(self, nbytes: int):
+        with self._cond:
+            self._reserved -= nbytes
+            self._running -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserving(self, nbytes: int, what: str = ''):
+        self.reserve(nbytes, what)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
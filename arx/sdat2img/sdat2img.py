@@ -6,117 +6,194 @@
 #       PYTHON3: packmad on 2018-01-16
 #====================================================
 
-import errno
+import logging
 import os
 import sys
 
-from six.moves import input
-from six.moves import range
+from bisect import bisect_left, bisect_right
+from functools import partial
+from typing import BinaryIO, Callable, Iterable, List, NamedTuple, Optional, Tuple
 
+from arx.fileio import copy_range, copy_stream, write_fill
 
-def sdat2img(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE, show_msg=False):
-    __version__ = '1.2'
+__version__ = '2.0'
 
-    if sys.hexversion < 0x02070000:
-        sys.exit("Python 3 or newer is required.")
-    else:
-        print('sdat2img binary - version: {}\n'.format(__version__))
+logger = logging.getLogger('rom_analyzer')
 
-    def rangeset(src):
-        src_set = src.split(',')
-        num_set = [int(item) for item in src_set]
-        if len(num_set) != num_set[0]+1:
-            raise Exception('Error on parsing following data to rangeset:\n{}'.format(src), file=sys.stderr)
+BLOCK_SIZE = 4096
 
-        return tuple([(num_set[i], num_set[i+1]) for i in range(1, len(num_set), 2)])
+ANDROID_VERSIONS = {
+    1: 'Android Lollipop 5.0',
+    2: 'Android Lollipop 5.1',
+    3: 'Android Marshmallow 6.x',
+    4: 'Android Nougat 7.x / Oreo 8.x',
+}
 
-    def parse_transfer_list_file(path):
-        trans_list = open(TRANSFER_LIST_FILE, 'r')
+Range = Tuple[int, int]
+ProgressCallback = Callable[[int, int], None]
 
-        # First line in transfer list is the version number
-        version = int(trans_list.readline())
 
-        # Second line in transfer list is the total number of blocks we expect to write
-        new_blocks = int(trans_list.readline())
+class Sdat2ImgError(Exception):
+    pass
+
+
+class TransferList(NamedTuple):
+    version: int
+    new_blocks: int
+    commands: List[Tuple[str, Tuple[Range, ...]]]
+
+
+class Sdat2ImgResult(NamedTuple):
+    version: int
+    android_version: str
+    output_image: str
+    image_size: int
+    blocks_written: int
+    copy_calls: int
+
+
+def rangeset(src: str) -> Tuple[Range, ...]:
+    num_set = [int(item) for item in src.split(',')]
+    if len(num_set) != num_set[0] + 1 or num_set[0] % 2 != 0:
+        raise Sdat2ImgError('Error on parsing following data to rangeset:\n{}'.format(src))
+    return tuple((num_set[i], num_set[i + 1]) for i in range(1, len(num_set), 2))
+
+
+def parse_transfer_list(transfer_list_file: str) -> TransferList:
+    with open(transfer_list_file, 'r') as trans_list:
+        return read_transfer_list(trans_list)
 
+
+def read_transfer_list(lines: Iterable[str]) -> TransferList:
+    trans_list = iter(lines)
+    try:
+        # First line in transfer list is the version number
+        version = int(next(trans_list))
+        # Second line in transfer list is the total number of blocks we expect to write
+        new_blocks = int(next(trans_list))
         if version >= 2:
             # Third line is how many stash entries are needed simultaneously
-            trans_list.readline()
+            next(trans_list)
             # Fourth line is the maximum number of blocks that will be stashed simultaneously
-            trans_list.readline()
-
-        # Subsequent lines are all individual transfer commands
-        commands = []
-        for line in trans_list:
-            line = line.split(' ')
-            cmd = line[0]
-            if cmd in ['erase', 'new', 'zero']:
-                commands.append([cmd, rangeset(line[1])])
-            else:
-                # Skip lines starting with numbers, they are not commands anyway
-                if not cmd[0].isdigit():
-                    trans_list.close()
-                    raise Exception('Command "{}" is not valid.'.format(cmd), file=sys.stderr)
-
-        trans_list.close()
-        return version, new_blocks, commands
-
-    BLOCK_SIZE = 4096
-    
-    version, new_blocks, commands = parse_transfer_list_file(TRANSFER_LIST_FILE)
-
-    if version == 1:
-        print('Android Lollipop 5.0 detected!\n')
-    elif version == 2:
-        print('Android Lollipop 5.1 detected!\n')
-    elif version == 3:
-        print('Android Marshmallow 6.x detected!\n')
-    elif version == 4:
-        print('Android Nougat 7.x / Oreo 8.x detected!\n')
-    else:
-        print('Unknown Android version!\n')
-
-    # Don't clobber existing files to avoid accidental data loss
-    try:
-        output_img = open(OUTPUT_IMAGE_FILE, 'wb')
-    except IOError as e:
-        if e.errno == errno.EEXIST:
-            print('Error: the output file "{}" already exists'.format(e.filename), file=sys.stderr)
-            print('Remove it, rename it, or choose a different file name.', file=sys.stderr)
-            sys.exit(e.errno)
+            next(trans_list)
+    except (StopIteration, ValueError):
+        raise Sdat2ImgError('Bad transfer list header')
+    # Subsequent lines are all individual transfer commands
+    commands = []
+    for line in trans_list:
+        line = line.strip().split(' ')
+        cmd = line[0]
+        if cmd in ('erase', 'new', 'zero'):
+            commands.append((cmd, rangeset(line[1])))
+        elif cmd and not cmd[0].isdigit():
+            # Skip lines starting with numbers, they are not commands anyway
+            raise Sdat2ImgError('Command "{}" is not valid.'.format(cmd))
+    return TransferList(version, new_blocks, commands)
+
+
+def merge_ranges(ranges: List[Range]) -> List[Range]:
+    # Merge only ranges that are adjacent in the given order: 'new' data is consumed
+    # sequentially, so reordering would change which bytes land where.
+    merged: List[Range] = []
+    for begin, end in ranges:
+        if begin >= end:
+            continue
+        if merged and merged[-1][1] == begin:
+            merged[-1] = (merged[-1][0], end)
         else:
-            raise
-
-    new_data_file = open(NEW_DATA_FILE, 'rb')
-    all_block_sets = [i for command in commands for i in command[1]]
-    max_file_size = max(pair[1] for pair in all_block_sets)*BLOCK_SIZE
-
-    for command in commands:
-        if command[0] == 'new':
-            for block in command[1]:
-                begin = block[0]
-                end = block[1]
-                block_count = end - begin
-                if show_msg:
-                    print('Copying {} blocks into position {}...'.format(block_count, begin))
-
-                # Position output file
-                output_img.seek(begin*BLOCK_SIZE)
-                
-                # Copy one block at a time
-                while(block_count > 0):
-                    output_img.write(new_data_file.read(BLOCK_SIZE))
-                    block_count -= 1
-        elif show_msg:
-            print('Skipping command {}...'.format(command[0]))
-
-    # Make file larger if necessary
-    if(output_img.tell() < max_file_size):
-        output_img.truncate(max_file_size)
-
-    output_img.close()
-    new_data_file.close()
-    print('Done! Output image: {}'.format(os.path.realpath(output_img.name)))
+            merged.append((begin, end))
+    return merged
+
+
+class _WrittenRanges:
+    # Sorted, non overlapping block ranges already holding 'new' data
+
+    def __init__(self):
+        self.begins: List[int] = []
+        self.ends: List[int] = []
+
+    def add(self, begin: int, end: int):
+        i = bisect_left(self.ends, begin)
+        j = bisect_right(self.begins, end)
+        if i < j:
+            begin = min(begin, self.begins[i])
+            end = max(end, self.ends[j - 1])
+        self.begins[i:j] = [begin]
+        self.ends[i:j] = [end]
+
+    def overlaps(self, begin: int, end: int) -> List[Range]:
+        ret = []
+        i = bisect_right(self.ends, begin)
+        while i < len(self.begins) and self.begins[i] < end:
+            ret.append((max(begin, self.begins[i]), min(end, self.ends[i])))
+            i += 1
+        return ret
+
+
+def sdat2img(transfer_list_file: str, new_data_file: str, output_image_file: str,
+             progress: Optional[ProgressCallback] = None) -> Sdat2ImgResult:
+    transfer_list = parse_transfer_list(transfer_list_file)
+    with open(new_data_file, 'rb') as new_data:
+        in_fd = new_data.fileno()
+        src_offset = 0
+
+        def copy_new(out_fd: int, dst_offset: int, length: int):
+            nonlocal src_offset
+            copy_range(in_fd, src_offset, out_fd, dst_offset, length)
+            src_offset += length
+
+        return apply_transfer_list(transfer_list, copy_new, new_data_file, output_image_file, progress)
+
+
+def sdat2img_stream(transfer_list: TransferList, new_data: BinaryIO, output_image_file: str,
+                    progress: Optional[ProgressCallback] = None) -> Sdat2ImgResult:
+    # new data is consumed in order, so it can come from a decompressor or a pipe
+    return apply_transfer_list(transfer_list, partial(copy_stream, new_data), getattr(new_data, 'name', 'new data'),
+                               output_image_file, progress)
+
+
+def apply_transfer_list(transfer_list: TransferList, copy_new: Callable[[int, int, int], None], new_data_name: str,
+                        output_image_file: str, progress: Optional[ProgressCallback] = None) -> Sdat2ImgResult:
+    # copy_new(out_fd, dst_offset, length) writes the next length bytes of new data at dst_offset
+    android_version = ANDROID_VERSIONS.get(transfer_list.version, 'Unknown Android version')
+    logger.debug('sdat2img: transfer list v{} ({})'.format(transfer_list.version, android_version))
+
+    all_block_sets = [r for _, ranges in transfer_list.commands for r in ranges]
+    if len(all_block_sets) == 0:
+        raise Sdat2ImgError('Empty transfer list for {}'.format(new_data_name))
+    max_file_size = max(end for _, end in all_block_sets) * BLOCK_SIZE
+    total_new = sum(end - begin for cmd, ranges in transfer_list.commands if cmd == 'new' for begin, end in ranges)
+
+    written = _WrittenRanges()
+    blocks_written = 0
+    copy_calls = 0
+    out_fd = os.open(output_image_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for cmd, ranges in transfer_list.commands:
+            if cmd == 'new':
+                for begin, end in merge_ranges(list(ranges)):
+                    try:
+                        copy_new(out_fd, begin * BLOCK_SIZE, (end - begin) * BLOCK_SIZE)
+                    except EOFError as e:
+                        raise Sdat2ImgError('{} is too short: {}'.format(new_data_name, e))
+                    copy_calls += 1
+                    written.add(begin, end)
+                    blocks_written += end - begin
+                    if progress is not None:
+                        progress(blocks_written, total_new)
+            else:
+                # erase/zero: the output starts as a hole, only blocks already written need zeroing
+                for r_begin, r_end in ranges:
+                    for begin, end in written.overlaps(r_begin, r_end):
+                        write_fill(out_fd, begin * BLOCK_SIZE, (end - begin) * BLOCK_SIZE, b'\x00')
+        # Make file larger if necessary
+        if os.fstat(out_fd).st_size < max_file_size:
+            os.ftruncate(out_fd, max_file_size)
+        image_size = os.fstat(out_fd).st_size
+    finally:
+        os.close(out_fd)
+    return Sdat2ImgResult(transfer_list.version, android_version, os.path.realpath(output_image_file),
+                          image_size, blocks_written, copy_calls)
 
 
 if __name__ == '__main__':
@@ -129,12 +206,17 @@ if __name__ == '__main__':
         print('    <system_new_file>: system new dat file')
         print('    [system_img]: output system image\n\n')
         print('Visit xda thread for more information.\n')
-        input('Press ENTER to exit...')
-        sys.exit()
+        sys.exit(1)
 
     try:
         OUTPUT_IMAGE_FILE = str(sys.argv[3])
     except IndexError:
         OUTPUT_IMAGE_FILE = 'system.img'
 
-    sdat2img(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE)
+    print('sdat2img binary - version: {}\n'.format(__version__))
+    try:
+        result = sdat2img(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE)
+    except Sdat2ImgError as e:
+        sys.exit('Error: {}'.format(e))
+    print('{} detected!\n'.format(result.android_version))
+    print('Done! Output image: {}'.format(result.output_image))
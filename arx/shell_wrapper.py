@@ -1,130 +1,100 @@
-import fnmatch
 import subprocess
 import logging
-import magic
 import os
-import pexpect
-import shutil
-import tempfile
 
 from os.path import isfile, isdir
-from typing import Optional, List
+from typing import Optional, List, Callable
+
+from arx import commands
+from arx.classify import classify
+from arx.fileio import concat_files
+from arx.workdir_index import WorkDirIndex
 
 logger = logging.getLogger('rom_analyzer')
 
+UNPACK_TIMEOUT = 5 * 60  # seconds
+MOUNT_TIMEOUT = 60
+# setuid root mount/umount/chmod, see setuid_wrapper
+WRAPPER = '/usr/local/bin/wrapper'
+
 
-def run_cmd(cmd: List[str], env: dict = None, print_cmd: bool = True) -> Optional[str]:
+def run_cmd(cmd: List[str], env: dict = None, print_cmd: bool = True, timeout: Optional[float] = None) -> Optional[str]:
+    # Output kept as per commands.run, None on failure or after timeout seconds
     if print_cmd:
         logger.info("$ {}".format(' '.join(cmd)))
-    try:
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, env=env).strip()
-        return output.decode(errors='ignore')
-    except subprocess.CalledProcessError as e:
-        logger.error('Error during command: {0}'.format(e.output.decode(errors='replace') if e.output else e))
+    result = commands.run(cmd, env, timeout)
+    if result.timed_out:
+        logger.error('Timeout after {}s: {}'.format(timeout, ' '.join(cmd)))
+    if not result.ok:
+        e = subprocess.CalledProcessError(result.returncode, cmd, result.output)
+        logger.error('Error during command: {0}'.format(e.output if e.output else e))
         return None
+    return result.output.strip()
 
 
-def aunpack(archive: str, dstfolder: str) -> bool:
+def aunpack(archive: str, dstfolder: str, keep: Optional[Callable[[str], bool]] = None) -> bool:
     assert isdir(dstfolder)
     assert isfile(archive)
 
-    if "Java archive" in file_info(archive):
-        from arx.formats_extraction import x7z_tar_md5  # circular dependency
-        return x7z_tar_md5(archive, dstfolder)
-
-    aunpack_path = '/usr/bin/aunpack'
-    pwdtmp = tempfile.mkdtemp(dir=dstfolder)
-    child = pexpect.spawn(aunpack_path, [archive, '-X', pwdtmp])
-    try:
-        child.expect(["Enter password", "password:"], timeout=2)
-        child.close()
-        child.terminate()
-        # is password protected
-        ret = aunpack_pwd(archive, dstfolder)
-        shutil.rmtree(pwdtmp, ignore_errors=True)
-        return ret      
-    except Exception as e:
-        pass
-    # is NOT pwd protected
-    output = run_cmd(["timeout", "-s", "SIGKILL", "-k", "0", "5m", aunpack_path, archive, '-X', dstfolder])
-    shutil.rmtree(pwdtmp, ignore_errors=True)
+    from arx.archive import unpack  # circular dependency
+    ret = unpack(archive, dstfolder, keep)
+    if ret is not None:
+        return ret
+    # headers unknown here, atool guesses the format
+    output = run_cmd(['/usr/bin/aunpack', archive, '-X', dstfolder], timeout=UNPACK_TIMEOUT)
     return output is not None
 
 
-def aunpack_pwd(archive: str, dstfolder: str) -> bool:
-    ftype = magic.from_file(archive)
-    pwd = "www.stockrom.net"
-    dstfolder = os.path.join(dstfolder, '')  # Ensure the path ends with a trailing slash.
-    cmd = ["timeout", "-s", "SIGKILL", "-k", "0", "5m"]
-    if ftype.startswith("Zip") or ftype.startswith("Java archive") or ftype.startswith("7-zip"):
-        cmd += ["/usr/bin/7za", "x", archive, "-p" + pwd, "-o" + dstfolder]
-        output = run_cmd(cmd)
-        return "ERRORS" not in output and "No files to process" not in output
-    elif ftype.startswith("RAR"):
-        cmd += ["/usr/bin/unrar", "x", archive, "-p" + pwd, dstfolder]
-        output = run_cmd(cmd)
-        return "All OK" in output
-    raise Exception("Unmanaged password protected archive '{}' of type '{}'")
-
-
-def find(directory: str, tgt_file: str) -> Optional[str]:
+def find(directory: str, tgt_file: str, index: Optional[WorkDirIndex] = None) -> Optional[str]:
     assert "*" not in tgt_file
     assert isdir(directory)
+    if index is None:
+        index = WorkDirIndex(directory)
+    return index.find(tgt_file, directory)
 
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if tgt_file == file:
-                return os.path.join(root, file)
-    return None
 
-
-def findw(directory: str, tgt_file: str) -> Optional[list]:
+def findw(directory: str, tgt_file: str, index: Optional[WorkDirIndex] = None) -> Optional[list]:
     assert "*" in tgt_file
     assert isdir(directory)
-    lst_match = []
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if fnmatch.fnmatch(file, tgt_file):
-                lst_match.append(os.path.join(root, file))
-    if len(lst_match) > 0:
-        return lst_match
-    return None
+    if index is None:
+        index = WorkDirIndex(directory)
+    return index.findw(tgt_file, directory)
 
 
 def file_info(file: str) -> Optional[str]:
     assert isfile(file)
-    output = run_cmd(['/usr/bin/file', file])
-    return output
+    return classify(file)
 
 
-def mount(img_path: str, mnt_point: str) -> bool:
+def mount(img_path: str, mnt_point: str, options: str = 'loop') -> bool:
     assert isfile(img_path)
     assert isdir(mnt_point)
-    img_path = '"' + img_path + '"'
-    output = run_cmd(['/usr/local/bin/wrapper', 'mount', img_path, mnt_point])
-    logger.info('Mount output: {}'.format(output))
-    return output.count('\n') == 0
+    output = run_cmd([WRAPPER, 'mount', img_path, mnt_point, options], timeout=MOUNT_TIMEOUT)
+    return output is not None and os.path.ismount(mnt_point)
 
 
-def umount(mnt_dir: str) -> bool:
+def umount(mnt_dir: str, lazy: bool = False) -> bool:
+    # lazy: detached now, cleaned up once no longer busy
     assert isdir(mnt_dir)
-    try:
-        output = run_cmd(['/usr/local/bin/wrapper', 'umount', mnt_dir])
-        return output is not None
-    except Exception:
-        return False
+    output = run_cmd([WRAPPER, 'umount', mnt_dir] + (['lazy'] if lazy else []), timeout=MOUNT_TIMEOUT)
+    return output is not None
 
 
 def chmodr777(dst_dir: str) -> bool:
     assert isdir(dst_dir)
-    output = run_cmd(['/usr/local/bin/wrapper', 'chmod', dst_dir])
+    output = run_cmd([WRAPPER, 'chmod', dst_dir])
     return output is not None
 
 
 def catfiles(src_files: List[str], dst_file: str) -> bool:
-    cmd = "/bin/cat {} > {}".format(' '.join(src_files), dst_file)
-    logger.info(f"$ {cmd}")
-    os.system(cmd)
+    # in process, without copying the data through userspace (see concat_files)
+    logger.info("cat {} > {}".format(' '.join(src_files), dst_file))
+    try:
+        size = concat_files(src_files, dst_file)
+    except OSError as e:
+        logger.error("Can't concatenate {}: {}".format(src_files, e))
+        return False
+    logger.debug("{}: {} bytes".format(dst_file, size))
     return isfile(dst_file)
 
 
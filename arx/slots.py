@@ -0,0 +1,71 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from os.path import join
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger('rom_analyzer')
+
+SLOT_POLL_SECONDS = 1.0
+
+# pid, lock and slots held (lock file -> descriptor) of this process: POSIX locks don't tell its
+# threads apart. A forked process starts afresh, with none of its parent's slots nor its lock state.
+_state: Tuple[int, threading.Lock, Dict[str, int]] = (os.getpid(), threading.Lock(), {})
+
+
+def _process_state() -> Tuple[threading.Lock, Dict[str, int]]:
+    global _state
+    if _state[0] != os.getpid():
+        _state = (os.getpid(), threading.Lock(), {})
+    return _state[1], _state[2]
+
+
+class Slots:
+    # n lock files shared by every process using the same slots folder: a holder keeps a POSIX lock
+    # on one of them. The kernel releases it if the process dies, and unlike flock the processes
+    # forked meanwhile (process pool workers, ...) don't inherit it, so a crash never keeps a slot.
+
+    def __init__(self, n: int, slots_dir: str):
+        assert n > 0
+        os.makedirs(slots_dir, exist_ok=True)
+        self.slots = [join(slots_dir, 'slot{:04d}'.format(i)) for i in range(n)]
+
+    def try_acquire(self) -> Optional[str]:
+        # the slot taken, None when all of them are
+        lock, held = _process_state()
+        with lock:
+            for slot in self.slots:
+                if slot in held:
+                    continue
+                # closing any descriptor of a locked file drops the locks of the process on it,
+                # so held slots are never opened again
+                fd = os.open(slot, os.O_RDWR | os.O_CREAT, 0o666)
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    os.close(fd)
+                    continue
+                held[slot] = fd
+                return slot
+        return None
+
+    def acquire(self, what: str = '', poll: float = SLOT_POLL_SECONDS) -> str:
+        slot = self.try_acquire()
+        if slot is None:
+            logger.info("slots: {} waits for one of {} slots in {}".format(
+                what, len(self.slots), os.path.dirname(self.slots[0])))
+        while slot is None:
+            time.sleep(poll)
+            slot = self.try_acquire()
+        return slot
+
+    @staticmethod
+    def release(slot: str):
+        lock, held = _process_state()
+        with lock:
+            fd = held.pop(slot)
+        # closing the descriptor releases the lock
+        os.close(fd)
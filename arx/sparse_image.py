@@ -0,0 +1,198 @@
+import logging
+import os
+import struct
+
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Tuple
+
+from arx.ext4 import EXT4_MAGIC, EXT4_MAGIC_OFFSET, EXT4_SUPERBLOCK_OFFSET, EXT4_SUPERBLOCK_SIZE, is_ext4_superblock
+from arx.fileio import copy_range, write_fill
+
+logger = logging.getLogger('rom_analyzer')
+
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+SPARSE_HEADER = struct.Struct('<IHHHHIIII')
+CHUNK_HEADER = struct.Struct('<HHII')
+
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+
+class SparseImageError(Exception):
+    pass
+
+
+class SparseHeader(NamedTuple):
+    major_version: int
+    minor_version: int
+    file_hdr_sz: int
+    chunk_hdr_sz: int
+    blk_sz: int
+    total_blks: int
+    total_chunks: int
+
+
+class SparseChunk(NamedTuple):
+    chunk_type: int
+    out_offset: int  # bytes, in the raw image
+    out_length: int  # bytes, in the raw image
+    data_offset: int  # bytes, in the sparse file (RAW chunks only)
+    fill: bytes  # 4 bytes pattern (FILL chunks only)
+
+
+def is_sparse_image(img: str) -> bool:
+    with open(img, 'rb') as f:
+        magic = f.read(4)
+    return len(magic) == 4 and struct.unpack('<I', magic)[0] == SPARSE_HEADER_MAGIC
+
+
+def read_sparse_header(f: BinaryIO) -> SparseHeader:
+    buf = f.read(SPARSE_HEADER.size)
+    if len(buf) != SPARSE_HEADER.size:
+        raise SparseImageError('Truncated sparse header')
+    magic, major, minor, file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks, total_chunks, _ = SPARSE_HEADER.unpack(buf)
+    if magic != SPARSE_HEADER_MAGIC:
+        raise SparseImageError(f'Bad sparse magic {magic:#x}')
+    if major != 1:
+        raise SparseImageError(f'Unsupported sparse major version {major}')
+    if file_hdr_sz < SPARSE_HEADER.size or chunk_hdr_sz < CHUNK_HEADER.size:
+        raise SparseImageError('Bad sparse header sizes')
+    if blk_sz == 0 or blk_sz % 4 != 0:
+        raise SparseImageError(f'Bad sparse block size {blk_sz}')
+    f.seek(file_hdr_sz)
+    return SparseHeader(major, minor, file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks, total_chunks)
+
+
+def iter_chunks(f: BinaryIO, header: SparseHeader) -> Iterator[SparseChunk]:
+    out_offset = 0
+    pos = header.file_hdr_sz
+    for i in range(header.total_chunks):
+        f.seek(pos)
+        buf = f.read(CHUNK_HEADER.size)
+        if len(buf) != CHUNK_HEADER.size:
+            raise SparseImageError(f'Truncated chunk header #{i}')
+        chunk_type, _, chunk_sz, total_sz = CHUNK_HEADER.unpack(buf)
+        data_offset = pos + header.chunk_hdr_sz
+        data_sz = total_sz - header.chunk_hdr_sz
+        out_length = chunk_sz * header.blk_sz
+        fill = b''
+        if chunk_type == CHUNK_TYPE_RAW:
+            if data_sz != out_length:
+                raise SparseImageError(f'Bad RAW chunk #{i} size {data_sz} != {out_length}')
+        elif chunk_type == CHUNK_TYPE_FILL:
+            if data_sz != 4:
+                raise SparseImageError(f'Bad FILL chunk #{i} size {data_sz}')
+            f.seek(data_offset)
+            fill = f.read(4)
+        elif chunk_type in (CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_CRC32):
+            if chunk_type == CHUNK_TYPE_CRC32:
+                out_length = 0
+        else:
+            raise SparseImageError(f'Unknown chunk #{i} type {chunk_type:#x}')
+        yield SparseChunk(chunk_type, out_offset, out_length, data_offset, fill)
+        out_offset += out_length
+        pos += total_sz
+    if out_offset != header.total_blks * header.blk_sz:
+        raise SparseImageError(f'Chunks cover {out_offset} bytes, header says {header.total_blks * header.blk_sz}')
+
+
+SCAN_WINDOW_SIZE = 4 * 1024 * 1024
+
+
+def _read_logical(images: List[Tuple[BinaryIO, List[SparseChunk]]], pos: int, size: int) -> bytes:
+    # Bytes [pos, pos+size) of the decoded stream; later images win over earlier ones, like sparse_to_raw
+    buf = bytearray(size)
+    for f, chunks in images:
+        for chunk in chunks:
+            begin = max(pos, chunk.out_offset)
+            end = min(pos + size, chunk.out_offset + chunk.out_length)
+            if begin >= end:
+                continue
+            if chunk.chunk_type == CHUNK_TYPE_RAW:
+                f.seek(chunk.data_offset + begin - chunk.out_offset)
+                buf[begin - pos:end - pos] = f.read(end - begin)
+            elif chunk.chunk_type == CHUNK_TYPE_FILL:
+                phase = (begin - chunk.out_offset) % 4
+                pattern = chunk.fill[phase:] + chunk.fill[:phase]
+                buf[begin - pos:end - pos] = (pattern * ((end - begin) // 4 + 1))[:end - begin]
+    return bytes(buf)
+
+
+def _scan_raw_chunk(images: List[Tuple[BinaryIO, List[SparseChunk]]], f: BinaryIO, chunk: SparseChunk) -> Optional[int]:
+    overlap = EXT4_MAGIC_OFFSET + len(EXT4_MAGIC)
+    start = 0
+    while start < chunk.out_length:
+        f.seek(chunk.data_offset + start)
+        window = f.read(min(SCAN_WINDOW_SIZE + overlap, chunk.out_length - start))
+        i = window.find(EXT4_MAGIC)
+        while i >= 0:
+            sb_pos = chunk.out_offset + start + i - EXT4_MAGIC_OFFSET
+            fs_offset = sb_pos - EXT4_SUPERBLOCK_OFFSET
+            if fs_offset >= 0 and is_ext4_superblock(_read_logical(images, sb_pos, EXT4_SUPERBLOCK_SIZE)):
+                return fs_offset
+            i = window.find(EXT4_MAGIC, i + 1)
+        start += SCAN_WINDOW_SIZE
+    return None
+
+
+def locate_ext4_superblock(sparse_imgs: List[str]) -> Optional[int]:
+    # Offset of the first valid ext4 filesystem in the decoded stream, found by scanning the RAW
+    # chunks in bounded windows: the raw image is never materialized nor read in memory.
+    files = [open(img, 'rb') for img in sparse_imgs]
+    try:
+        images = []
+        for f in files:
+            header = read_sparse_header(f)
+            images.append((f, list(iter_chunks(f, header))))
+        best = None
+        for f, chunks in images:
+            for chunk in chunks:
+                # chunks come in increasing offsets: stop as soon as they cannot beat the best match
+                if best is not None and chunk.out_offset - EXT4_SUPERBLOCK_OFFSET - EXT4_MAGIC_OFFSET >= best:
+                    break
+                if chunk.chunk_type != CHUNK_TYPE_RAW:
+                    continue
+                fs_offset = _scan_raw_chunk(images, f, chunk)
+                if fs_offset is not None:
+                    best = fs_offset if best is None else min(best, fs_offset)
+        return best
+    finally:
+        for f in files:
+            f.close()
+
+
+def sparse_to_raw(sparse_imgs: List[str], raw_img: str, skip_bytes: int = 0) -> int:
+    # Like simg2img: every input is laid out from offset 0 of the same output, so a list of
+    # sparsechunk files behaves as a single logical stream. DONT_CARE chunks and zero FILL
+    # chunks over never written ranges are left as holes. The first skip_bytes of the stream
+    # are dropped, so a leading non-filesystem area can be trimmed without a second copy.
+    assert len(sparse_imgs) > 0
+    assert skip_bytes >= 0
+    out_size = 0
+    high_water = 0
+    out_fd = os.open(raw_img, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for img in sparse_imgs:
+            with open(img, 'rb') as f:
+                header = read_sparse_header(f)
+                in_fd = f.fileno()
+                for chunk in iter_chunks(f, header):
+                    end = chunk.out_offset + chunk.out_length - skip_bytes
+                    if end <= 0:
+                        continue
+                    dropped = max(0, skip_bytes - chunk.out_offset)
+                    begin = chunk.out_offset + dropped - skip_bytes
+                    if chunk.chunk_type == CHUNK_TYPE_RAW:
+                        copy_range(in_fd, chunk.data_offset + dropped, out_fd, begin, end - begin)
+                        high_water = max(high_water, end)
+                    elif chunk.chunk_type == CHUNK_TYPE_FILL:
+                        if chunk.fill != b'\x00' * 4 or begin < high_water:
+                            phase = dropped % 4
+                            write_fill(out_fd, begin, end - begin, chunk.fill[phase:] + chunk.fill[:phase])
+                            high_water = max(high_water, end)
+                    out_size = max(out_size, end)
+        os.ftruncate(out_fd, out_size)
+    finally:
+        os.close(out_fd)
+    return out_size
@@ -0,0 +1,181 @@
+import io
+import logging
+import lzma
+import shutil
+import subprocess
+import threading
+import zipfile
+
+from os.path import basename
+from typing import BinaryIO, Callable, List, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+logger = logging.getLogger('rom_analyzer')
+
+READ_SIZE = 1024 * 1024
+# compressed bytes fed to the decompressors at a time, zeros can expand a lot
+DECOMPRESS_INPUT_SIZE = 256 * 1024
+TRANSFER_LIST_SUFFIX = '.transfer.list'
+# new.dat members, as they are stored in the ROMs
+NEW_DATA_SUFFIXES = ('.new.dat.br', '.new.dat.lz4', '.new.dat.xz', '.new.dat')
+# command line decoders, used when the Python bindings are not installed
+DECODER_COMMANDS = {
+    '.br': ['/usr/bin/brotli', '--decompress', '--stdout'],
+    '.lz4': ['/usr/bin/lz4', '--decompress', '--stdout'],
+}
+
+
+class StreamError(Exception):
+    pass
+
+
+class _DecompressorStream(io.RawIOBase):
+    # Readable stream over an incremental decompressor object (lzma, brotli, lz4.frame)
+
+    def __init__(self, src: BinaryIO, decompress: Callable[[bytes], bytes], is_finished: Callable[[], bool]):
+        super().__init__()
+        self._src = src
+        self._decompress = decompress
+        self._is_finished = is_finished
+        self._buf = b''
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self._buf) == 0 and not self._eof:
+            chunk = self._src.read(DECOMPRESS_INPUT_SIZE)
+            if not chunk:
+                if not self._is_finished():
+                    raise StreamError('Truncated compressed stream')
+                self._eof = True
+                break
+            try:
+                self._buf = self._decompress(chunk)
+            except Exception as e:
+                # each library has its own error type
+                raise StreamError('Corrupted compressed stream: {}'.format(e))
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+    def close(self):
+        self._src.close()
+        super().close()
+
+
+class _CommandStream(io.RawIOBase):
+    # Output of a decoder process fed with src by a thread, so that no side of the pipe can stall
+
+    def __init__(self, src: BinaryIO, cmd: List[str]):
+        super().__init__()
+        self._src = src
+        self._cmd = cmd
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self._feeder = threading.Thread(target=self._feed, daemon=True)
+        self._feeder.start()
+
+    def _feed(self):
+        try:
+            shutil.copyfileobj(self._src, self._proc.stdin, READ_SIZE)
+        except (BrokenPipeError, ValueError):
+            # the decoder exited early, its exit code tells why
+            pass
+        finally:
+            try:
+                self._proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self._proc.stdout.readinto(b)
+        if n == 0 and self._proc.wait() != 0:
+            raise StreamError('{} exited with {}'.format(' '.join(self._cmd), self._proc.returncode))
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._proc.stdout.close()
+            if self._proc.poll() is None:
+                self._proc.kill()
+            self._proc.wait()
+            self._feeder.join()
+            self._src.close()
+        super().close()
+
+
+def open_decompressed(src: BinaryIO, name: str) -> BinaryIO:
+    # Decoded stream of src, the compression is told by the extension of name
+    if name.endswith('.xz'):
+        d = lzma.LZMADecompressor()
+        return io.BufferedReader(_DecompressorStream(src, d.decompress, lambda: d.eof), READ_SIZE)
+    if name.endswith('.br') and brotli is not None:
+        d = brotli.Decompressor()
+        return io.BufferedReader(_DecompressorStream(src, d.process, d.is_finished), READ_SIZE)
+    if name.endswith('.lz4') and lz4 is not None:
+        d = lz4.frame.LZ4FrameDecompressor()
+        return io.BufferedReader(_DecompressorStream(src, d.decompress, lambda: d.eof), READ_SIZE)
+    for ext, cmd in DECODER_COMMANDS.items():
+        if name.endswith(ext):
+            return io.BufferedReader(_CommandStream(src, cmd), READ_SIZE)
+    return src
+
+
+def streamable_transfer_lists(archive: str) -> List[Tuple[str, str]]:
+    # (transfer list, new data) member pairs of a plain zip, that can be decoded without unpacking
+    if not zipfile.is_zipfile(archive):
+        return []
+    with zipfile.ZipFile(archive) as zf:
+        infos = zf.infolist()
+        if any(i.flag_bits & 0x1 for i in infos):
+            return []
+        names = {i.filename for i in infos}
+    pairs = []
+    for name in sorted(names):
+        if not name.endswith(TRANSFER_LIST_SUFFIX):
+            continue
+        prefix = name[:-len(TRANSFER_LIST_SUFFIX)]
+        for suffix in NEW_DATA_SUFFIXES:
+            if prefix + suffix in names:
+                pairs.append((name, prefix + suffix))
+                break
+    return pairs
+
+
+def open_member(archive: str, member: str) -> BinaryIO:
+    # Decoded member of a zip archive, read sequentially
+    zf = zipfile.ZipFile(archive)
+    try:
+        stream = zf.open(member)
+    except Exception:
+        zf.close()
+        raise
+    # the member stream keeps its own reference to the archive file
+    zf.close()
+    logger.debug("streaming {}:{}".format(basename(archive), member))
+    return open_decompressed(stream, member)
+
+
+def new_data_image_name(new_data_member: str) -> str:
+    # same name transfer_list_to_img gives to the images of unpacked new.dat files
+    name = basename(new_data_member)
+    return name[:name.index('.new.dat') + len('.new.dat')] + '.img'
+
+
+def read_member_lines(archive: str, member: str) -> List[str]:
+    with zipfile.ZipFile(archive) as zf:
+        return zf.read(member).decode().splitlines()
+
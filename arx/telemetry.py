@@ -0,0 +1,227 @@
+import json
+import os
+import resource
+import threading
+import time
+
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+CATEGORY_STEP = 'step'  # the phases of unpack_and_mount
+CATEGORY_STAGE = 'stage'
+CATEGORY_JOB = 'job'
+CATEGORY_CMD = 'cmd'
+DISK_SAMPLE_SECONDS = 1.0
+# per thread figures when the platform has them, a thread of the coordinator then does not
+# take the CPU time of the others
+_RUSAGE_SCOPE = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+# CPU time and block I/O of the commands reaped by each thread (see add_child_usage). RUSAGE_CHILDREN
+# is of the whole process: a span would take the commands the other threads reaped meanwhile.
+_children = threading.local()
+
+
+class Span(NamedTuple):
+    name: str
+    category: str
+    start: float  # epoch seconds
+    wall: float
+    cpu_user: float
+    cpu_system: float
+    read_bytes: int  # block I/O, page cache hits are not counted
+    write_bytes: int
+    # bytes, ru_maxrss: the high-water mark of the process since it started, not of the span alone.
+    # Of a cmd span, that process is the command (and the children it reaped).
+    process_peak_rss: int
+    pid: int
+    tid: int
+    args: Dict[str, Any]
+
+
+def _usage(who: int) -> Tuple[float, float, int, int]:
+    ru = resource.getrusage(who)
+    return ru.ru_utime, ru.ru_stime, ru.ru_inblock * 512, ru.ru_oublock * 512
+
+
+def _children_usage() -> Tuple[float, float, int, int]:
+    return getattr(_children, 'usage', (0.0, 0.0, 0, 0))
+
+
+def add_child_usage(ru):
+    # a child process of the calling thread was reaped by os.wait4, ru is its resource usage
+    usage = _children_usage()
+    _children.usage = (usage[0] + ru.ru_utime, usage[1] + ru.ru_stime, usage[2] + ru.ru_inblock * 512,
+                       usage[3] + ru.ru_oublock * 512)
+
+
+def rusage_span(name: str, category: str, start: float, ru, args: Optional[Dict[str, Any]] = None) -> Span:
+    # Span of a child process reaped by os.wait4
+    return Span(name, category, start, time.time() - start, ru.ru_utime, ru.ru_stime, ru.ru_inblock * 512,
+                ru.ru_oublock * 512, ru.ru_maxrss * 1024, os.getpid(), threading.get_ident(), args or {})
+
+
+class Recorder:
+    # Collects the spans of a run: the steps and stages of unpack_and_mount, the jobs run by the
+    # scheduler workers and every external command, plus the peak disk usage of the work directory.
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self.peak_disk = 0
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def extend(self, spans: List[Span]):
+        with self._lock:
+            self.spans.extend(spans)
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        # CPU and I/O of the calling thread, plus the commands it reaped meanwhile. Children not
+        # run by arx.commands (process pool workers, ...) are not counted: their jobs have spans.
+        start = time.time()
+        before = _usage(_RUSAGE_SCOPE)
+        children_before = _children_usage()
+        try:
+            yield
+        finally:
+            after = _usage(_RUSAGE_SCOPE)
+            children_after = _children_usage()
+            delta = [a - b + ca - cb for a, b, ca, cb in zip(after, before, children_after, children_before)]
+            self.add(Span(name, category, start, time.time() - start, delta[0], delta[1], delta[2], delta[3],
+                          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, os.getpid(),
+                          threading.get_ident(), args))
+
+    @contextmanager
+    def sample_disk(self, directory: str, interval: float = DISK_SAMPLE_SECONDS):
+        stop = threading.Event()
+
+        def sample():
+            while True:
+                self.peak_disk = max(self.peak_disk, disk_usage(directory))
+                if stop.wait(interval):
+                    return
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            sampler.join()
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        # totals per category and name
+        ret: Dict[str, Dict[str, Any]] = {}
+        for s in self.spans:
+            key = '{}:{}'.format(s.category, s.name)
+            t = ret.setdefault(key, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'read_bytes': 0, 'write_bytes': 0,
+                                     'process_peak_rss': 0})
+            t['count'] += 1
+            t['wall'] += s.wall
+            t['cpu'] += s.cpu_user + s.cpu_system
+            t['read_bytes'] += s.read_bytes
+            t['write_bytes'] += s.write_bytes
+            t['process_peak_rss'] = max(t['process_peak_rss'], s.process_peak_rss)
+        return ret
+
+    def report(self, **meta) -> Dict[str, Any]:
+        spans = sorted(self.spans, key=lambda s: s.start)
+        return dict(meta, peak_disk=self.peak_disk, summary=self.summary(), spans=[s._asdict() for s in spans])
+
+    def write_report(self, path: str, **meta):
+        with open(path, 'w') as out:
+            json.dump(self.report(**meta), out, indent=1)
+
+    def write_chrome_trace(self, path: str):
+        # chrome://tracing and Perfetto "complete" events, timestamps in microseconds
+        if len(self.spans) == 0:
+            origin = 0.0
+        else:
+            origin = min(s.start for s in self.spans)
+        events = []
+        for s in self.spans:
+            args = dict(s.args, cpu=round(s.cpu_user + s.cpu_system, 6), read_bytes=s.read_bytes,
+                        write_bytes=s.write_bytes, process_peak_rss=s.process_peak_rss)
+            events.append({'name': s.name, 'cat': s.category, 'ph': 'X', 'ts': int((s.start - origin) * 1e6),
+                           'dur': int(s.wall * 1e6), 'pid': s.pid, 'tid': s.tid, 'args': args})
+        with open(path, 'w') as out:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, out)
+
+
+@contextmanager
+def optional_span(recorder: Optional[Recorder], name: str, category: str, **args):
+    if recorder is None:
+        yield
+    else:
+        with recorder.span(name, category, **args):
+            yield
+
+
+def disk_usage(directory: str) -> int:
+    # allocated bytes, so sparse images count for what they really take. The partitions mounted
+    # in directory are not entered, their files are not on its disk.
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not os.path.ismount(os.path.join(root, d))]
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_blocks * 512
+            except OSError:
+                # removed meanwhile
+                continue
+    return total
+
+
+# recorder of this process, run_cmd reports to it
+_current: Optional[Recorder] = None
+
+
+def current() -> Optional[Recorder]:
+    return _current
+
+
+def install(recorder: Optional[Recorder]):
+    global _current
+    _current = recorder
+
+
+def _run_traced(name: str, fn: Callable, *args) -> Tuple[Any, List[Span]]:
+    # Process pool side of traced_submit: the spans go back to the parent with the result
+    recorder = Recorder()
+    previous = current()
+    install(recorder)
+    try:
+        with recorder.span(name, CATEGORY_JOB, inputs=[str(a) for a in args]):
+            value = fn(*args)
+    finally:
+        install(previous)
+    return value, recorder.spans
+
+
+def traced_submit(submit: Callable[..., Future], recorder: Recorder, name: str, fn: Callable, *args) -> Future:
+    # submit(fn, *args) of a process pool, with the spans of the job merged in recorder.
+    # The returned future has the result of fn.
+    ret = Future()
+    ret.set_running_or_notify_cancel()
+
+    def done(fut: Future):
+        try:
+            value, spans = fut.result()
+        except BaseException as e:
+            ret.set_exception(e)
+            return
+        recorder.extend(spans)
+        ret.set_result(value)
+
+    submit(_run_traced, name, fn, *args).add_done_callback(done)
+    return ret
+
+
+def job_name(fn: Callable) -> str:
+    while hasattr(fn, 'func'):
+        # functools.partial
+        fn = fn.func
+    return getattr(fn, '__name__', type(fn).__name__)
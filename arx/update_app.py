@@ -0,0 +1,157 @@
+import logging
+import mmap
+import os
+import struct
+
+from binascii import crc_hqx
+from os.path import isfile, join
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from arx.fileio import copy_range
+from arx.partitions import PartitionFilter
+from arx.scheduler import job_pool
+
+logger = logging.getLogger('rom_analyzer')
+
+# See huawei_firmware_extractor/data_structure for the layout
+UPDATE_APP_MAGIC = b'\x55\xAA\x5A\xA5'
+ENTRY_HEADER = struct.Struct('<4sII8sII16s16s16s16sHHH')
+DEFAULT_CRC_BLOCK_SIZE = 4096
+CRC_SEGMENT_SIZE = 64 * 1024 * 1024
+
+_BIT_REVERSE = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
+class UpdateAppError(Exception):
+    pass
+
+
+class UpdateAppEntry(NamedTuple):
+    file_type: str
+    hardware_id: str
+    file_seq: bytes
+    file_date: str
+    file_time: str
+    header_offset: int
+    data_offset: int
+    data_length: int
+    block_size: int
+    crcs: bytes  # one little endian CRC16 per block_size bytes of payload
+
+    @property
+    def file_name(self) -> str:
+        return self.file_type.replace(os.sep, '_') + '.img'
+
+
+def crc16_x25(data: bytes) -> int:
+    # CRC-16/X-25 (reflected CCITT), computed by the C crc_hqx (non reflected) on bit reversed input
+    crc = crc_hqx(data.translate(_BIT_REVERSE), 0xFFFF)
+    return (_BIT_REVERSE[crc & 0xFF] << 8 | _BIT_REVERSE[crc >> 8]) ^ 0xFFFF
+
+
+def _verify_crc_segment(update_app: str, offset: int, length: int, block_size: int, expected: bytes) -> bool:
+    with open(update_app, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        i = 0
+        for pos in range(offset, offset + length, block_size):
+            block = mm[pos:min(pos + block_size, offset + length)]
+            if struct.pack('<H', crc16_x25(block)) != expected[i:i + 2]:
+                return False
+            i += 2
+    return True
+
+
+def _str(raw: bytes) -> str:
+    return raw.split(b'\x00', 1)[0].decode(errors='replace').strip()
+
+
+class UpdateAppReader:
+
+    def __init__(self, update_app: str):
+        assert isfile(update_app)
+        self.path = update_app
+        self._f = open(update_app, 'rb')
+        try:
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._f.close()
+            raise UpdateAppError(f'{update_app} is empty')
+        self.entries = self._index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._mm.close()
+        self._f.close()
+
+    def _index(self) -> List[UpdateAppEntry]:
+        # One pass over the headers: payloads are skipped, never scanned for the magic
+        entries = []
+        size = len(self._mm)
+        pos = self._mm.find(UPDATE_APP_MAGIC, 0)
+        while 0 <= pos and pos + ENTRY_HEADER.size <= size:
+            _, header_length, _, hw_id, file_seq, data_length, file_date, file_time, file_type, _, _, block_size, _ = \
+                ENTRY_HEADER.unpack_from(self._mm, pos)
+            if header_length < ENTRY_HEADER.size:
+                raise UpdateAppError(f'Bad header length {header_length} at {pos:#x}')
+            data_offset = pos + header_length
+            if data_offset + data_length > size:
+                raise UpdateAppError(f'Truncated payload of {_str(file_type)} at {pos:#x}')
+            entries.append(UpdateAppEntry(
+                _str(file_type), _str(hw_id), struct.pack('<I', file_seq), _str(file_date), _str(file_time),
+                pos, data_offset, data_length, block_size or DEFAULT_CRC_BLOCK_SIZE,
+                self._mm[pos + ENTRY_HEADER.size:data_offset]))
+            # entries are 4 bytes aligned
+            pos = self._mm.find(UPDATE_APP_MAGIC, (data_offset + data_length + 3) & ~3)
+        if len(entries) == 0:
+            raise UpdateAppError(f'No entries found in {self.path}')
+        return entries
+
+    def select(self, partitions: Optional[Iterable[str]] = None) -> List[UpdateAppEntry]:
+        keep = PartitionFilter(partitions)
+        return [e for e in self.entries if keep(e.file_name)]
+
+    def extract(self, entry: UpdateAppEntry, dst_file: str) -> str:
+        out_fd = os.open(dst_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            copy_range(self._f.fileno(), entry.data_offset, out_fd, 0, entry.data_length)
+        finally:
+            os.close(out_fd)
+        return dst_file
+
+    def extract_all(self, dst_dir: str, partitions: Optional[Iterable[str]] = None, verify_crc: bool = True,
+                    workers: int = 1) -> Dict[str, str]:
+        # workers: processes checking the CRCs (see job_pool). The files of the entries whose CRCs
+        # don't match are removed, and UpdateAppError raised.
+        os.makedirs(dst_dir, exist_ok=True)
+        entries = self.select(partitions)
+        extracted = {}
+        with job_pool(workers) as pool:
+            checks = []
+            for e in entries:
+                if verify_crc:
+                    checks.extend((e, pool.submit(_verify_crc_segment, self.path, *seg)) for seg in self._crc_segments(e))
+                logger.info("extracting {} ({} bytes)".format(e.file_name, e.data_length))
+                extracted[e.file_type] = self.extract(e, join(dst_dir, e.file_name))
+            bad = {e.file_type for e, check in checks if not check.result()}
+        for file_type in bad:
+            os.remove(extracted.pop(file_type))
+        if len(bad) > 0:
+            raise UpdateAppError('CRC error in {} of {}'.format(', '.join(sorted(bad)), self.path))
+        return extracted
+
+    @staticmethod
+    def _crc_segments(entry: UpdateAppEntry):
+        n_blocks = -(-entry.data_length // entry.block_size)
+        if len(entry.crcs) < 2 * n_blocks:
+            logger.warning("No usable checksum for {}".format(entry.file_type))
+            return
+        blocks_per_segment = max(1, CRC_SEGMENT_SIZE // entry.block_size)
+        for first in range(0, n_blocks, blocks_per_segment):
+            offset = first * entry.block_size
+            length = min(blocks_per_segment * entry.block_size, entry.data_length - offset)
+            yield (entry.data_offset + offset, length, entry.block_size,
+                   entry.crcs[2 * first:2 * (first + blocks_per_segment)])
@@ -1,58 +1,64 @@
 import os
-import magic
 
 from collections import defaultdict
 from os.path import isdir, isfile
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Callable, Set
 from pathlib import Path
 
 
+from arx.classify import classify, YAFFS_HEADER
 from arx.shell_wrapper import findw
+from arx.workdir_index import WorkDirIndex
 
 
 def get_parent_folder(file_path: str) -> str:
     return str(Path(file_path).parent)
 
 
-def get_biggest_file(files_list: list) -> str:
+def get_biggest_file(files_list: list, index: Optional[WorkDirIndex] = None) -> str:
     assert files_list is not None
     assert len(files_list) > 0
 
+    getsize = os.path.getsize if index is None else index.size
     max_file = files_list[0]
-    max_size = os.path.getsize(max_file)
+    max_size = getsize(max_file)
     for f in files_list:
-        sz = os.path.getsize(f)
+        sz = getsize(f)
         if sz > max_size:
             max_file = f
             max_size = sz
     return max_file
 
 
-def find_biggest_archive(directory: str) -> Optional[str]:
+def find_biggest_archive(directory: str, index: Optional[WorkDirIndex] = None,
+                         among: Optional[Set[str]] = None) -> Optional[str]:
+    # among: only look at these files, e.g. what the last unpack produced
     assert os.path.isdir(directory)
-    archives = ["rar", "zip", "7z", "ftf", "md5"]
+    if index is None:
+        index = WorkDirIndex(directory)
+    archives = ["rar", "zip", "7z", "ftf", "md5", "tar"]
     for a in archives:
-        fw = findw(directory, '*' + a)
+        fw = findw(directory, '*' + a, index)
+        if fw is not None and among is not None:
+            fw = [f for f in fw if f in among] or None
         if fw is not None:
-            return get_biggest_file(fw)
+            return get_biggest_file(fw, index)
     return None
 
 
 def is_YAFFS(binary):
-    return open(binary, "rb").read(12).upper() == b"\x03\x00\x00\x00\x01\x00\x00\x00\xFF\xFF\x00\x00".upper()
+    with open(binary, "rb") as f:
+        return f.read(len(YAFFS_HEADER)) == YAFFS_HEADER
 
 
-def filetype_to_files(folder: str, filter_size_bytes: int = 10**7) -> Dict[str, List[str]]:
+def filetype_to_files(folder: str, filter_size_bytes: int = 10**7, index: Optional[WorkDirIndex] = None,
+                      select: Optional[Callable[[str], bool]] = None) -> Dict[str, List[str]]:
     assert os.path.isdir(folder)
+    if index is None:
+        index = WorkDirIndex(folder)
     diz = defaultdict(list)
-    for root, dirs, files in os.walk(folder, topdown=False):
-        for name in files:
-            file = os.path.join(root, name)
-            if os.path.getsize(file) > filter_size_bytes:
-                magic_type = magic.from_file(file)
-                if magic_type.startswith('Android sparse image'):
-                    magic_type = "".join(magic_type.split(',')[0:2])
-                if magic_type == 'data' and is_YAFFS(file):
-                    magic_type = 'YAFFS'
-                diz[magic_type].append(file)
+    for file in index.larger_than(filter_size_bytes, folder):
+        if select is not None and not select(file):
+            continue
+        diz[classify(file)].append(file)
     return diz
@@ -0,0 +1,153 @@
+import fnmatch
+import os
+import time
+
+from os.path import isdir, join
+from typing import Dict, Iterable, List, Optional
+
+# directories (or files in them) modified less than this many seconds before a scan may still
+# change without a visible directory mtime change, so their mtime is not trusted on the next refresh
+RACY_MTIME_SECONDS = 2
+
+
+class _DirEntry:
+    __slots__ = ('mtime_ns', 'files', 'subdirs')
+
+    def __init__(self, mtime_ns: Optional[int], files: Dict[str, int], subdirs: List[str]):
+        self.mtime_ns = mtime_ns
+        self.files = files  # name -> size
+        self.subdirs = subdirs
+
+
+class WorkDirIndex:
+    # In-memory view of a work directory: built with one walk, then kept up to date either by
+    # stages reporting what they produced (add/remove) or by refresh(), which only re-lists the
+    # directories whose mtime changed since the last scan.
+
+    def __init__(self, root: str):
+        assert isdir(root)
+        self.root = os.path.abspath(root)
+        self._dirs: Dict[str, _DirEntry] = {}
+        self.refresh()
+
+    def refresh(self, directory: Optional[str] = None):
+        directory = self.root if directory is None else os.path.abspath(directory)
+        stack = [directory]
+        seen = set()
+        while stack:
+            d = stack.pop()
+            seen.add(d)
+            try:
+                st = os.stat(d)
+            except OSError:
+                self._drop_tree(d)
+                continue
+            entry = self._dirs.get(d)
+            if entry is None or entry.mtime_ns is None or entry.mtime_ns != st.st_mtime_ns:
+                entry = self._scan_dir(d, st.st_mtime_ns)
+            # reversed, so that the walk is top-down in listing order
+            stack.extend(reversed(entry.subdirs))
+        for d in [d for d in self._dirs if d not in seen and self._is_under(d, directory)]:
+            del self._dirs[d]
+
+    def add(self, path: str):
+        path = os.path.abspath(path)
+        parent, name = os.path.split(path)
+        if isdir(path):
+            self.refresh(path)
+            entry = self._dirs.get(parent)
+            if entry is not None and path not in entry.subdirs:
+                entry.subdirs.append(path)
+            return
+        entry = self._dirs.get(parent)
+        if entry is None:
+            self.refresh(parent)
+            return
+        entry.files[name] = os.path.getsize(path)
+
+    def add_all(self, paths: Iterable[str]):
+        for p in paths:
+            self.add(p)
+
+    def remove(self, path: str):
+        path = os.path.abspath(path)
+        if path in self._dirs:
+            self._drop_tree(path)
+        parent, name = os.path.split(path)
+        entry = self._dirs.get(parent)
+        if entry is not None:
+            entry.files.pop(name, None)
+            if path in entry.subdirs:
+                entry.subdirs.remove(path)
+
+    def files(self, directory: Optional[str] = None) -> Iterable[str]:
+        for d, entry in self._walk(directory):
+            for name in entry.files:
+                yield join(d, name)
+
+    def find(self, tgt_file: str, directory: Optional[str] = None) -> Optional[str]:
+        for d, entry in self._walk(directory):
+            if tgt_file in entry.files:
+                return join(d, tgt_file)
+        return None
+
+    def findw(self, pattern: str, directory: Optional[str] = None) -> Optional[List[str]]:
+        lst_match = [join(d, name) for d, entry in self._walk(directory)
+                     for name in fnmatch.filter(entry.files, pattern)]
+        if len(lst_match) > 0:
+            return lst_match
+        return None
+
+    def larger_than(self, size_bytes: int, directory: Optional[str] = None) -> List[str]:
+        return [join(d, name) for d, entry in self._walk(directory)
+                for name, sz in entry.files.items() if sz > size_bytes]
+
+    def size(self, path: str) -> int:
+        parent, name = os.path.split(os.path.abspath(path))
+        entry = self._dirs.get(parent)
+        if entry is None or name not in entry.files:
+            return os.path.getsize(path)
+        return entry.files[name]
+
+    def _scan_dir(self, d: str, mtime_ns: int) -> _DirEntry:
+        files = {}
+        subdirs = []
+        newest_ns = mtime_ns
+        with os.scandir(d) as it:
+            for e in it:
+                try:
+                    if e.is_dir(follow_symlinks=False):
+                        subdirs.append(e.path)
+                    elif e.is_file():
+                        st = e.stat()
+                        files[e.name] = st.st_size
+                        newest_ns = max(newest_ns, st.st_mtime_ns)
+                except OSError:
+                    continue
+        # a file still being written does not change the directory mtime: list it again next time
+        if time.time() - newest_ns / 1e9 < RACY_MTIME_SECONDS:
+            mtime_ns = None
+        entry = _DirEntry(mtime_ns, files, subdirs)
+        self._dirs[d] = entry
+        return entry
+
+    def _walk(self, directory: Optional[str] = None):
+        directory = self.root if directory is None else os.path.abspath(directory)
+        if directory not in self._dirs:
+            self.refresh(directory)
+        stack = [directory]
+        while stack:
+            d = stack.pop()
+            entry = self._dirs.get(d)
+            if entry is None:
+                continue
+            yield d, entry
+            stack.extend(reversed(entry.subdirs))
+
+    def _drop_tree(self, directory: str):
+        for d in [d for d in self._dirs if self._is_under(d, directory)]:
+            del self._dirs[d]
+
+    @staticmethod
+    def _is_under(path: str, directory: str) -> bool:
+        return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
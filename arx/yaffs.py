@@ -0,0 +1,181 @@
+import os
+import stat
+import struct
+
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from arx.imagefs import ImageFileSystem, ImageFsError, DataRun, DirEntry, Stat
+
+# See yaffs_guts.h and yaffs_packedtags2.h. An image is a sequence of chunks, each followed by its
+# spare area holding the packed tags: sequence number, object id, chunk id (0 for the object
+# header, n for the n-th data chunk of a file) and number of data bytes.
+YAFFS_GEOMETRIES = ((2048, 64), (4096, 128), (8192, 256), (16384, 512), (1024, 32))  # chunk, spare
+YAFFS_TAGS = struct.Struct('<IIII')
+YAFFS_OBJECT_HEADER = struct.Struct('<II2x256s2xIIIIIIIi160sI')  # up to yst_rdev
+YAFFS_FILE_SIZE_HIGH_OFFSET = 496
+YAFFS_LOWEST_SEQUENCE_NUMBER = 0x00001000
+YAFFS_HIGHEST_SEQUENCE_NUMBER = 0xEFFFFF00
+YAFFS_ERASED = 0xFFFFFFFF
+YAFFS_PROBE_CHUNKS = 8
+
+YAFFS_OBJECTID_ROOT = 1
+YAFFS_OBJECTID_UNLINKED = 3
+YAFFS_OBJECTID_DELETED = 4
+
+YAFFS_OBJECT_TYPE_FILE = 1
+YAFFS_OBJECT_TYPE_SYMLINK = 2
+YAFFS_OBJECT_TYPE_DIRECTORY = 3
+YAFFS_OBJECT_TYPE_HARDLINK = 4
+YAFFS_OBJECT_TYPE_SPECIAL = 5
+_TYPE_MODES = {YAFFS_OBJECT_TYPE_FILE: stat.S_IFREG, YAFFS_OBJECT_TYPE_SYMLINK: stat.S_IFLNK,
+               YAFFS_OBJECT_TYPE_DIRECTORY: stat.S_IFDIR}
+
+# header chunks written by the kernel carry the object type and file size in the tags too
+EXTRA_HEADER_INFO_FLAG = 0x80000000
+EXTRA_OBJECT_TYPE_MASK = 0x0F << 28
+
+
+class YaffsObject(NamedTuple):
+    object_id: int
+    object_type: int
+    parent: int
+    name: str
+    mode: int
+    uid: int
+    gid: int
+    mtime: int
+    size: int
+    equiv_id: int  # hard links: the object they link to
+    alias: str  # symlinks: the target
+
+
+def _tags_plausible(seq: int, object_id: int, chunk_id: int, n_bytes: int, chunk_size: int) -> bool:
+    if seq == YAFFS_ERASED:
+        return True
+    if not YAFFS_LOWEST_SEQUENCE_NUMBER <= seq <= YAFFS_HIGHEST_SEQUENCE_NUMBER:
+        return False
+    return chunk_id == 0 or chunk_id & EXTRA_HEADER_INFO_FLAG != 0 or n_bytes <= chunk_size
+
+
+def yaffs2_geometry(head, size: int) -> Optional[Tuple[int, int]]:
+    # (chunk size, spare size) whose first chunks in head hold sensible tags, the first one an
+    # object header. size: of the whole image, a multiple of the chunk and spare size
+    for chunk_size, spare_size in YAFFS_GEOMETRIES:
+        stride = chunk_size + spare_size
+        n = min(YAFFS_PROBE_CHUNKS, size // stride)
+        if n == 0 or size % stride != 0 or len(head) < n * stride:
+            continue
+        seq, _, chunk_id, _ = YAFFS_TAGS.unpack(head[chunk_size:chunk_size + YAFFS_TAGS.size])
+        if seq == YAFFS_ERASED or chunk_id & ~EXTRA_HEADER_INFO_FLAG != 0 \
+                or not YAFFS_OBJECT_TYPE_FILE <= head[0] <= YAFFS_OBJECT_TYPE_SPECIAL:
+            continue
+        if all(_tags_plausible(*YAFFS_TAGS.unpack(head[off:off + YAFFS_TAGS.size]), chunk_size)
+               for off in range(chunk_size, n * stride, stride)):
+            return chunk_size, spare_size
+    return None
+
+
+def is_yaffs2_image(image: str) -> bool:
+    with open(image, 'rb') as f:
+        head = f.read(YAFFS_PROBE_CHUNKS * max(c + s for c, s in YAFFS_GEOMETRIES))
+        size = os.fstat(f.fileno()).st_size
+    return yaffs2_geometry(head, size) is not None
+
+
+class YaffsFileSystem(ImageFileSystem):
+    # YAFFS2 images (mkyaffs2image, NAND dumps with the spare areas), indexed in one pass over the
+    # tags of the chunks: the newest header of each object and the newest copy of each of its data
+    # chunks win, deleted objects are left out. Files are read in place from their chunks.
+
+    root_inode = YAFFS_OBJECTID_ROOT
+
+    def __init__(self, image: str, parts: Optional[List[str]] = None):
+        super().__init__(image, parts)
+        geometry = yaffs2_geometry(self._mm, len(self._mm))
+        if geometry is None:
+            self.close()
+            raise ImageFsError(f'{image} is not a YAFFS2 image')
+        self.chunk_size, self.spare_size = geometry
+        self.objects: Dict[int, YaffsObject] = {}
+        self._chunks: Dict[int, Dict[int, Tuple[int, int]]] = {}  # object -> chunk id -> offset, bytes
+        self._children: Dict[int, Dict[str, int]] = {}
+        self._index()
+
+    def _index(self):
+        stride = self.chunk_size + self.spare_size
+        headers: Dict[int, Tuple[int, int]] = {}  # object -> sequence number, offset of the newest header
+        newest: Dict[Tuple[int, int], int] = {}  # (object, chunk id) -> sequence number
+        for offset in range(0, len(self._mm) - stride + 1, stride):
+            seq, object_id, chunk_id, n_bytes = self._unpack(YAFFS_TAGS, offset + self.chunk_size)
+            if seq == YAFFS_ERASED or object_id == YAFFS_ERASED or seq == 0:
+                continue
+            if chunk_id & EXTRA_HEADER_INFO_FLAG:
+                object_id &= ~EXTRA_OBJECT_TYPE_MASK
+                chunk_id = 0
+            if chunk_id == 0:
+                # later in the image wins among equal sequence numbers, as in a block
+                if object_id not in headers or headers[object_id][0] <= seq:
+                    headers[object_id] = (seq, offset)
+            elif newest.get((object_id, chunk_id), -1) <= seq:
+                newest[(object_id, chunk_id)] = seq
+                self._chunks.setdefault(object_id, {})[chunk_id] = (offset, min(n_bytes, self.chunk_size))
+        for object_id, (_, offset) in headers.items():
+            obj = self._header(object_id, offset)
+            if obj.parent in (YAFFS_OBJECTID_UNLINKED, YAFFS_OBJECTID_DELETED):
+                continue
+            self.objects[object_id] = obj
+        if YAFFS_OBJECTID_ROOT not in self.objects:
+            # mkyaffs2image writes no header for the root
+            self.objects[YAFFS_OBJECTID_ROOT] = YaffsObject(YAFFS_OBJECTID_ROOT, YAFFS_OBJECT_TYPE_DIRECTORY,
+                                                            YAFFS_OBJECTID_ROOT, '', stat.S_IFDIR | 0o755, 0, 0, 0,
+                                                            0, 0, '')
+        for obj in self.objects.values():
+            if obj.object_id != YAFFS_OBJECTID_ROOT and obj.parent in self.objects:
+                self._children.setdefault(obj.parent, {})[obj.name] = obj.object_id
+
+    def _header(self, object_id: int, offset: int) -> YaffsObject:
+        object_type, parent, name, mode, uid, gid, _, mtime, _, size_low, equiv_id, alias, _ = \
+            self._unpack(YAFFS_OBJECT_HEADER, offset)
+        size_high, = self._unpack('<I', offset + YAFFS_FILE_SIZE_HIGH_OFFSET)
+        size = size_low if size_high == YAFFS_ERASED else size_high << 32 | size_low
+        if stat.S_IFMT(mode) == 0:
+            mode |= _TYPE_MODES.get(object_type, 0)
+        return YaffsObject(object_id, object_type, parent, _name(name), mode, uid, gid, mtime,
+                           size if object_type == YAFFS_OBJECT_TYPE_FILE else 0, equiv_id, _name(alias))
+
+    def _object(self, inode: int) -> YaffsObject:
+        obj = self.objects.get(inode)
+        if obj is None:
+            raise ImageFsError(f'No object {inode} in {self.path}')
+        if obj.object_type == YAFFS_OBJECT_TYPE_HARDLINK:
+            return self._object(obj.equiv_id) if obj.equiv_id != inode else obj
+        return obj
+
+    def _stat(self, inode: int) -> Stat:
+        obj = self._object(inode)
+        size = len(obj.alias.encode(errors='surrogateescape')) if obj.object_type == YAFFS_OBJECT_TYPE_SYMLINK \
+            else obj.size
+        nlink = 2 if obj.object_type == YAFFS_OBJECT_TYPE_DIRECTORY else 1
+        return Stat(obj.object_id, obj.mode, size, obj.uid, obj.gid, obj.mtime, nlink)
+
+    def _dir_entries(self, inode: int) -> Iterator[DirEntry]:
+        for name, object_id in self._children.get(self._object(inode).object_id, {}).items():
+            # hard links are entries of the object they link to
+            yield DirEntry(name, self._object(object_id).object_id)
+
+    def _data_runs(self, inode: int) -> List[DataRun]:
+        obj = self._object(inode)
+        runs = []
+        for chunk_id, (offset, n_bytes) in sorted(self._chunks.get(obj.object_id, {}).items()):
+            start = (chunk_id - 1) * self.chunk_size
+            length = min(n_bytes, obj.size - start)
+            if length > 0:
+                runs.append((start, offset, length))
+        return runs
+
+    def _readlink(self, inode: int) -> str:
+        return self._object(inode).alias
+
+
+def _name(raw: bytes) -> str:
+    return raw.split(b'\x00', 1)[0].decode(errors='surrogateescape')
@@ -5,49 +5,100 @@
 #include <unistd.h>
 
 
+/* the options arx mounts the images with (see arx.mounts.mount_options), and safe restrictions */
+static const char * const MOUNT_OPTIONS[] = {"loop", "ro", "rw", "noatime", "noload", "nodev", "nosuid", "noexec", NULL};
+#define MAX_OPTIONS_LENGTH 256
+
+
 void usage() {
-    printf("Wrong arguments! No usage, self-explanatory code :)\n");
+    printf("Usage: wrapper mount <image> <dir> [<options>] | umount <dir> [lazy] | chmod <dir>\n");
+    printf("Mount options: loop (required), ro, rw, noatime, noload, nodev, nosuid, noexec\n");
+}
+
+
+/* 1 when options is a comma separated list of MOUNT_OPTIONS including loop: anything else (offset,
+ * sizelimit, uid, context, ...) could mount what the caller is not allowed to read or write. */
+int allowed_mount_options(const char *options) {
+    char buf[MAX_OPTIONS_LENGTH + 1];
+    char *option, *saveptr = NULL;
+    int loop = 0;
+
+    if (strlen(options) > MAX_OPTIONS_LENGTH) {
+        return 0;
+    }
+    strcpy(buf, options);
+    /* strtok would skip empty options */
+    if (buf[0] == ',' || buf[strlen(buf) - 1] == ',' || strstr(buf, ",,") != NULL) {
+        return 0;
+    }
+    for (option = strtok_r(buf, ",", &saveptr); option != NULL; option = strtok_r(NULL, ",", &saveptr)) {
+        int i;
+        for (i = 0; MOUNT_OPTIONS[i] != NULL && strcmp(option, MOUNT_OPTIONS[i]) != 0; i++) {
+        }
+        if (MOUNT_OPTIONS[i] == NULL) {
+            fprintf(stderr, "Mount option not allowed: %s\n", option);
+            return 0;
+        }
+        loop |= strcmp(option, "loop") == 0;
+    }
+    return loop;
 }
 
 
-/* Bad and insecure code! Use at your own risk! I'm not responsible for any damages or loss  */
+/* Runs mount, umount or chmod as root. The arguments are passed as they are, without any shell, and
+ * the exit status is the one of the command: 0 only when it succeeded. Only the mount options of
+ * MOUNT_OPTIONS are passed on. */
 int main(int argc, char ** const argv) {
-    char cmd[2048] = {0};
+    char *cmd[8] = {0};
 
-    if (argc < 3 || argc > 4) {
+    if (argc < 3 || argc > 5) {
         usage();
         return -1;
     }
 
-    if (strcmp(argv[1], "mount") == 0) {
-        strcpy(cmd, "mount ");
-        strcat(cmd, argv[2]);
-        strcat(cmd, " ");
-        strcat(cmd, argv[3]);
+    if (strcmp(argv[1], "mount") == 0 && argc >= 4) {
+        if (argc == 5 && !allowed_mount_options(argv[4])) {
+            usage();
+            return -1;
+        }
+        cmd[0] = "mount";
+        cmd[1] = "-o";
+        cmd[2] = argc == 5 ? argv[4] : "loop";
+        cmd[3] = "--";
+        cmd[4] = argv[2];
+        cmd[5] = argv[3];
     }
 
-    if (strcmp(argv[1], "umount") == 0) {
-        strcpy(cmd, "umount ");
-        strcat(cmd, argv[2]);
+    if (strcmp(argv[1], "umount") == 0 && argc <= 4) {
+        cmd[0] = "umount";
+        if (argc == 4 && strcmp(argv[3], "lazy") == 0) {
+            cmd[1] = "-l";
+            cmd[2] = "--";
+            cmd[3] = argv[2];
+        } else if (argc == 3) {
+            cmd[1] = "--";
+            cmd[2] = argv[2];
+        }
     }
 
-    if (strcmp(argv[1], "chmod") == 0) {
-        strcpy(cmd, "chmod -R 777 ");
-        strcat(cmd, argv[2]);
+    if (strcmp(argv[1], "chmod") == 0 && argc == 3) {
+        cmd[0] = "chmod";
+        cmd[1] = "-R";
+        cmd[2] = "777";
+        cmd[3] = "--";
+        cmd[4] = argv[2];
     }
 
-    if (strlen(cmd) < 1) {
+    if (cmd[0] == NULL || (strcmp(cmd[0], "umount") == 0 && cmd[1] == NULL)) {
         usage();
         return -1;
     }
 
-    if (setuid(0) == 0) {
-        printf("$ %s\n", cmd);
-        return system(cmd);
-    } else {
+    if (setuid(0) != 0) {
         perror("You must run it as root");
+        return -1;
     }
-
-    return 0;
+    execvp(cmd[0], cmd);
+    perror(cmd[0]);
+    return 127;
 }
-
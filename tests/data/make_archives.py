@@ -0,0 +1,199 @@
+# Writes the 7z and RAR fixtures of test_archive.py next to this file, byte by byte after
+# 7zFormat.txt, technote.txt (RAR 4) and the RAR 5.0 archive format: neither 7za nor rar is
+# needed. Members are stored (copy coder, RAR method 0), so the data is readable as is.
+import lzma
+import os
+import struct
+import zlib
+
+from os.path import dirname, join, realpath
+from typing import Optional
+
+DATA_DIR = dirname(realpath(__file__))
+
+SEVEN_ZIP_MAGIC = b'7z\xBC\xAF\x27\x1C'
+RAR_MAGIC = b'Rar!\x1A\x07'
+CODER_COPY = b'\x00'
+CODER_LZMA = b'\x03\x01\x01'
+CODER_AES = b'\x06\xF1\x07\x01'
+
+# (name, data): None for a directory
+MEMBERS = [('system/build.prop', b'ro.build.id=ARX01\n'), ('system.img', bytes(range(256)) * 4),
+           ('system', None), ('empty.txt', b'')]
+
+
+def number(value: int) -> bytes:
+    # 7z NUMBER, small values only
+    assert value < 0x4000
+    return bytes([value]) if value < 0x80 else bytes([0x80 | value >> 8, value & 0xFF])
+
+
+def vint(value: int) -> bytes:
+    ret = bytearray()
+    while True:
+        ret.append(value & 0x7F | (0x80 if value > 0x7F else 0))
+        value >>= 7
+        if value == 0:
+            return bytes(ret)
+
+
+def bits(flags) -> bytes:
+    ret = bytearray((len(flags) + 7) // 8)
+    for i, f in enumerate(flags):
+        if f:
+            ret[i // 8] |= 0x80 >> i % 8
+    return bytes(ret)
+
+
+def crc(data: bytes) -> bytes:
+    return struct.pack('<I', zlib.crc32(data))
+
+
+def folder(coders) -> bytes:
+    # (coder id, properties) of single input/output coders, the first one unpacks the last
+    ret = number(len(coders))
+    for coder_id, props in coders:
+        ret += bytes([len(coder_id) | (0x20 if props else 0)]) + coder_id
+        if props:
+            ret += number(len(props)) + props
+    for i in range(len(coders) - 1):
+        # bind pair: input of coder i <- output of coder i + 1
+        ret += number(i) + number(i + 1)
+    return ret
+
+
+def streams_info(pack_pos: int, pack_size: int, coders, unpack_sizes, substreams=None) -> bytes:
+    ret = b'\x06' + number(pack_pos) + number(1) + b'\x09' + number(pack_size) + b'\x00'
+    ret += b'\x07\x0B' + number(1) + b'\x00' + folder(coders)
+    ret += b'\x0C' + b''.join(number(s) for s in unpack_sizes) + b'\x00'
+    if substreams is not None:
+        ret += b'\x08\x0D' + number(len(substreams)) + b'\x09' + b''.join(number(len(s)) for s in substreams[:-1])
+        ret += b'\x0A\x01' + b''.join(crc(s) for s in substreams) + b'\x00'
+    return ret + b'\x00'
+
+
+def seven_zip_header(coders, data_size: int) -> bytes:
+    streams = [data for _, data in MEMBERS if data]
+    empty_stream = [not data for _, data in MEMBERS]
+    empty_file = [data is not None for _, data in MEMBERS if not data]
+    names = b''.join((name + '\x00').encode('utf-16-le') for name, _ in MEMBERS)
+    unpack_sizes = [sum(len(s) for s in streams)] + [data_size] * (len(coders) - 1)
+    files = number(len(MEMBERS))
+    for prop, value in ((0x0E, bits(empty_stream)), (0x0F, bits(empty_file)), (0x11, b'\x00' + names)):
+        files += bytes([prop]) + number(len(value)) + value
+    return b'\x01\x04' + streams_info(0, data_size, coders, unpack_sizes, streams) + b'\x05' + files + b'\x00\x00'
+
+
+def seven_zip(data: bytes, header: bytes) -> bytes:
+    start = struct.pack('<QQ', len(data), len(header)) + crc(header)
+    return SEVEN_ZIP_MAGIC + b'\x00\x04' + crc(start) + start + data + header
+
+
+def encoded_header(header: bytes, data_size: int, encrypted: bool) -> bytes:
+    # the header LZMA packed after the data of the members, and AES encrypted: random bytes
+    lzma_props = bytes([(2 * 5 + 0) * 9 + 3]) + struct.pack('<I', 1 << 16)
+    packed = lzma.compress(header, lzma.FORMAT_RAW, filters=[{'id': lzma.FILTER_LZMA1, 'dict_size': 1 << 16}])
+    coders = [(CODER_LZMA, lzma_props)]
+    unpack_sizes = [len(header)]
+    if encrypted:
+        packed = os.urandom(-(-len(packed) // 16) * 16)
+        coders.append((CODER_AES, b'\x13\x07' + os.urandom(8)))
+        unpack_sizes.append(len(packed))
+    return packed, b'\x17' + streams_info(data_size, len(packed), coders, unpack_sizes)
+
+
+def write_7z():
+    data = b''.join(data for _, data in MEMBERS if data)
+    header = seven_zip_header([(CODER_COPY, b'')], len(data))
+    plain = seven_zip(data, header)
+    packed, encoded = encoded_header(header, len(data), False)
+    encrypted, encrypted_encoded = encoded_header(header, len(data), True)
+    files = {
+        'plain.7z': plain,
+        'encoded_header.7z': seven_zip(data + packed, encoded),
+        # 7za a -p: the data is encrypted, the listing is not
+        'encrypted_files.7z': seven_zip(data, seven_zip_header([(CODER_COPY, b''), (CODER_AES, b'\x13\x07')],
+                                                               len(data))),
+        # 7za a -p -mhe: the listing too
+        'encrypted_header.7z': seven_zip(data + encrypted, encrypted_encoded),
+        'truncated.7z': plain[:len(plain) - len(header) // 2],
+    }
+    for name, content in files.items():
+        with open(join(DATA_DIR, name), 'wb') as f:
+            f.write(content)
+
+
+def rar4_block(block_type: int, flags: int, body: bytes = b'') -> bytes:
+    head = struct.pack('<BHH', block_type, flags, 7 + len(body)) + body
+    return struct.pack('<H', zlib.crc32(head) & 0xFFFF) + head
+
+
+def rar4(file_flags: int = 0, encrypted_header: bool = False) -> bytes:
+    ret = RAR_MAGIC + b'\x00' + rar4_block(0x73, 0x0080 if encrypted_header else 0, bytes(6))
+    if encrypted_header:
+        return ret + os.urandom(256)
+    for name, data in MEMBERS[:3]:
+        flags = 0x8000 | file_flags | (0x00E0 if data is None else 0)
+        raw_name = name.replace('/', '\\').encode()
+        body = struct.pack('<IIBIIBBHI', len(data or b''), len(data or b''), 2, zlib.crc32(data or b''), 0, 29, 0x30,
+                           len(raw_name), 0x10 if data is None else 0x20) + raw_name
+        ret += rar4_block(0x74, flags, body) + (data or b'')
+    return ret + rar4_block(0x7B, 0x4000)
+
+
+def rar5_block(header_type: int, body: bytes = b'', data: Optional[bytes] = None, extra: bytes = b'') -> bytes:
+    # data: of file headers, empty for directories
+    flags = (0x1 if extra else 0) | (0x2 if data is not None else 0)
+    head = vint(header_type) + vint(flags)
+    if extra:
+        head += vint(len(extra))
+    if data is not None:
+        head += vint(len(data))
+    head = vint(len(head + body + extra)) + head + body + extra
+    return crc(head) + head + (data or b'')
+
+
+def rar5(encrypted_files: bool = False, encrypted_header: bool = False) -> bytes:
+    ret = RAR_MAGIC + b'\x01\x00'
+    if encrypted_header:
+        # version, flags (password check), KDF count, salt, check value
+        return ret + rar5_block(4, vint(0) + vint(1) + bytes([15]) + os.urandom(16) + os.urandom(12)) + os.urandom(256)
+    ret += rar5_block(1, vint(0))
+    for name, data in MEMBERS[:3]:
+        file_flags = 0x2 | (0x1 if data is None else 0x4)
+        body = vint(file_flags) + vint(len(data or b'')) + vint(0x10 if data is None else 0x20) + struct.pack('<I', 0)
+        if data is not None:
+            body += crc(data)
+        # stored, Windows
+        body += vint(0) + vint(0) + vint(len(name)) + name.encode()
+        extra = b''
+        if encrypted_files and data is not None:
+            record = vint(1) + vint(0) + vint(0) + bytes([15]) + os.urandom(32)
+            extra = vint(len(record)) + record
+        ret += rar5_block(2, body, data or b'', extra)
+    return ret + rar5_block(5, vint(0))
+
+
+def write_rar():
+    plain5 = rar5()
+    files = {
+        'plain4.rar': rar4(),
+        # rar a -p: per file password flag
+        'encrypted_files4.rar': rar4(file_flags=0x0004),
+        # rar a -hp: the headers that follow the main one are encrypted
+        'encrypted_header4.rar': rar4(encrypted_header=True),
+        'truncated4.rar': rar4()[:40],
+        'plain5.rar': plain5,
+        'encrypted_files5.rar': rar5(encrypted_files=True),
+        'encrypted_header5.rar': rar5(encrypted_header=True),
+        # in the middle of the first file header
+        'truncated5.rar': plain5[:len(RAR_MAGIC) + 2 + len(rar5_block(1, vint(0))) + 12],
+    }
+    for name, content in files.items():
+        with open(join(DATA_DIR, name), 'wb') as f:
+            f.write(content)
+
+
+if __name__ == '__main__':
+    write_7z()
+    write_rar()
@@ -0,0 +1,119 @@
+import os
+import struct
+import zipfile
+
+from os.path import dirname, join, realpath
+
+import pytest
+
+from arx import archive
+from arx.archive import ARCHIVE_7Z, ARCHIVE_RAR, PASSWORDS, ArchiveInfo, probe_archive, unpack
+
+# written by data/make_archives.py
+DATA_DIR = join(dirname(realpath(__file__)), 'data')
+MEMBERS = ['system/build.prop', 'system.img']
+SEVEN_ZIP_MEMBERS = MEMBERS + ['empty.txt']
+ZIP_DEFLATE64 = 9
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('plain.7z', ArchiveInfo(ARCHIVE_7Z, False, SEVEN_ZIP_MEMBERS)),
+    ('encoded_header.7z', ArchiveInfo(ARCHIVE_7Z, False, SEVEN_ZIP_MEMBERS)),
+    ('encrypted_files.7z', ArchiveInfo(ARCHIVE_7Z, True, SEVEN_ZIP_MEMBERS)),
+    ('encrypted_header.7z', ArchiveInfo(ARCHIVE_7Z, True, None)),
+    ('plain4.rar', ArchiveInfo(ARCHIVE_RAR, False, MEMBERS)),
+    ('encrypted_files4.rar', ArchiveInfo(ARCHIVE_RAR, True, MEMBERS)),
+    ('encrypted_header4.rar', ArchiveInfo(ARCHIVE_RAR, True, None)),
+    ('plain5.rar', ArchiveInfo(ARCHIVE_RAR, False, MEMBERS)),
+    ('encrypted_files5.rar', ArchiveInfo(ARCHIVE_RAR, True, MEMBERS)),
+    ('encrypted_header5.rar', ArchiveInfo(ARCHIVE_RAR, True, None)),
+    ('truncated.7z', None),
+    ('truncated4.rar', None),
+    ('truncated5.rar', None),
+])
+def test_probe(name, expected):
+    assert probe_archive(join(DATA_DIR, name)) == expected
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    # (backend, archive, selected, password) of the calls, which all fail
+    calls = []
+
+    def fake(backend):
+        def extract(archive_path, dst_dir, selected, password):
+            calls.append((backend, os.path.basename(archive_path), selected, password))
+            return False
+        return extract
+
+    monkeypatch.setattr(archive, '_extract_7za', fake('7za'))
+    monkeypatch.setattr(archive, '_extract_unrar', fake('unrar'))
+    return calls
+
+
+def test_unpack_selected(backends, tmp_path):
+    assert unpack(join(DATA_DIR, 'plain.7z'), str(tmp_path), keep=lambda m: m.endswith('.img')) is False
+    assert unpack(join(DATA_DIR, 'plain5.rar'), str(tmp_path), keep=lambda m: m.endswith('.img')) is False
+    assert backends == [('7za', 'plain.7z', ['system.img'], None), ('unrar', 'plain5.rar', ['system.img'], None)]
+    # nothing selected, nothing to run
+    assert unpack(join(DATA_DIR, 'plain4.rar'), str(tmp_path), keep=lambda m: m.endswith('.bin')) is True
+    assert len(backends) == 2
+
+
+def test_unpack_encrypted(backends, tmp_path):
+    assert unpack(join(DATA_DIR, 'encrypted_header.7z'), str(tmp_path), keep=lambda m: True) is False
+    assert backends == [('7za', 'encrypted_header.7z', None, p) for p in PASSWORDS]
+
+
+def test_unpack_unknown(tmp_path):
+    assert unpack(join(DATA_DIR, 'truncated5.rar'), str(tmp_path)) is None
+
+
+def _zip(path: str, compression: int) -> str:
+    with zipfile.ZipFile(path, 'w', compression) as zf:
+        zf.writestr('system/build.prop', b'ro.build.id=ARX01\n' * 64)
+        zf.writestr('system.img', bytes(range(256)) * 64)
+    return path
+
+
+def test_zip_extracted(backends, tmp_path):
+    out = tmp_path / 'out'
+    out.mkdir()
+    assert unpack(_zip(str(tmp_path / 'rom.zip'), zipfile.ZIP_DEFLATED), str(out)) is True
+    assert (out / 'system.img').read_bytes() == bytes(range(256)) * 64
+    assert backends == []
+
+
+def test_zip_unsupported_method(backends, tmp_path):
+    path = _zip(str(tmp_path / 'rom.zip'), zipfile.ZIP_STORED)
+    # Deflate64 in the local and central headers of every member: zipfile can't extract it
+    with open(path, 'r+b') as f:
+        data = bytearray(f.read())
+        for magic, offset in ((b'PK\x03\x04', 8), (b'PK\x01\x02', 10)):
+            pos = data.find(magic)
+            while pos >= 0:
+                struct.pack_into('<H', data, pos + offset, ZIP_DEFLATE64)
+                pos = data.find(magic, pos + 4)
+        f.seek(0)
+        f.write(data)
+    out = tmp_path / 'out'
+    out.mkdir()
+    assert unpack(path, str(out)) is False
+    assert backends == [('7za', 'rom.zip', None, None)]
+    assert os.listdir(str(out)) == []
+
+
+def test_zip_corrupted_member(backends, tmp_path):
+    path = _zip(str(tmp_path / 'rom.zip'), zipfile.ZIP_DEFLATED)
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo('system.img')
+    # in the middle of the deflate stream of system.img
+    with open(path, 'r+b') as f:
+        f.seek(info.header_offset + 30 + len(info.filename) + info.compress_size // 2)
+        f.write(b'\xff\xff\xff\xff')
+    out = tmp_path / 'out'
+    out.mkdir()
+    assert unpack(path, str(out), keep=lambda m: m == 'system.img') is False
+    assert backends == [('7za', 'rom.zip', ['system.img'], None)]
+    # the partial member is not left behind
+    assert not (out / 'system.img').exists()
@@ -0,0 +1,22 @@
+import json
+import shutil
+
+import pytest
+
+from arx.batch import result_paths
+from arx.fixtures import make_ext4_image
+from arx.imagefs import open_filesystem
+from arx.mounts import MountManager
+
+
+@pytest.mark.skipif(shutil.which('mke2fs') is None, reason='needs e2fsprogs')
+def test_result_paths(tmp_path):
+    image = make_ext4_image(str(tmp_path / 'system.img'), 4 * 1024 * 1024)
+    mounts = MountManager(max_mounts=None)
+    # as mount() records it, without mounting
+    mounts._mounts.append((str(tmp_path / 'vendor.img'), str(tmp_path / 'mnt'), None))
+    with open_filesystem(image) as fs:
+        result = {'system.img': fs, 'vendor.img': str(tmp_path / 'mnt'), 'boot.img': str(tmp_path / 'boot.img')}
+        paths = result_paths(result, mounts)
+    assert json.loads(json.dumps(paths)) == {'system.img': image, 'vendor.img': str(tmp_path / 'vendor.img'),
+                                             'boot.img': str(tmp_path / 'boot.img')}
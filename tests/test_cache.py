@@ -0,0 +1,64 @@
+import os
+
+from arx.cache import ExtractionCache
+
+
+def _write(path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_put_get(tmp_path):
+    cache = ExtractionCache(str(tmp_path / 'cache'), 1 << 20)
+    rom = _write(tmp_path / 'rom.zip', b'rom')
+    system = _write(tmp_path / 'work' / 'system.img', b'system' * 100)
+    vendor = _write(tmp_path / 'work' / 'vendor.img', b'vendor' * 100)
+    key = cache.rom_key(rom)
+    assert cache.get(key, str(tmp_path / 'out')) is None
+    cache.put(key, [system, vendor], {'mounts': 2})
+    files, meta = cache.get(key, str(tmp_path / 'out'))
+    assert meta == {'mounts': 2}
+    assert [os.path.basename(f) for f in files] == ['system.img', 'vendor.img']
+    assert [open(f, 'rb').read() for f in files] == [b'system' * 100, b'vendor' * 100]
+    # content addressed: same bytes elsewhere, same key; other bytes, other key
+    assert cache.rom_key(_write(tmp_path / 'copy.zip', b'rom')) == key
+    assert cache.rom_key(_write(tmp_path / 'other.zip', b'ROM')) != key
+    assert cache.rom_key(rom, 'system') != key
+    assert [n for n in os.listdir(str(tmp_path / 'cache')) if n.startswith('.tmp_')] == []
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ExtractionCache(str(tmp_path / 'cache'), 2500)
+    images = [_write(tmp_path / 'work' / '{}.img'.format(i), bytes([i]) * 1000) for i in range(3)]
+    keys = [cache.key('image', str(i)) for i in range(3)]
+    cache.put(keys[0], [images[0]], {})
+    cache.put(keys[1], [images[1]], {})
+    # the second one last used long ago, the first one is not the least recently used anymore
+    entries = {os.path.basename(e): e for _, _, e in cache.entries()}
+    os.utime(os.path.join(entries[keys[1]], 'manifest.json'), (1, 1))
+    cache.put(keys[2], [images[2]], {})
+    assert sorted(os.path.basename(e) for _, _, e in cache.entries()) == sorted([keys[0], keys[2]])
+    assert sum(size for _, size, _ in cache.entries()) <= cache.max_bytes
+
+
+def test_cached_artifact(tmp_path):
+    cache = ExtractionCache(str(tmp_path / 'cache'), 1 << 20, intermediates=True)
+    inputs = [_write(tmp_path / 'a' / 'system.transfer.list', b'4\n'), _write(tmp_path / 'a' / 'system.new.dat', b'd')]
+    runs = []
+
+    def producer(output):
+        def produce():
+            runs.append(output)
+            _write(tmp_path / output, b'image')
+            return True
+        return produce
+
+    output = str(tmp_path / 'a' / 'system.img')
+    assert cache.cached_artifact('sdat2img', inputs, output, producer('a/system.img'))
+    # same inputs in another work folder: copied from the cache, not produced again
+    inputs = [_write(tmp_path / 'b' / 'system.transfer.list', b'4\n'), _write(tmp_path / 'b' / 'system.new.dat', b'd')]
+    output = str(tmp_path / 'b' / 'system.img')
+    assert cache.cached_artifact('sdat2img', inputs, output, producer('b/system.img'))
+    assert runs == ['a/system.img']
+    assert open(output, 'rb').read() == b'image'
@@ -0,0 +1,19 @@
+import struct
+
+from arx.classify import FileClassifier
+from arx.sparse_image import SPARSE_HEADER, SPARSE_HEADER_MAGIC
+
+
+def test_sparse_header():
+    header = SPARSE_HEADER.pack(SPARSE_HEADER_MAGIC, 1, 0, SPARSE_HEADER.size, 12, 4096, 1, 1, 0)
+    classifier = FileClassifier(use_libmagic=False)
+    assert classifier.classify_header(header, 'system.img') == 'Android sparse image, version: 1.0'
+    # the magic alone, or a header cut short, is no sparse image
+    for n in (4, 6, SPARSE_HEADER.size - 1):
+        assert classifier.classify_header(header[:n], 'system.img') is None
+
+
+def test_unknown_file(tmp_path):
+    blob = tmp_path / 'blob.bin'
+    blob.write_bytes(struct.pack('<I', 0x12345678) * 16)
+    assert FileClassifier(use_libmagic=False).classify(str(blob)) == 'data'
@@ -0,0 +1,52 @@
+import asyncio
+import sys
+import time
+
+from arx import commands
+from arx.commands import run, run_async, set_max_tools
+
+
+def test_run():
+    result = run([sys.executable, '-c', 'import sys; print("\\n".join(map(str, range(1000)))); sys.exit(3)'])
+    assert (result.returncode, result.lines, result.ok) == (3, 1000, False)
+    lines = result.output.splitlines()
+    assert lines[:2] == ['0', '1'] and lines[-1] == '999'
+    assert '[... {} lines ...]'.format(1000 - commands.HEAD_LINES - commands.TAIL_LINES) in lines
+
+
+def test_timeout():
+    start = time.time()
+    result = run([sys.executable, '-c', 'import time; time.sleep(30)'], timeout=0.5)
+    assert result.timed_out and not result.ok
+    assert time.time() - start < 10
+
+
+def test_run_async_limit(tmp_path):
+    set_max_tools(2, str(tmp_path / 'slots'))
+    try:
+        sleep = [sys.executable, '-c', 'import time; time.sleep(0.5)']
+
+        async def three():
+            return await asyncio.gather(*(run_async(sleep) for _ in range(3)))
+
+        loop = asyncio.new_event_loop()
+        start = time.time()
+        try:
+            results = loop.run_until_complete(three())
+        finally:
+            loop.close()
+        # two at once, then the third one
+        assert all(r.ok for r in results)
+        assert time.time() - start >= 1.0
+    finally:
+        set_max_tools(None)
+
+
+def test_slots_per_invocation():
+    set_max_tools(1)
+    first = commands._tools
+    set_max_tools(1)
+    try:
+        assert first.slots != commands._tools.slots
+    finally:
+        set_max_tools(None)
@@ -0,0 +1,27 @@
+import shutil
+import subprocess
+
+import pytest
+
+from arx.ext4 import Ext4FileSystem
+from arx.fixtures import make_ext4_image
+
+pytestmark = pytest.mark.skipif(shutil.which('mke2fs') is None or shutil.which('debugfs') is None,
+                                reason='needs e2fsprogs')
+
+
+def _debugfs(image: str, *requests: str):
+    for r in requests:
+        subprocess.run(['debugfs', '-w', '-R', r, image], check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+
+
+def test_stat_owner_and_links(tmp_path):
+    image = make_ext4_image(str(tmp_path / 'system.img'), 4 * 1024 * 1024)
+    _debugfs(image, 'sif /build.prop uid 1000', 'sif /build.prop gid 1234', 'sif /build.prop links_count 3')
+    with Ext4FileSystem(image) as fs:
+        st = fs.stat('/build.prop')
+        assert (st.st_uid, st.st_gid, st.st_nlink) == (1000, 1234, 3)
+        assert st.st_size == len(fs.read('/build.prop'))
+        assert fs.stat('/').st_nlink >= 3
+
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import sqlite3
+import zipfile
+
+from arx import inventory
+from arx.inventory import BATCH_BYTES, BATCH_FILES, Entry, write_inventory
+
+DEX = b'dex\n035\0' + bytes(range(256)) * 16
+
+
+def _tree(root):
+    (root / 'app' / 'Settings').mkdir(parents=True)
+    with zipfile.ZipFile(str(root / 'app' / 'Settings' / 'Settings.apk'), 'w') as zf:
+        zf.writestr('AndroidManifest.xml', b'\3\0\x08\0' * 64)
+        zf.writestr('classes.dex', DEX)
+    with zipfile.ZipFile(str(root / 'app' / 'Settings' / 'resources.zip'), 'w') as zf:
+        zf.writestr('res/values.xml', b'<resources/>')
+    (root / 'framework').mkdir()
+    (root / 'framework' / 'classes.dex').write_bytes(DEX)
+    (root / 'build.prop').write_bytes(b'ro.build.id=ARX01\n')
+    os.symlink('/system/bin/toybox', str(root / 'ls'))
+
+
+def _files(manifest: str):
+    db = sqlite3.connect(manifest)
+    try:
+        return {(r[0], r[1]): r[2:] for r in db.execute(
+            'SELECT partition, path, link, sha256, is_apk, is_dex FROM files')}
+    finally:
+        db.close()
+
+
+def test_inventory(tmp_path):
+    system = tmp_path / 'system'
+    _tree(system)
+    boot = tmp_path / 'boot.img'
+    boot.write_bytes(b'ANDROID!' + bytes(4096))
+    manifest = str(tmp_path / 'inventory.sqlite')
+    assert write_inventory({'system': str(system), 'boot': str(boot)}, manifest, workers=2) == 5
+    files = _files(manifest)
+    assert files[('system', '/build.prop')] == (None, hashlib.sha256(b'ro.build.id=ARX01\n').hexdigest(), 0, 0)
+    assert files[('system', '/app/Settings/Settings.apk')][2:] == (1, 0)
+    # a zip, but no APK
+    assert files[('system', '/app/Settings/resources.zip')][2:] == (0, 0)
+    assert files[('system', '/framework/classes.dex')][2:] == (0, 1)
+    assert files[('system', '/ls')] == ('/system/bin/toybox', None, None, None)
+    assert files[('system', '/app')][1] is None
+    assert files[('boot', 'boot.img')][1] == hashlib.sha256(boot.read_bytes()).hexdigest()
+
+
+def test_reuses_hashes(tmp_path):
+    system = tmp_path / 'system'
+    _tree(system)
+    manifest = str(tmp_path / 'inventory.sqlite')
+    write_inventory({'system': str(system)}, manifest, workers=1)
+    first = _files(manifest)
+    # same device, inode, size and mtime: not hashed again
+    assert write_inventory({'system': str(system)}, manifest, workers=1) == 0
+    assert _files(manifest) == first
+    with open(str(system / 'build.prop'), 'ab') as f:
+        f.write(b'ro.debuggable=1\n')
+    assert write_inventory({'system': str(system)}, manifest, workers=1) == 1
+    assert _files(manifest)[('system', '/build.prop')][1] != first[('system', '/build.prop')][1]
+
+
+def test_batches():
+    def entry(i, size):
+        return Entry('system', '/f{}'.format(i), size, 0o100644, 0, 0, 0, None, 'dev', i)
+
+    big = entry(0, BATCH_BYTES + 1)
+    small = [entry(i, 10) for i in range(1, BATCH_FILES + 2)]
+    batches = list(inventory._batches(small + [big]))
+    # the big file first and alone, then the small ones up to BATCH_FILES at a time
+    assert batches[0] == [big]
+    assert [len(b) for b in batches[1:]] == [BATCH_FILES, 1]
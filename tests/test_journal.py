@@ -0,0 +1,91 @@
+import json
+import logging
+
+from arx import journal as journal_module
+from arx.journal import JOURNAL, Journal
+
+RUN = {'rom': '/roms/fixture.zip', 'size': 1}
+
+
+def _write(path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def test_torn_line(tmp_path):
+    journal = Journal(str(tmp_path), RUN)
+    _write(tmp_path / 'unpacked' / 'system.img', b'system' * 1000)
+    journal.commit('unpack')
+    # killed while appending the next checkpoint
+    with open(str(tmp_path / JOURNAL), 'a') as f:
+        f.write('{"step": "stages", "files": {"unpacked/sys')
+    _write(tmp_path / 'unpacked' / 'vendor.img', b'vendor' * 1000)
+    journal = Journal(str(tmp_path), RUN)
+    assert [cp.step for cp in journal.checkpoints] == ['unpack']
+    # rewritten without the torn line
+    with open(str(tmp_path / JOURNAL)) as f:
+        assert [json.loads(line).get('step') for line in f] == [None, 'unpack']
+    assert journal.resume().step == 'unpack'
+    assert (tmp_path / 'unpacked' / 'system.img').exists()
+    assert not (tmp_path / 'unpacked' / 'vendor.img').exists()
+
+
+def test_corrupted_artifact(tmp_path, caplog):
+    journal = Journal(str(tmp_path), RUN)
+    _write(tmp_path / 'system.img.lz4', b'lz4' * 1000)
+    journal.commit('unpack')
+    _write(tmp_path / 'system.img', b'system' * 1000)
+    journal.commit('stages')
+    # same size, other bytes
+    _write(tmp_path / 'system.img', b'SYSTEM' * 1000)
+    with caplog.at_level(logging.WARNING, logger='rom_analyzer'):
+        assert Journal(str(tmp_path), RUN).resume().step == 'unpack'
+    assert 'system.img of stages is corrupted' in caplog.text
+    assert (tmp_path / 'system.img.lz4').exists()
+    assert not (tmp_path / 'system.img').exists()
+
+
+def test_user_file_between_runs(tmp_path, caplog):
+    before = _write(tmp_path / 'notes.txt', b'there before the first run')
+    journal = Journal(str(tmp_path), RUN)
+    _write(tmp_path / 'system.img', b'system' * 1000)
+    journal.commit('unpack')
+    added = _write(tmp_path / 'analysis' / 'report.txt', b'added between the runs')
+    with caplog.at_level(logging.WARNING, logger='rom_analyzer'):
+        assert Journal(str(tmp_path), RUN).resume().step == 'unpack'
+    assert before.exists()
+    # not part of any checkpoint, so it goes, but never silently
+    assert not added.exists()
+    assert 'removing {}'.format(added) in caplog.text
+    assert str(before) not in caplog.text
+
+
+def test_commit_hashes_artifacts(tmp_path, monkeypatch):
+    journal = Journal(str(tmp_path), RUN)
+    _write(tmp_path / 'system.img.lz4', b'lz4' * 1000)
+    journal.commit('unpack')
+    hashed = []
+
+    def sha256(path):
+        hashed.append(path)
+        return 'sha of ' + path
+
+    monkeypatch.setattr(journal_module, 'file_sha256', sha256)
+    # next run, another process: nothing hashed before
+    journal = Journal(str(tmp_path), RUN)
+    _write(tmp_path / 'system.img', b'system' * 1000)
+    journal.commit('stages')
+    assert hashed == [str(tmp_path / 'system.img')]
+    assert journal.done('stages').files['system.img.lz4'] == journal.done('unpack').files['system.img.lz4']
+
+
+def test_other_run(tmp_path):
+    journal = Journal(str(tmp_path), RUN)
+    _write(tmp_path / 'system.img', b'system' * 1000)
+    journal.commit('unpack')
+    journal = Journal(str(tmp_path), dict(RUN, size=2))
+    assert journal.checkpoints == []
+    # the files of the other run are no files of this one: left alone
+    assert journal.resume() is None
+    assert (tmp_path / 'system.img').exists()
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from arx.fixtures import write_dz, write_kdz
+from arx.formats_extraction import extract_dz, extract_kdz
+from arx.kdz import DZ_HEADER_SIZE, DzReader, KdzError
+
+# of the MD5 in a chunk header: magic, partition, file name, lengths
+CHUNK_MD5_OFFSET = 4 + 32 + 64 + 4 + 4
+
+
+@pytest.fixture
+def images(tmp_path):
+    images = {}
+    for name in ('system', 'vendor'):
+        images[name] = str(tmp_path / (name + '.bin'))
+        with open(images[name], 'wb') as f:
+            f.write(os.urandom(4096 * 16) + bytes(4096 * 8) + os.urandom(4096 * 8))
+    return images
+
+
+def test_extract_kdz(images, tmp_path):
+    kdz = write_kdz(write_dz(images, str(tmp_path / 'fixture.dz')), str(tmp_path / 'fixture.kdz'))
+    os.remove(str(tmp_path / 'fixture.dz'))
+    assert extract_kdz(kdz)
+    for name, image in images.items():
+        with open(str(tmp_path / (name + '.img')), 'rb') as a, open(image, 'rb') as b:
+            assert a.read() == b.read()
+
+
+def test_md5_mismatch(images, tmp_path):
+    dz = write_dz(images, str(tmp_path / 'fixture.dz'))
+    # MD5 of the first chunk, of system
+    with open(dz, 'r+b') as f:
+        f.seek(DZ_HEADER_SIZE + CHUNK_MD5_OFFSET)
+        md5 = f.read(16)
+        f.seek(-16, os.SEEK_CUR)
+        f.write(bytes(b ^ 0xFF for b in md5))
+    with pytest.raises(KdzError, match='system'):
+        DzReader(dz).extract_all(str(tmp_path / 'out'), workers=2)
+    assert os.listdir(str(tmp_path / 'out')) == ['vendor.img']
+    assert not extract_dz(dz)
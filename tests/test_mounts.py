@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from arx import mounts
+from arx.mounts import MountError, MountManager, mount_options
+
+
+@pytest.fixture
+def loop(monkeypatch):
+    # mount points of the fake mount and umount, with their options
+    mounted = {}
+    failing = set()
+
+    def mount(image, mnt_point, options):
+        if image in failing:
+            return False
+        mounted[mnt_point] = (image, options)
+        return True
+
+    def umount(mnt_point, lazy=False):
+        return mounted.pop(mnt_point, None) is not None
+
+    monkeypatch.setattr(mounts, 'mount', mount)
+    monkeypatch.setattr(mounts, 'umount', umount)
+    monkeypatch.setattr(mounts, 'has_journal', lambda image: image.endswith('ext4.img'))
+    return mounted, failing
+
+
+def test_options(loop):
+    assert mount_options('system.ext4.img', True) == 'loop,ro,noatime,noload'
+    assert mount_options('vendor.erofs.img', True) == 'loop,ro,noatime'
+    assert mount_options('system.ext4.img', False) == 'loop'
+
+
+def test_max_mounts(loop, tmp_path):
+    mounted, _ = loop
+    with MountManager(max_mounts=2, slots_dir=str(tmp_path / 'slots')) as manager:
+        system = manager.mount('system.ext4.img', str(tmp_path))
+        vendor = manager.mount('vendor.img', str(tmp_path))
+        assert mounted[system] == ('system.ext4.img', 'loop,ro,noatime,noload')
+        assert manager.image_of(vendor) == 'vendor.img'
+        # a single ROM holding all of them: waiting for a slot would be waiting for itself
+        with pytest.raises(MountError, match='already 2 mounts'):
+            manager.mount('product.img', str(tmp_path))
+        manager.unmount(system)
+        assert not os.path.exists(system)
+        assert manager.image_of(system) is None
+        manager.mount('product.img', str(tmp_path))
+    assert mounted == {}
+
+
+def test_failed_mount(loop, tmp_path):
+    mounted, failing = loop
+    failing.add('system.img')
+    with MountManager(max_mounts=1, read_only=False, slots_dir=str(tmp_path / 'slots')) as manager:
+        with pytest.raises(MountError, match='mount -o loop failed'):
+            manager.mount('system.img', str(tmp_path))
+        # neither the mount point nor the slot is left behind
+        assert sorted(os.listdir(str(tmp_path))) == ['slots']
+        manager.mount('vendor.img', str(tmp_path))
+    assert mounted == {}
+
+
+def test_close(loop, tmp_path, monkeypatch):
+    mounted, _ = loop
+    monkeypatch.setattr(mounts, 'UMOUNT_RETRY_SECONDS', 0)
+    closed = []
+
+    class Handle:
+        def close(self):
+            closed.append(self)
+
+    manager = MountManager(max_mounts=None)
+    points = [manager.mount(image, str(tmp_path)) for image in ('system.img', 'vendor.img')]
+    manager.track(Handle())
+    # unmounted behind the manager's back: reported, the others are still undone
+    del mounted[points[1]]
+    monkeypatch.setattr(os.path, 'ismount', lambda path: True)
+    errors = manager.close()
+    assert len(closed) == 1
+    assert [e.mnt_point for e in errors] == [points[1]]
+    assert mounted == {}
+    assert not os.path.exists(points[0])
+    assert manager.close() == []
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+import pytest
+
+from arx import payload as payload_module
+from arx.fixtures import write_payload
+from arx.formats_extraction import extract_ota_payload_bin
+from arx.payload import OP_REPLACE_ZSTD, PayloadError, PayloadReader
+
+
+def _images(tmp_path):
+    images = {}
+    for name in ('system', 'vendor'):
+        images[name] = str(tmp_path / (name + '.bin'))
+        with open(images[name], 'wb') as f:
+            # compressible half, random half, zero blocks
+            f.write(b'arx' * 4096 * 32 + os.urandom(4096 * 64) + bytes(4096 * 16))
+    return images
+
+
+def _assert_extracted(extracted, images):
+    assert sorted(extracted) == sorted(images)
+    for name, image in images.items():
+        with open(extracted[name], 'rb') as a, open(image, 'rb') as b:
+            assert a.read() == b.read()
+
+
+def test_extract_all(tmp_path):
+    images = _images(tmp_path)
+    reader = PayloadReader(write_payload(images, str(tmp_path / 'payload.bin')))
+    _assert_extracted(reader.extract_all(str(tmp_path / 'out'), workers=2), images)
+
+
+@pytest.mark.skipif(payload_module.zstandard is None and shutil.which('zstd') is None, reason='needs zstd')
+def test_replace_zstd(tmp_path):
+    images = _images(tmp_path)
+    reader = PayloadReader(write_payload(images, str(tmp_path / 'payload.bin'), zstd=True))
+    assert any(op.type == OP_REPLACE_ZSTD for p in reader.partitions for op in p.operations)
+    _assert_extracted(reader.extract_all(str(tmp_path / 'out')), images)
+
+
+def test_replace_zstd_unsupported(tmp_path, monkeypatch):
+    if payload_module.zstandard is None and shutil.which('zstd') is None:
+        pytest.skip('needs zstd to write the payload')
+    path = write_payload(_images(tmp_path), str(tmp_path / 'payload.bin'), zstd=True)
+    monkeypatch.setattr(payload_module, 'zstandard', None)
+    monkeypatch.setattr(payload_module, 'ZSTD_COMMAND', ['arx-no-such-zstd'])
+    with pytest.raises(PayloadError, match='REPLACE_ZSTD'):
+        PayloadReader(path).extract_all(str(tmp_path / 'out'))
+    assert os.listdir(str(tmp_path / 'out')) == []
+
+
+def test_sha256_mismatch(tmp_path):
+    path = write_payload(_images(tmp_path), str(tmp_path / 'payload.bin'))
+    # the data of the last operation, of vendor
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+    with pytest.raises(PayloadError, match='vendor'):
+        PayloadReader(path).extract_all(str(tmp_path / 'out'))
+    assert os.listdir(str(tmp_path / 'out')) == ['system.img']
+    assert not extract_ota_payload_bin(path, str(tmp_path / 'out'))
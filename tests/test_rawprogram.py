@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from arx.formats_extraction import unsparse_joiner
+from arx.rawprogram import RawProgramPiece, assemble_rawprogram, assembled_pieces, parse_rawprogram
+
+SECTOR = 512
+RAWPROGRAM = """<?xml version="1.0" ?>
+<data>
+  <program SECTOR_SIZE_IN_BYTES="512" filename="system_2.img" label="system" num_partition_sectors="4"
+           start_sector="1200"/>
+  <program SECTOR_SIZE_IN_BYTES="512" filename="system_1.img" label="system" num_partition_sectors="2"
+           start_sector="1000."/>
+  <program SECTOR_SIZE_IN_BYTES="512" filename="vendor_1.img" label="vendor" num_partition_sectors="1"
+           start_sector="2000"/>
+  <program SECTOR_SIZE_IN_BYTES="512" filename="vendor_2.img" label="vendor" num_partition_sectors="1"
+           start_sector="2001"/>
+  <program SECTOR_SIZE_IN_BYTES="512" filename="boot.img" label="boot" num_partition_sectors="64"
+           start_sector="3000"/>
+  <program SECTOR_SIZE_IN_BYTES="512" filename="" label="userdata" num_partition_sectors="64" start_sector="4000"/>
+  <program SECTOR_SIZE_IN_BYTES="512" filename="gpt_backup0.bin" label="BackupGPT" num_partition_sectors="33"
+           start_sector="NUM_DISK_SECTORS-33."/>
+</data>
+"""
+PIECES = {'system_1.img': b'\x01' * 2 * SECTOR, 'system_2.img': b'\x02' * SECTOR, 'vendor_1.img': b'\x03' * SECTOR,
+          'vendor_2.img': b'\x04' * SECTOR, 'boot.img': b'\x05' * SECTOR}
+
+
+@pytest.fixture
+def rawprogram(tmp_path):
+    for name, data in PIECES.items():
+        (tmp_path / name).write_bytes(data)
+    path = tmp_path / 'rawprogram0.xml'
+    path.write_text(RAWPROGRAM)
+    return str(path)
+
+
+def test_parse(rawprogram):
+    partitions = parse_rawprogram(rawprogram)
+    assert sorted(partitions) == ['boot', 'system', 'vendor']
+    # sorted by start sector, trailing dot dropped
+    assert partitions['system'] == [RawProgramPiece('system_1.img', 1000, 2, SECTOR),
+                                    RawProgramPiece('system_2.img', 1200, 4, SECTOR)]
+
+
+def test_assemble(rawprogram, tmp_path):
+    images = assemble_rawprogram(rawprogram)
+    assert sorted(images) == [str(tmp_path / 'system.img'), str(tmp_path / 'vendor.img')]
+    with open(str(tmp_path / 'system.img'), 'rb') as f:
+        system = f.read()
+    # pieces at their sector offsets, zeros in between, plus the size of the first piece as padding
+    assert system == PIECES['system_1.img'] + bytes(198 * SECTOR) + PIECES['system_2.img'] + bytes(2 * SECTOR)
+    with open(str(tmp_path / 'vendor.img'), 'rb') as f:
+        vendor = f.read()
+    # doubled, like combine_unsparse.sh does for the other partitions
+    assert vendor == PIECES['vendor_1.img'] + PIECES['vendor_2.img'] + bytes(2 * SECTOR)
+    # the gap is a hole, not written zeros
+    assert os.stat(str(tmp_path / 'system.img')).st_blocks * 512 < len(system)
+
+
+def test_selected_partitions(rawprogram, tmp_path):
+    assert assembled_pieces(rawprogram, ['vendor']) == [str(tmp_path / 'vendor_1.img'),
+                                                       str(tmp_path / 'vendor_2.img')]
+    assert assemble_rawprogram(rawprogram, partitions=['vendor']) == [str(tmp_path / 'vendor.img')]
+    assert not (tmp_path / 'system.img').exists()
+    # single piece partitions are used as they are
+    assert assemble_rawprogram(rawprogram, partitions=['boot']) == []
+
+
+def test_missing_piece(rawprogram, tmp_path):
+    os.remove(str(tmp_path / 'system_2.img'))
+    with pytest.raises(FileNotFoundError):
+        assemble_rawprogram(rawprogram, partitions=['system'])
+    assert unsparse_joiner(rawprogram) is False
@@ -0,0 +1,44 @@
+import os
+import shutil
+
+import pytest
+
+from arx.bench import BENCHMARKS, base_image, expected_digest, extract_rom
+from arx.fixtures import FixtureError, ROM_KINDS, build_rom, tree_digest
+from arx.imagefs import open_filesystem
+
+# big enough for the split and sparsechunks images to be classified (see arx.bench.SIZE_FILTER)
+SIZE_MIB = 64
+FORMATS = [(n, p) for n, p in BENCHMARKS if not n.startswith('rom_') and n != 'classify']
+
+pytestmark = pytest.mark.skipif(shutil.which('mke2fs') is None, reason='needs e2fsprogs')
+
+
+@pytest.fixture(scope='module')
+def image(tmp_path_factory):
+    return base_image(str(tmp_path_factory.mktemp('fixtures')), SIZE_MIB, 0, 0.5)
+
+
+@pytest.mark.parametrize('name, prepare', FORMATS, ids=[n for n, _ in FORMATS])
+def test_format(name, prepare, image, tmp_path):
+    try:
+        case = prepare(image, str(tmp_path))
+    except FixtureError as e:
+        pytest.skip(str(e))
+    value = case.fn(*case.args)
+    assert value is not None and value is not False
+    assert case.verify is None or case.verify(value)
+
+
+@pytest.mark.parametrize('kind', ROM_KINDS)
+def test_rom(kind, image, tmp_path):
+    try:
+        rom = build_rom(kind, str(tmp_path), os.path.getsize(image), image=image)
+    except FixtureError as e:
+        pytest.skip(str(e))
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    system = extract_rom(rom, str(work_dir))
+    assert system is not None
+    with open_filesystem(*system) as fs:
+        assert tree_digest(fs) == expected_digest(kind, image, str(tmp_path))
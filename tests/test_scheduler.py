@@ -0,0 +1,70 @@
+import os
+import time
+
+from arx.scheduler import RESOURCE_CPU, RESOURCE_DISK, Stage, StageScheduler
+from arx.scratch import ScratchSpace
+from arx.workdir_index import WorkDirIndex
+
+JOB_SECONDS = 0.2
+
+
+def _hold(path: str) -> bool:
+    # job of the pool processes: the time it ran, next to path
+    start = time.time()
+    time.sleep(JOB_SECONDS)
+    with open(path + '.ran', 'w') as f:
+        f.write('{} {}'.format(start, time.time()))
+    return True
+
+
+def _unpack(path: str) -> bool:
+    # firmware.zip -> firmware.lz4
+    with open(os.path.splitext(path)[0] + '.lz4', 'w') as f:
+        f.write('unpacked')
+    return True
+
+
+def _decompress(path: str) -> bool:
+    with open(os.path.splitext(path)[0] + '.img', 'w') as f:
+        f.write('decompressed')
+    return True
+
+
+def _max_concurrency(paths) -> int:
+    events = []
+    for p in paths:
+        with open(p + '.ran') as f:
+            start, end = map(float, f.read().split())
+        events += [(start, 1), (end, -1)]
+    running = peak = 0
+    # ends before starts at the same time
+    for _, delta in sorted(events):
+        running += delta
+        peak = max(peak, running)
+    return peak
+
+
+def test_resource_limits(tmp_path):
+    cpu = [str(tmp_path / 'cpu{}'.format(i)) for i in range(4)]
+    disk = [str(tmp_path / 'disk{}'.format(i)) for i in range(3)]
+    with StageScheduler(WorkDirIndex(str(tmp_path)), max_workers=4,
+                        limits={RESOURCE_CPU: 2, RESOURCE_DISK: 1}) as scheduler:
+        futures = [scheduler.submit(RESOURCE_DISK, _hold, p) for p in disk]
+        futures += [scheduler.submit(RESOURCE_CPU, _hold, p) for p in cpu]
+        assert all(f.result() for f in futures)
+    assert _max_concurrency(disk) == 1
+    assert _max_concurrency(cpu) == 2
+
+
+def test_stage_graph(tmp_path):
+    (tmp_path / 'firmware.zip').write_text('zip')
+    index = WorkDirIndex(str(tmp_path))
+    stages = [
+        Stage('lz4', ('*.lz4',), _decompress, RESOURCE_CPU, after=('zip',), consumes=lambda f: [f]),
+        Stage('zip', ('*.zip',), _unpack, RESOURCE_DISK, consumes=lambda f: [f]),
+    ]
+    with StageScheduler(index, max_workers=2, scratch=ScratchSpace(str(tmp_path), index)) as scheduler:
+        scheduler.run(stages)
+    # lz4 saw the output of zip, and each input went once its job was done
+    assert sorted(os.listdir(str(tmp_path))) == ['firmware.img']
+    assert index.findw('*') == [str(tmp_path / 'firmware.img')]
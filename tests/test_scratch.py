@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+from arx import scratch as scratch_module
+from arx.scratch import DiskBudgetError, ScratchSpace
+from arx.workdir_index import WorkDirIndex
+
+MIB = 1024 * 1024
+
+
+def _write(path, size: int):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(path), 'wb') as f:
+        # written out, so that the blocks are allocated
+        f.write(b'\1' * size)
+    return str(path)
+
+
+def test_consume(tmp_path):
+    archive = _write(tmp_path / 'rom' / 'firmware.zip', 8192)
+    rom = _write(tmp_path / 'rom.zip', 8192)
+    index = WorkDirIndex(str(tmp_path))
+    scratch = ScratchSpace(str(tmp_path), index, protected=[rom])
+    scratch.consume([archive, rom, str(tmp_path / 'gone.img')])
+    assert not (tmp_path / 'rom' / 'firmware.zip').exists()
+    assert index.find('firmware.zip') is None
+    # the input of the user is never removed
+    assert (tmp_path / 'rom.zip').exists()
+    assert scratch.removed_bytes >= 8192
+
+
+def test_keep_intermediates(tmp_path):
+    archive = _write(tmp_path / 'firmware.zip', 8192)
+    scratch = ScratchSpace(str(tmp_path), keep_intermediates=True)
+    scratch.consume([archive])
+    assert (tmp_path / 'firmware.zip').exists()
+    assert scratch.removed_bytes == 0
+
+
+def test_over_budget_with_nothing_running(tmp_path):
+    _write(tmp_path / 'system.img.lz4', MIB)
+    scratch = ScratchSpace(str(tmp_path), budget_bytes=2 * MIB)
+    with scratch.reserving(MIB // 2, 'lz4'):
+        pass
+    # nothing would free space: fails instead of waiting
+    with pytest.raises(DiskBudgetError, match='lz4 needs about'):
+        scratch.reserve(2 * MIB, 'lz4')
+
+
+def test_waits_for_running_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(scratch_module, 'BUDGET_POLL_SECONDS', 0.01)
+    lz4 = _write(tmp_path / 'system.img.lz4', MIB)
+    scratch = ScratchSpace(str(tmp_path), budget_bytes=3 * MIB)
+    scratch.reserve(MIB, 'first')
+    reserved = threading.Event()
+
+    def second():
+        scratch.reserve(2 * MIB, 'second')
+        reserved.set()
+
+    waiter = threading.Thread(target=second)
+    waiter.start()
+    # 1M used and 1M reserved: 2M more don't fit until the first job is done with its input
+    assert not reserved.wait(0.2)
+    scratch.consume([lz4])
+    scratch.release(MIB)
+    waiter.join(5)
+    assert reserved.is_set()
+    scratch.release(2 * MIB)
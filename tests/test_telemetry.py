@@ -0,0 +1,34 @@
+import resource
+import threading
+
+from types import SimpleNamespace
+
+from arx import telemetry
+from arx.telemetry import CATEGORY_STEP, Recorder
+
+
+def _rusage(cpu: float, io_blocks: int):
+    return SimpleNamespace(ru_utime=cpu, ru_stime=cpu, ru_inblock=io_blocks, ru_oublock=io_blocks, ru_maxrss=1)
+
+
+def test_children_of_other_threads(monkeypatch):
+    monkeypatch.setattr(telemetry, '_usage', lambda who: (0.0, 0.0, 0, 0))
+    recorder = Recorder()
+    other = threading.Thread(target=telemetry.add_child_usage, args=(_rusage(100.0, 1000),))
+    with recorder.span('unpack', CATEGORY_STEP):
+        telemetry.add_child_usage(_rusage(1.0, 2))
+        # a command reaped by another thread meanwhile is not one of this span
+        other.start()
+        other.join()
+    span = recorder.spans[0]
+    assert (span.cpu_user, span.cpu_system, span.read_bytes, span.write_bytes) == (1.0, 1.0, 1024, 1024)
+
+
+def test_process_peak_rss():
+    recorder = Recorder()
+    with recorder.span('unpack', CATEGORY_STEP):
+        pass
+    # the high-water mark of the process so far, not of the span
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    assert 0 < recorder.spans[0].process_peak_rss <= peak
+    assert recorder.summary()['step:unpack']['process_peak_rss'] == recorder.spans[0].process_peak_rss
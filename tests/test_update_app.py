@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from arx.fixtures import write_update_app
+from arx.formats_extraction import extract_update_app
+from arx.update_app import UpdateAppError, UpdateAppReader
+
+
+@pytest.fixture
+def update_app(tmp_path):
+    images = {}
+    for file_type in ('SYSTEM', 'VENDOR'):
+        images[file_type] = str(tmp_path / (file_type.lower() + '.bin'))
+        with open(images[file_type], 'wb') as f:
+            f.write(os.urandom(64 * 1024))
+    return write_update_app(images, str(tmp_path / 'UPDATE.APP')), images
+
+
+def test_extract_all(update_app, tmp_path):
+    path, images = update_app
+    with UpdateAppReader(path) as reader:
+        extracted = reader.extract_all(str(tmp_path / 'out'), workers=2)
+    assert sorted(extracted) == ['SYSTEM', 'VENDOR']
+    for file_type, image in images.items():
+        with open(extracted[file_type], 'rb') as a, open(image, 'rb') as b:
+            assert a.read() == b.read()
+
+
+def test_crc_error(update_app, tmp_path):
+    path, images = update_app
+    with UpdateAppReader(path) as reader:
+        vendor = reader.entries[1]
+    # last byte of the VENDOR payload
+    with open(path, 'r+b') as f:
+        f.seek(vendor.data_offset + vendor.data_length - 1)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([last[0] ^ 0xFF]))
+    with UpdateAppReader(path) as reader, pytest.raises(UpdateAppError, match='VENDOR'):
+        reader.extract_all(str(tmp_path / 'out'))
+    assert os.listdir(str(tmp_path / 'out')) == ['SYSTEM.img']
+    assert not extract_update_app(path)
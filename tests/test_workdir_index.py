@@ -0,0 +1,89 @@
+import os
+
+from arx.workdir_index import WorkDirIndex
+
+OLD = 1000000000
+
+
+def _write(path, size: int = 16):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'\0' * size)
+    return path
+
+
+def _age(root):
+    # older than RACY_MTIME_SECONDS, so the index trusts the directory mtimes
+    for d, _, files in os.walk(str(root)):
+        for name in files:
+            os.utime(os.path.join(d, name), (OLD, OLD))
+        os.utime(d, (OLD, OLD))
+
+
+def _tree(root):
+    _write(root / 'system.img', 4096)
+    _write(root / 'rom' / 'boot.img', 1024)
+    _write(root / 'rom' / 'firmware' / 'system.new.dat.br', 64)
+    _write(root / 'rom' / 'firmware' / 'system.transfer.list')
+    _age(root)
+
+
+def test_lookups(tmp_path):
+    _tree(tmp_path)
+    index = WorkDirIndex(str(tmp_path))
+    assert index.find('boot.img') == str(tmp_path / 'rom' / 'boot.img')
+    assert index.find('vendor.img') is None
+    assert index.findw('*.img') == [str(tmp_path / 'system.img'), str(tmp_path / 'rom' / 'boot.img')]
+    assert index.findw('*.br', str(tmp_path / 'rom' / 'firmware')) == [
+        str(tmp_path / 'rom' / 'firmware' / 'system.new.dat.br')]
+    assert index.findw('*.lz4') is None
+    assert sorted(index.larger_than(100)) == [str(tmp_path / 'rom' / 'boot.img'), str(tmp_path / 'system.img')]
+    assert index.size(str(tmp_path / 'system.img')) == 4096
+
+
+def test_refresh_lists_changed_directories(tmp_path, monkeypatch):
+    _tree(tmp_path)
+    index = WorkDirIndex(str(tmp_path))
+    scanned = []
+    scan_dir = index._scan_dir
+
+    def counted(d, mtime_ns):
+        scanned.append(d)
+        return scan_dir(d, mtime_ns)
+
+    monkeypatch.setattr(index, '_scan_dir', counted)
+    index.refresh()
+    assert scanned == []
+    _write(tmp_path / 'rom' / 'firmware' / 'vendor.img')
+    index.refresh()
+    assert scanned == [str(tmp_path / 'rom' / 'firmware')]
+    assert index.find('vendor.img') == str(tmp_path / 'rom' / 'firmware' / 'vendor.img')
+
+
+def test_racy_directory_listed_again(tmp_path):
+    _write(tmp_path / 'system.img', 16)
+    # just written: its size may still change without the directory mtime changing
+    index = WorkDirIndex(str(tmp_path))
+    assert index._dirs[str(tmp_path)].mtime_ns is None
+    with open(str(tmp_path / 'system.img'), 'ab') as f:
+        f.write(b'\0' * 16)
+    index.refresh()
+    assert index.size(str(tmp_path / 'system.img')) == 32
+
+
+def test_add_and_remove(tmp_path):
+    _tree(tmp_path)
+    index = WorkDirIndex(str(tmp_path))
+    # reported by a stage: no refresh needed, mtimes unchanged
+    out = _write(tmp_path / 'rom' / 'system.img.raw', 512)
+    extracted = _write(tmp_path / 'extracted' / 'super' / 'product.img', 256)
+    _age(tmp_path)
+    index.add(str(out))
+    index.add(str(tmp_path / 'extracted'))
+    assert index.size(str(out)) == 512
+    assert index.find('product.img') == str(extracted)
+    os.remove(str(tmp_path / 'rom' / 'firmware' / 'system.transfer.list'))
+    index.remove(str(tmp_path / 'rom' / 'firmware' / 'system.transfer.list'))
+    index.remove(str(tmp_path / 'extracted'))
+    assert index.find('system.transfer.list') is None
+    assert index.find('product.img') is None
+    assert str(tmp_path / 'extracted' / 'super') not in index._dirs